@@ -1,144 +1,160 @@
-import json
+from decimal import Decimal, ROUND_HALF_UP
+import itertools
 
-from sqlalchemy import distinct, func
+from sqlalchemy import distinct
 
 import immunedb.common.config as config
-from immunedb.common.models import (Clone, CloneStats, Sequence,
+import immunedb.common.dirty as dirty
+from immunedb.common.models import (Clone, CloneStats,
+                                    serialize_clone_mutations,
+                                    serialize_mutations, Sequence,
                                     SequenceCollapse)
 import immunedb.common.modification_log as mod_log
 from immunedb.common.mutations import CloneMutations
 import immunedb.util.concurrent as concurrent
+import immunedb.util.funcs as funcs
 from immunedb.util.log import logger
 
 
+def _v_identity(seq):
+    """Gets the V identity of a sequence rounded as MySQL rounds integer
+    division so results match those aggregated in the database."""
+    return (Decimal(seq.v_match) / Decimal(seq.v_length)).quantize(
+        Decimal('.0001'), rounding=ROUND_HALF_UP)
+
+
 class CloneStatsWorker(concurrent.Worker):
     """A worker class for generating clone statistics.  This worker will accept
-    one clone at a time for parallelization.
+    a batch of clones at a time for parallelization.  All sequences in the
+    batch are fetched with one query and the statistics for every sample and
+    the overall clone are calculated in memory and written in bulk.
 
     :param Session session: The database session
+    :param bool compact: If set, mutations are stored in the compact encoding
 
     """
-    def __init__(self, session):
+    def __init__(self, session, compact=False):
         self._session = session
+        self._compact = compact
 
-    def do_task(self, clone_id):
-        """Starts the task of generating clone statistics for a given
-        clone_id.
-        :param int args: The clone_id for which to calculate statistics
+    def do_task(self, clone_ids):
+        """Starts the task of generating clone statistics for a batch of
+        clones.
 
-        """
+        :param list clone_ids: The clone IDs for which to calculate statistics
 
-        existing = self._session.query(CloneStats).filter(
-            CloneStats.clone_id == clone_id).first()
-
-        if existing is not None:
+        """
+        existing = set(c.clone_id for c in self._session.query(
+                distinct(CloneStats.clone_id).label('clone_id')
+            ).filter(
+                CloneStats.clone_id.in_(clone_ids)
+            ))
+        clone_ids = [c for c in clone_ids if c not in existing]
+        if len(clone_ids) == 0:
             return
 
-        self.info('Clone {}'.format(clone_id))
-        sample_ids = [c.sample_id for c in self._session.query(
-                distinct(Sequence.sample_id).label('sample_id')
-            ).filter(
-                Sequence.clone_id == clone_id
-            )]
-        sample_ids.append(None)
-        for sample_id in sample_ids:
-            self._process_sample(clone_id, sample_id)
+        self.info('Clones {} through {}'.format(clone_ids[0], clone_ids[-1]))
+        clones = {c.id: c for c in self._session.query(Clone).filter(
+            Clone.id.in_(clone_ids))}
+        seqs = self._session.query(
+            Sequence.clone_id, Sequence.sample_id, Sequence.ai,
+            Sequence.seq_id, Sequence.sequence, Sequence._insertions,
+            Sequence.copy_number, Sequence.v_match, Sequence.v_length,
+            SequenceCollapse.copy_number_in_subject
+        ).join(SequenceCollapse).filter(
+            Sequence.clone_id.in_(clone_ids)
+        ).order_by(
+            Sequence.clone_id, Sequence.sample_id, Sequence.ai
+        ).all()
+
+        stats = []
+        clone_updates = []
+        seq_updates = []
+        for clone_id, clone_seqs in itertools.groupby(
+                seqs, key=lambda s: s.clone_id):
+            clone_inst = clones[clone_id]
+            clone_seqs = list(clone_seqs)
+            sample_mutations, seq_mutations = CloneMutations(
+                self._session, clone_inst).calculate_for_seqs(clone_seqs)
+
+            for sample_id, sample_seqs in itertools.groupby(
+                    clone_seqs, key=lambda s: s.sample_id):
+                sample_seqs = list(sample_seqs)
+                stats.append(self._get_stats(
+                    clone_inst, sample_id, sample_seqs, sample_seqs,
+                    [s.copy_number for s in sample_seqs],
+                    sample_mutations[sample_id]))
+
+            overall = [s for s in clone_seqs if s.copy_number_in_subject > 0]
+            overall_stats = self._get_stats(
+                clone_inst, None, clone_seqs, overall,
+                [s.copy_number_in_subject for s in overall],
+                sample_mutations[None])
+            stats.append(overall_stats)
+            clone_updates.append({
+                'id': clone_id,
+                'overall_unique_cnt': overall_stats['unique_cnt'],
+                'overall_instance_cnt': len(clone_seqs),
+                'overall_total_cnt': overall_stats['total_cnt'],
+            })
+            seq_updates.extend([{
+                'sample_id': sample_id,
+                'ai': ai,
+                'mutations_from_clone': serialize_mutations(
+                    mutations, compact=self._compact)
+            } for (sample_id, ai), mutations in seq_mutations.items()])
+
+        self._session.bulk_insert_mappings(CloneStats, stats)
+        self._session.bulk_update_mappings(Clone, clone_updates)
+        self._session.bulk_update_mappings(Sequence, seq_updates)
+        self._session.commit()
 
-    def _process_sample(self, clone_id, sample_id):
-        """Processes clone statistics for one sample (or the aggregate of all
-        samples).  If ``sample_id`` is None the statistics for all sequences in
-        the clone is generated.
+    def _get_stats(self, clone_inst, sample_id, seqs, counted, copies,
+                   mutations):
+        """Gets the statistics for one sample (or the aggregate of all
+        samples if ``sample_id`` is None) of a clone.
 
-        :param int clone_id: The ID of the clone
-        :param int sample_id: The ID of a sample in which the clone exists
+        :param Clone clone_inst: The clone
+        :param int sample_id: The ID of the sample or None for all samples
+        :param list seqs: The sequences from which to select the top copy
+            sequence
+        :param list counted: The sequences to include in the counts
+        :param list copies: The copy number of each of ``counted``
+        :param ContextualMutations mutations: The mutations of ``counted``
 
-        """
+        :returns: The values for a :py:class:`CloneStats` record
+        :rtype: dict
 
-        top_seq = self._session.query(
-            Sequence.ai,
-            Sequence.copy_number,
-            Sequence.sequence
-        ).filter(
-            Sequence.clone_id == clone_id
-        )
-        if sample_id is None:
-            counts = self._session.query(
-                func.count(Sequence.ai).label('unique'),
-                func.sum(SequenceCollapse.copy_number_in_subject).label(
-                    'total'),
-                func.sum(
-                    (Sequence.v_match / Sequence.v_length) *
-                    Sequence.copy_number
-                ).label('v_identity')
-            ).join(SequenceCollapse).filter(
-                Sequence.clone_id == clone_id,
-                SequenceCollapse.copy_number_in_subject > 0
-            ).first()
-        else:
-            counts = self._session.query(
-                func.count(Sequence.ai).label('unique'),
-                func.sum(Sequence.copy_number).label('total'),
-                func.sum(
-                    (Sequence.v_match / Sequence.v_length) *
-                    Sequence.copy_number
-                ).label('v_identity')
-            ).filter(
-                Sequence.sample_id == sample_id,
-                Sequence.clone_id == clone_id
-            ).first()
-            top_seq = top_seq.filter(Sequence.sample_id == sample_id)
-
-        top_seq = top_seq.order_by(
-            Sequence.copy_number.desc(),
-            Sequence.seq_id.desc()
-        ).first()
-
-        clone_inst = self._session.query(Clone).filter(
-            Clone.id == clone_id).first()
-        sample_mutations = CloneMutations(
-            self._session,
-            clone_inst
-        ).calculate(
-            commit_seqs=sample_id is not None, limit_samples=[sample_id],
-        )[sample_id]
-
-        record_values = {
-            'clone_id': clone_id,
+        """
+        top_seq = max(seqs, key=lambda s: (s.copy_number, s.seq_id))
+        total = sum(copies)
+        v_identity = sum(_v_identity(s) * s.copy_number for s in counted)
+        return {
+            'clone_id': clone_inst.id,
+            'sample_id': sample_id,
             'subject_id': clone_inst.subject_id,
             'functional': clone_inst.functional,
-            'unique_cnt': counts.unique,
-            'total_cnt': counts.total,
-            'mutations': json.dumps(sample_mutations.get_all()),
-            'avg_v_identity': counts.v_identity / counts.total,
+            'unique_cnt': len(counted),
+            'total_cnt': total,
+            'mutations': serialize_clone_mutations(mutations.get_all(),
+                                                   compact=self._compact),
+            'avg_v_identity': float(v_identity / total),
             'top_copy_seq_ai': top_seq.ai,
             'top_copy_seq_sequence': top_seq.sequence,
             'top_copy_seq_copies': top_seq.copy_number
         }
 
-        self._session.add(CloneStats(sample_id=sample_id, **record_values))
-
-        # If this clone only appears in one sample, the 'total clone' stats are
-        # the same as for the single sample
-        if sample_id is None:
-            clone_inst.overall_unique_cnt = counts.unique
-            clone_inst.overall_instance_cnt = self._session.query(
-                func.count(Sequence.ai).label('instances'),
-            ).filter(
-                Sequence.clone_id == clone_id
-            ).first().instances
-
-            clone_inst.overall_total_cnt = counts.total
-        self._session.commit()
-
     def cleanup(self):
         self._session.commit()
         self._session.close()
 
 
-def run_clone_stats(session, args):
+def run_clone_stats(session, args, batch_size=100):
     """Runs the clone statistics generation stage of the pipeline.
     :param Session session: The database session
     :param Namespace args: The arguments passed to the command
+    :param int batch_size: The number of clones for which to generate
+        statistics in each task
 
     """
     mod_log.make_mod('clone_stats', session=session, commit=True,
@@ -153,22 +169,38 @@ def run_clone_stats(session, args):
         clones = [c.id for c in session.query(Clone.id)]
     clones.sort()
 
+    dirty_clones = dirty.get_dirty(session, 'clone_stats', clones)
     if args.regen:
         logger.info('Deleting old clone statistics for {} clones'.format(
             len(clones)))
-        session.query(CloneStats).filter(
-            CloneStats.clone_id.in_(clones)
-        ).delete(synchronize_session=False)
+        for chunk in dirty.id_chunks(clones):
+            session.query(CloneStats).filter(
+                CloneStats.clone_id.in_(chunk)
+            ).delete(synchronize_session=False)
+        session.commit()
+    elif len(dirty_clones) > 0:
+        logger.info('Deleting old clone statistics for {} changed '
+                    'clones'.format(len(dirty_clones)))
+        for chunk in dirty.id_chunks(dirty_clones):
+            session.query(CloneStats).filter(
+                CloneStats.clone_id.in_(chunk)
+            ).delete(synchronize_session=False)
         session.commit()
 
     tasks = concurrent.TaskQueue()
     logger.info('Creating task queue to generate stats for {} clones.'.format(
         len(clones)))
-    for cid in clones:
-        tasks.add_task(cid)
+    for batch in funcs.chunks(clones, batch_size):
+        tasks.add_task(batch)
 
     for i in range(0, args.nproc):
-        session = config.init_db(args.db_config)
-        tasks.add_worker(CloneStatsWorker(session))
+        tasks.add_worker(CloneStatsWorker(config.init_db(args.db_config),
+                                          compact=args.compact_mutations))
 
     tasks.start()
+    dirty.clear(session, 'clone_stats', dirty_clones, [
+        c.clone_id for c in dirty.query_in(
+            session.query(distinct(CloneStats.clone_id).label('clone_id')),
+            CloneStats.clone_id, dirty_clones
+        )
+    ])
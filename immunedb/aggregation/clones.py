@@ -1,55 +1,81 @@
 from collections import OrderedDict
+import itertools
 
-from sqlalchemy import desc
+from sqlalchemy import desc, func
 from sqlalchemy.sql import text
 
-import dnautils
-from immunedb.common.models import (CDR3_OFFSET, Clone, Sequence,
+from immunedb.common.models import (CDR3_OFFSET, Clone, CloneStats,
+                                    deserialize_gaps, Sample,
+                                    SelectionPressure, Sequence,
                                     SequenceCollapse, Subject)
 import immunedb.common.modification_log as mod_log
 import immunedb.common.config as config
+import immunedb.common.dirty as dirty
+from immunedb.aggregation.similarity import (GreedySimilarityClusterer,
+                                             SingleLinkageClusterer)
 from immunedb.trees import cut_tree, get_seq_pks, LineageWorker
 import immunedb.trees.clearcut as clearcut
 import immunedb.util.concurrent as concurrent
+import immunedb.util.distance as distance
 import immunedb.util.funcs as funcs
 import immunedb.util.lookups as lookups
 from immunedb.util.log import logger
 
 
-def generate_consensus(session, clone_ids):
-    """Generates consensus CDR3s for clones.
+def generate_consensus(session, clone_ids, chunk_size=1000):
+    """Generates consensus CDR3s for clones.  Only the fields required to
+    build the consensus are fetched, for ``chunk_size`` clones per query, and
+    the clones are updated in bulk.
 
     :param Session session: The database session
     :param list clone_ids: The list of clone IDs to assign to groups
+    :param int chunk_size: The number of clones to process per query
 
     """
 
     if len(clone_ids) == 0:
         return
-    for clone in funcs.periodic_commit(
-            session,
-            session.query(Clone).filter(Clone.id.in_(clone_ids)),
-            interval=1000):
+    for chunk in funcs.chunks(sorted(clone_ids), chunk_size):
         seqs = session.query(
-            Sequence
+            Sequence.clone_id, Sequence.cdr3_nt, Sequence.cdr3_num_nts,
+            Sequence.germline, Sequence._insertions
         ).join(SequenceCollapse).filter(
-            Sequence.clone_id == clone.id,
+            Sequence.clone_id.in_(chunk),
             SequenceCollapse.copy_number_in_subject > 0
-        ).all()
-        clone.cdr3_nt = funcs.consensus([s.cdr3_nt for s in seqs])
-        clone.cdr3_aa = lookups.aas_from_nts(clone.cdr3_nt)
+        ).order_by(Sequence.clone_id, Sequence.sample_id, Sequence.ai)
 
-        clone.germline = generate_germline(session, seqs, clone)
+        updates = []
+        for clone_id, clone_seqs in itertools.groupby(
+                seqs, key=lambda s: s.clone_id):
+            clone_seqs = list(clone_seqs)
+            cdr3_nt = funcs.consensus([s.cdr3_nt for s in clone_seqs])
+            germline, functional = generate_germline(clone_seqs[0])
+            updates.append({
+                'id': clone_id,
+                'cdr3_nt': cdr3_nt,
+                'cdr3_aa': lookups.aas_from_nts(cdr3_nt),
+                'germline': germline,
+                'functional': functional,
+            })
+        session.bulk_update_mappings(Clone, updates)
+        session.commit()
 
-    session.commit()
 
+def generate_germline(rep_seq):
+    """Generates the germline for a clone from one of its sequences with the
+    CDR3 replaced by gaps.
 
-def generate_germline(session, seqs, clone):
-    rep_seq = seqs[0]
-    cdr3_start_pos = sum(rep_seq.regions[:5])
+    :param Sequence rep_seq: A representative sequence from the clone
+
+    :returns: A tuple of the germline and if it is functional
+    :rtype: tuple
+
+    """
+    cdr3_start_pos = sum(funcs.get_regions(
+        deserialize_gaps(rep_seq._insertions)))
     germline = rep_seq.germline[:cdr3_start_pos]
-    germline += '-' * clone.cdr3_num_nts
-    clone.functional = (
+    germline += '-' * rep_seq.cdr3_num_nts
+    functional = (
         len(germline) % 3 == 0 and
         not lookups.has_stop(germline)
     )
@@ -57,53 +83,131 @@ def generate_germline(session, seqs, clone):
     j_region = rep_seq.germline[cdr3_start_pos + rep_seq.cdr3_num_nts:]
     germline += j_region
 
-    return germline
+    return germline, functional
+
 
+def invalidate_clones(session, clone_ids):
+    """Removes the statistics, selection pressure, and trees of clones whose
+    membership has changed.  Each clone is marked dirty only for the stages
+    which had results for it, since the others will generate them anyway.
+
+    :param Session session: The database session
+    :param list clone_ids: The IDs of the changed clones
+
+    """
+    for chunk in dirty.id_chunks(clone_ids):
+        results = {
+            'clone_stats': session.query(
+                CloneStats.clone_id
+            ).filter(CloneStats.clone_id.in_(chunk)).distinct(),
+            'clone_pressure': session.query(
+                SelectionPressure.clone_id
+            ).filter(SelectionPressure.clone_id.in_(chunk)).distinct(),
+            'clone_tree': session.query(Clone.id).filter(
+                Clone.id.in_(chunk), ~Clone.tree.is_(None)),
+        }
+        for stage, query in sorted(results.items()):
+            dirty.mark_clones(session, [r[0] for r in query],
+                              'membership changed', stages=(stage,))
+
+        session.query(CloneStats).filter(
+            CloneStats.clone_id.in_(chunk)
+        ).delete(synchronize_session=False)
+        session.query(SelectionPressure).filter(
+            SelectionPressure.clone_id.in_(chunk)
+        ).delete(synchronize_session=False)
+        session.query(Clone).filter(
+            Clone.id.in_(chunk)
+        ).update({Clone.tree: None}, synchronize_session=False)
 
-def push_clone_ids(session):
-    session.connection(mapper=Sequence).execute(text('''
-        UPDATE
-            sequences AS s
-        JOIN sequence_collapse AS c
-            ON s.sample_id=c.sample_id AND s.ai=c.seq_ai
-        JOIN sequences as s2
-            ON c.collapse_to_subject_seq_ai=s2.ai
-        SET s.clone_id=s2.clone_id
-        WHERE s.seq_id!=s2.seq_id
-    '''))
 
+def push_clone_ids(session, subject_ids=None, chunk_size=100000):
+    """Assigns each sequence the clone of the sequence it collapsed to.  The
+    update is run per sample in ranges of ``chunk_size`` sequence AIs,
+    committing after each range, so it can safely be interrupted and re-run.
 
-def collapse_identical(session, buckets):
-    for i, bucket in enumerate(buckets):
-        clones = session.query(
-            Clone.id, Clone.cdr3_aa
+    :param Session session: The database session
+    :param list subject_ids: The subjects to update, or all if ``None``
+    :param int chunk_size: The range of AIs to update per statement
+
+    """
+    samples = session.query(Sample.id)
+    if subject_ids is not None:
+        samples = samples.filter(Sample.subject_id.in_(subject_ids))
+    samples = [s.id for s in samples.order_by(Sample.id)]
+
+    for i, sample_id in enumerate(samples):
+        min_ai, max_ai = session.query(
+            func.min(Sequence.ai), func.max(Sequence.ai)
         ).filter(
-            Clone.subject_id == bucket.subject_id,
-            Clone.v_gene == bucket.v_gene,
-            Clone.j_gene == bucket.j_gene,
-            Clone.cdr3_num_nts == bucket.cdr3_num_nts,
-            Clone._insertions == bucket._insertions,
-            Clone._deletions == bucket._deletions,
-        )
-        if clones.count() < 2:
+            Sequence.sample_id == sample_id
+        ).one()
+        if min_ai is None:
             continue
-        logger.info('Reducing bucket {} / {} ({} clones)'.format(
-            i, len(buckets), clones.count()))
-        uniques = {}
-        for c in clones:
-            uniques.setdefault(c.cdr3_aa, []).append(c.id)
-        uniques = [sorted(u) for u in uniques.values() if len(u) > 1]
-        if len(uniques) > 1:
-            logger.info('Collapsing {} duplicate CDR3s'.format(len(uniques)))
-        for identical in uniques:
-            rep_id = identical[0]
-            session.query(Sequence).filter(
-                Sequence.clone_id.in_(identical)
-            ).update({'clone_id': rep_id}, synchronize_session=False)
-            session.query(Clone).filter(
-                Clone.id.in_(identical[1:])
-            ).delete(synchronize_session=False)
-    session.commit()
+        for start in range(min_ai, max_ai + 1, chunk_size):
+            session.connection(mapper=Sequence).execute(text('''
+                UPDATE
+                    sequences AS s
+                JOIN sequence_collapse AS c
+                    ON s.sample_id=c.sample_id AND s.ai=c.seq_ai
+                JOIN sequences as s2
+                    ON c.collapse_to_subject_seq_ai=s2.ai
+                SET s.clone_id=s2.clone_id
+                WHERE s.sample_id=:sample_id AND s.ai>=:start AND s.ai<:end
+                    AND s.seq_id!=s2.seq_id
+            '''), sample_id=sample_id, start=start, end=start + chunk_size)
+            session.commit()
+        logger.info('Pushed clone IDs for sample {} ({} / {})'.format(
+            sample_id, i + 1, len(samples)))
+
+
+def collapse_identical(session, subject_ids):
+    """Combines clones with the same subject, V, J, CDR3 length, indels, and
+    CDR3 amino-acids into the clone with the lowest ID.  Duplicate groups are
+    found with one grouped query per subject and sequences are remapped and
+    clones deleted with one statement each.
+
+    :param Session session: The database session
+    :param list subject_ids: The subjects in which to combine clones
+
+    """
+    duplicates = '''
+        JOIN (
+            SELECT
+                subject_id, v_gene, j_gene, cdr3_num_nts, insertions,
+                deletions, cdr3_aa, MIN(id) AS rep_id
+            FROM clones
+            WHERE subject_id=:subject_id
+            GROUP BY
+                subject_id, v_gene, j_gene, cdr3_num_nts, insertions,
+                deletions, cdr3_aa
+            HAVING COUNT(*) > 1
+        ) AS g
+            ON c.subject_id=g.subject_id AND c.v_gene<=>g.v_gene
+            AND c.j_gene<=>g.j_gene AND c.cdr3_num_nts<=>g.cdr3_num_nts
+            AND c.insertions<=>g.insertions AND c.deletions<=>g.deletions
+            AND c.cdr3_aa<=>g.cdr3_aa AND c.id!=g.rep_id
+    '''
+    for subject_id in subject_ids:
+        conn = session.connection(mapper=Clone)
+        rep_ids = [r.rep_id for r in conn.execute(text('''
+            SELECT DISTINCT g.rep_id FROM clones AS c {}
+        '''.format(duplicates)), subject_id=subject_id)]
+        conn.execute(text('''
+            UPDATE
+                sequences AS s
+            JOIN clones AS c
+                ON s.clone_id=c.id
+            {}
+            SET s.clone_id=g.rep_id
+        '''.format(duplicates)), subject_id=subject_id)
+        removed = conn.execute(text('''
+            DELETE c FROM clones AS c {}
+        '''.format(duplicates)), subject_id=subject_id).rowcount
+        invalidate_clones(session, rep_ids)
+        session.commit()
+        logger.info('Reduced {} duplicate clones in subject {}'.format(
+            removed, subject_id))
 
 
 def similar_to_all(seq, rest, field, min_similarity):
@@ -118,22 +222,29 @@ def similar_to_all(seq, rest, field, min_similarity):
     :rtype: bool
 
     """
-    for comp_seq in rest:
-        dist = dnautils.hamming(
-            getattr(comp_seq, 'cdr3_' + field).replace('X', '-'),
-            getattr(seq, 'cdr3_' + field).replace('X', '-')
-        )
-        sim_frac = 1 - dist / len(comp_seq.cdr3_aa)
-        if sim_frac < min_similarity:
-            return False
-    return True
+    return can_subclone([seq], rest, min_similarity, field=field)
+
+
+def can_subclone(sub_seqs, parent_seqs, min_similarity, field='aa'):
+    """Determines if every sequence in ``sub_seqs`` is at least
+    ``min_similarity`` similar to every sequence in ``parent_seqs``.
 
+    :param list sub_seqs: The sequences of the potential subclone
+    :param list parent_seqs: The sequences of the potential parent
+    :param int min_similarity: Minimum fraction to be considered similar
+    :param str field: The CDR3 level to compare, either ``aa`` or ``nt``
+
+    :returns: If all pairs of sequences are similar
+    :rtype: bool
 
-def can_subclone(sub_seqs, parent_seqs, min_similarity):
-    for seq in sub_seqs:
-        if not similar_to_all(seq, parent_seqs, min_similarity):
-            return False
-    return True
+    """
+    if len(sub_seqs) == 0 or len(parent_seqs) == 0:
+        return True
+    return distance.all_within(
+        distance.encode([getattr(s, 'cdr3_' + field) for s in sub_seqs]),
+        distance.encode([getattr(s, 'cdr3_' + field) for s in parent_seqs]),
+        distance.max_distance(len(parent_seqs[0].cdr3_aa), min_similarity)
+    )
 
 
 class ClonalWorker(concurrent.Worker):
@@ -153,6 +264,7 @@ class ClonalWorker(concurrent.Worker):
         'min_mut_occurrence': 2,
         'min_mut_samples': 1,
         'min_seq_instances': 1,
+        'tree_method': 'clearcut',
     }
 
     def __init__(self, session, **kwargs):
@@ -230,7 +342,7 @@ class LineageClonalWorker(ClonalWorker):
             ))
             lineage = LineageWorker(
                 self.session,
-                clearcut.get_newick,
+                clearcut.NEWICK_GENERATORS[self.tree_method],
                 self.min_mut_copies,
                 self.min_mut_samples,
                 exclude_stops=False,
@@ -263,79 +375,162 @@ class LineageClonalWorker(ClonalWorker):
 
 class SimilarityClonalWorker(ClonalWorker):
     def run_bucket(self, bucket):
-        clones = OrderedDict()
         consensus_needed = set([])
-        query = self.get_bucket_seqs(bucket, sort=True)
-
-        if query.count() > 0:
-            for seq in query:
-                if seq.clone_id not in clones:
-                    clones[seq.clone_id] = []
-                clones[seq.clone_id].append(seq)
-            if None in clones:
-                for seq_to_add in clones[None]:
-                    for clone_id, existing_seqs in clones.items():
-                        if clone_id is None:
-                            continue
-                        if similar_to_all(seq_to_add, existing_seqs,
-                                          self.level, self.min_similarity):
-                            existing_seqs.append(seq_to_add)
-                            break
-                    else:
-                        new_clone = Clone(subject_id=seq.subject_id,
-                                          v_gene=seq.v_gene,
-                                          j_gene=seq.j_gene,
-                                          cdr3_num_nts=seq.cdr3_num_nts,
-                                          _insertions=seq._insertions,
-                                          _deletions=seq._deletions)
-                        self.session.add(new_clone)
-                        self.session.flush()
-                        clones[new_clone.id] = [seq_to_add]
-                del clones[None]
-
-            for clone_id, seqs in clones.items():
-                to_update = [
-                    {
-                        'sample_id': s.sample_id,
-                        'ai': s.ai,
-                        'clone_id': clone_id
-                    } for s in seqs if s.clone_id is None
-                ]
-                if len(to_update) > 0:
-                    self.session.bulk_update_mappings(Sequence, to_update)
-                    consensus_needed.add(clone_id)
+        seqs = self.get_bucket_seqs(bucket, sort=True).all()
+        if len(seqs) == 0:
+            return
+
+        clusterer = GreedySimilarityClusterer(
+            [getattr(s, 'cdr3_' + self.level) for s in seqs],
+            len(seqs[0].cdr3_aa), self.min_similarity
+        )
+        existing = OrderedDict()
+        for i, seq in enumerate(seqs):
+            if seq.clone_id is not None:
+                existing.setdefault(seq.clone_id, []).append(i)
+        clone_ids = list(existing.keys())
+        for rows in existing.values():
+            clusterer.add_clone(rows)
+
+        to_update = {}
+        for i, seq in enumerate(seqs):
+            if seq.clone_id is not None:
+                continue
+            clone = clusterer.assign(i)
+            if clone is None:
+                new_clone = Clone(subject_id=bucket.subject_id,
+                                  v_gene=bucket.v_gene,
+                                  j_gene=bucket.j_gene,
+                                  cdr3_num_nts=bucket.cdr3_num_nts,
+                                  _insertions=bucket._insertions,
+                                  _deletions=bucket._deletions)
+                self.session.add(new_clone)
+                self.session.flush()
+                clone = clusterer.add_clone([i])
+                clone_ids.append(new_clone.id)
+            to_update.setdefault(clone_ids[clone], []).append({
+                'sample_id': seq.sample_id,
+                'ai': seq.ai,
+                'clone_id': clone_ids[clone]
+            })
+
+        for clone_id, updates in to_update.items():
+            self.session.bulk_update_mappings(Sequence, updates)
+            consensus_needed.add(clone_id)
+        invalidate_clones(self.session, consensus_needed & set(existing))
         generate_consensus(self.session, consensus_needed)
 
 
+class SingleLinkageClonalWorker(ClonalWorker):
+    def run_bucket(self, bucket):
+        seqs = self.get_bucket_seqs(bucket, sort=True).all()
+        if len(seqs) == 0:
+            return
+
+        cdr3s = [getattr(s, 'cdr3_' + self.level) for s in seqs]
+        clusterer = SingleLinkageClusterer(
+            cdr3s, len(cdr3s[0]), self.min_similarity,
+            wildcards=distance.level_wildcards(self.level))
+        existing = OrderedDict()
+        for i, seq in enumerate(seqs):
+            if seq.clone_id is not None:
+                existing.setdefault(seq.clone_id, []).append(i)
+        for rows in existing.values():
+            clusterer.link(rows)
+        labels = clusterer.cluster()
+
+        # Existing clones are never merged, so new sequences linked to more
+        # than one are added to the first
+        clone_ids = {}
+        for i, seq in enumerate(seqs):
+            if seq.clone_id is not None:
+                clone_ids.setdefault(labels[i], seq.clone_id)
+
+        to_update = {}
+        for i, seq in enumerate(seqs):
+            if seq.clone_id is not None:
+                continue
+            if labels[i] not in clone_ids:
+                new_clone = Clone(subject_id=bucket.subject_id,
+                                  v_gene=bucket.v_gene,
+                                  j_gene=bucket.j_gene,
+                                  cdr3_num_nts=bucket.cdr3_num_nts,
+                                  _insertions=bucket._insertions,
+                                  _deletions=bucket._deletions)
+                self.session.add(new_clone)
+                self.session.flush()
+                clone_ids[labels[i]] = new_clone.id
+            to_update.setdefault(clone_ids[labels[i]], []).append({
+                'sample_id': seq.sample_id,
+                'ai': seq.ai,
+                'clone_id': clone_ids[labels[i]]
+            })
+
+        for updates in to_update.values():
+            self.session.bulk_update_mappings(Sequence, updates)
+        invalidate_clones(self.session, set(to_update) & set(existing))
+        generate_consensus(self.session, set(to_update))
+
+
 class SubcloneWorker(concurrent.Worker):
     def __init__(self, session, min_similarity):
         self.session = session
         self.min_similarity = min_similarity
 
     def do_task(self, bucket):
-        clones = self.session.query(Clone).filter(
+        clones = self.session.query(
+            Clone.id, Clone._insertions, Clone._deletions, Clone.parent_id
+        ).filter(
             Clone.subject_id == bucket.subject_id,
             Clone.v_gene == bucket.v_gene,
             Clone.j_gene == bucket.j_gene,
             Clone.cdr3_num_nts == bucket.cdr3_num_nts,
-        ).all()
+        ).order_by(Clone.id).all()
 
         if len(clones) == 0:
             return
         # The clones with indels are the only ones which can be subclones
-        parent_clones = set([c for c in clones if len(c.insertions) == 0 and
-                             len(c.deletions) == 0])
-        potential_subclones = [c for c in clones if c not in parent_clones and
+        parent_clones = [c.id for c in clones
+                         if c._insertions is None and c._deletions is None]
+        potential_subclones = [c.id for c in clones
+                               if (c._insertions or c._deletions) and
                                c.parent_id is None]
         self.info('Bucket {} has {} clones; parents={}, subs={}'.format(
             bucket, len(clones), len(parent_clones), len(potential_subclones)))
+        if len(parent_clones) == 0 or len(potential_subclones) == 0:
+            return
 
-        for subclone in potential_subclones:
-            for parent in parent_clones:
-                if can_subclone(subclone.sequences, parent.sequences,
-                                self.min_similarity):
-                    subclone.parent = parent
+        cdr3s = {}
+        for seq in self.session.query(
+                Sequence.clone_id, Sequence.cdr3_aa
+                ).filter(
+                    Sequence.subject_id == bucket.subject_id,
+                    Sequence.v_gene == bucket.v_gene,
+                    Sequence.j_gene == bucket.j_gene,
+                    Sequence.cdr3_num_nts == bucket.cdr3_num_nts,
+                    ~Sequence.clone_id.is_(None)
+                ).distinct():
+            cdr3s.setdefault(seq.clone_id, []).append(seq.cdr3_aa)
+        encoded = {
+            clone_id: distance.encode(clone_cdr3s)
+            for clone_id, clone_cdr3s in cdr3s.items()
+        }
+        max_dist = distance.max_distance(
+            len(next(iter(cdr3s.values()))[0]), self.min_similarity)
+
+        updates = []
+        for subclone_id in potential_subclones:
+            if subclone_id not in encoded:
+                continue
+            for parent_id in parent_clones:
+                if parent_id not in encoded:
+                    continue
+                if distance.all_within(encoded[subclone_id],
+                                       encoded[parent_id], max_dist):
+                    updates.append({'id': subclone_id, 'parent_id': parent_id})
                     break
+        if len(updates) > 0:
+            self.session.bulk_update_mappings(Clone, updates)
         self.session.commit()
 
     def cleanup(self):
@@ -386,7 +581,6 @@ def run_clones(session, args):
         session.commit()
 
     tasks = concurrent.TaskQueue()
-    all_buckets = []
     for subject_id in subject_ids:
         logger.info('Generating task queue for subject {}'.format(
             subject_id))
@@ -405,13 +599,13 @@ def run_clones(session, args):
         for bucket in buckets:
             if not args.gene or bucket.v_gene.startswith(args.gene):
                 tasks.add_task(bucket)
-        all_buckets.extend(buckets)
 
     logger.info('Generated {} total tasks'.format(tasks.num_tasks()))
 
     methods = {
         'similarity': SimilarityClonalWorker,
         'lineage': LineageClonalWorker,
+        'linkage': SingleLinkageClonalWorker,
     }
     for i in range(0, min(tasks.num_tasks(), args.nproc)):
         worker = methods[args.method](
@@ -426,6 +620,7 @@ def run_clones(session, args):
         logger.info('Skipping subclones')
 
     if args.reduce:
-        collapse_identical(session, all_buckets)
-    push_clone_ids(session)
+        collapse_identical(session, subject_ids)
+    push_clone_ids(session, subject_ids)
+    dirty.mark_subject_samples(session, subject_ids, 'clones')
     session.commit()
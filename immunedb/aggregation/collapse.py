@@ -1,11 +1,14 @@
+import numpy as np
 from sqlalchemy.sql import exists
 
-import dnautils
+from immunedb.aggregation.clones import invalidate_clones
 import immunedb.common.config as config
-from immunedb.common.models import (Clone, Sample, Sequence, SequenceCollapse,
-                                    Subject)
+import immunedb.common.dirty as dirty
+from immunedb.common.models import (Clone, Sample, SampleStatBin, Sequence,
+                                    SequenceCollapse, Subject)
 import immunedb.common.modification_log as mod_log
 import immunedb.util.concurrent as concurrent
+import immunedb.util.distance as distance
 
 from immunedb.util.log import logger
 
@@ -22,56 +25,162 @@ class CollapseWorker(concurrent.Worker):
     def do_task(self, bucket):
         seqs = self._session.query(
             Sequence.sample_id, Sequence.ai, Sequence.seq_id,
-            Sequence.sequence, Sequence.copy_number
-        ).filter(
+            Sequence.sequence, Sequence.copy_number, Sequence.clone_id,
+            SequenceCollapse.collapse_to_subject_sample_id,
+            SequenceCollapse.collapse_to_subject_seq_ai,
+            SequenceCollapse.instances_in_subject,
+            SequenceCollapse.copy_number_in_subject
+        ).outerjoin(SequenceCollapse).filter(
             Sequence.subject_id == bucket.subject_id,
             Sequence.v_gene == bucket.v_gene,
             Sequence.j_gene == bucket.j_gene,
             Sequence.cdr3_num_nts == bucket.cdr3_num_nts,
             Sequence._insertions == bucket._insertions,
             Sequence._deletions == bucket._deletions
-        )
+        ).all()
 
+        # Sequences with collapse information are from samples which were
+        # previously collapsed and are only present with incremental collapsing
+        existing = [s for s in seqs
+                    if s.collapse_to_subject_seq_ai is not None]
         to_process = sorted([{
             'sample_id': s.sample_id,
             'ai': s.ai,
             'seq_id': s.seq_id,
             'sequence': s.sequence,
             'cn': s.copy_number
-        } for s in seqs], key=lambda e: -e['cn'])
+        } for s in seqs if s.collapse_to_subject_seq_ai is None],
+            key=lambda e: -e['cn'])
+        if len(existing) > 0 and len(to_process) > 0:
+            to_process = self._collapse_to_existing(existing, to_process)
+
+        by_length = {}
+        for seq in to_process:
+            by_length.setdefault(len(seq['sequence']), []).append(seq)
+        if len(by_length) > 1:
+            self.warning('Bucket {} has sequences of {} different lengths '
+                         'which will not be collapsed together'.format(
+                             bucket, len(by_length)))
+        for group in by_length.values():
+            self._collapse_group(group)
+
+        self._session.commit()
+        self._tasks += 1
+        if self._tasks > 0 and self._tasks % 100 == 0:
+            self.info('Collapsed {} buckets'.format(self._tasks))
+
+    def _collapse_to_existing(self, existing, to_process):
+        """Collapses new sequences into the existing subject-level sequences
+        without changing any existing collapse relationships.  Each new
+        sequence is collapsed to the existing representative with the highest
+        copy number it is equal to.
+
+        :param list existing: The previously collapsed sequences
+        :param list to_process: The new sequences sorted by descending copy
+            number
+
+        :returns: The new sequences which did not collapse to an existing
+            sequence
+        :rtype: list
+
+        """
+        rep_samples = {}
+        for seq in existing:
+            rep_samples.setdefault(
+                seq.collapse_to_subject_seq_ai, set()).add(seq.sample_id)
+        reps = sorted([
+            s for s in existing
+            if s.collapse_to_subject_seq_ai == s.ai and
+            s.collapse_to_subject_sample_id == s.sample_id
+        ], key=lambda s: (-s.copy_number_in_subject, s.ai))
+
+        updates = {}
+        touched_clones = set()
+        remaining = []
+        for length in set(len(s['sequence']) for s in to_process):
+            new_seqs = [s for s in to_process if len(s['sequence']) == length]
+            length_reps = [r for r in reps if len(r.sequence) == length]
+            if len(length_reps) == 0:
+                remaining.extend(new_seqs)
+                continue
+            dists = distance.pairwise(
+                distance.encode([s['sequence'] for s in new_seqs],
+                                wildcards='N-'),
+                distance.encode([r.sequence for r in length_reps],
+                                wildcards='N-'))
+            for seq, seq_dists in zip(new_seqs, dists):
+                matches = np.nonzero(seq_dists == 0)[0]
+                if len(matches) == 0:
+                    remaining.append(seq)
+                    continue
+                rep = length_reps[matches[0]]
+                update = updates.setdefault(rep.ai, {
+                    'sample_id': rep.sample_id,
+                    'seq_ai': rep.ai,
+                    'instances_in_subject': rep.instances_in_subject,
+                    'copy_number_in_subject': rep.copy_number_in_subject,
+                })
+                update['instances_in_subject'] += 1
+                update['copy_number_in_subject'] += seq['cn']
+                rep_samples[rep.ai].add(seq['sample_id'])
+                update['samples_in_subject'] = len(rep_samples[rep.ai])
+                if rep.clone_id is not None:
+                    touched_clones.add(rep.clone_id)
+
+                self._session.add(SequenceCollapse(**{
+                    'sample_id': seq['sample_id'],
+                    'seq_ai': seq['ai'],
+                    'collapse_to_subject_seq_ai': rep.ai,
+                    'collapse_to_subject_sample_id': rep.sample_id,
+                    'collapse_to_subject_seq_id': rep.seq_id,
+                    'instances_in_subject': 0,
+                    'copy_number_in_subject': 0,
+                    'samples_in_subject': 0,
+                }))
+
+        if len(updates) > 0:
+            self._session.bulk_update_mappings(SequenceCollapse,
+                                               list(updates.values()))
+        invalidate_clones(self._session, touched_clones)
+        return sorted(remaining, key=lambda e: -e['cn'])
+
+    def _collapse_group(self, to_process):
+        """Collapses a list of equal-length sequences, sorted by descending
+        copy number, into the largest sequence each is equal to.
+
+        :param list to_process: The sequences to collapse
+
+        """
+        encoded = distance.encode([s['sequence'] for s in to_process],
+                                  wildcards='N-')
+        remaining = np.ones(len(to_process), dtype=bool)
+        for i, larger in enumerate(to_process):
+            if not remaining[i]:
+                continue
+            remaining[i] = False
+            others = np.nonzero(remaining)[0]
+            matches = others[
+                distance.hamming_to_many(encoded[i], encoded[others]) == 0
+            ]
+            remaining[matches] = False
 
-        while len(to_process) > 0:
-            # Get the largest sequence in the list
-            larger = to_process.pop(0)
-            # Iterate over all smaller sequences to find matches
-            instances = 1
             samples = set([larger['sample_id']])
-            for i in reversed(range(len(to_process))):
-                smaller = to_process[i]
-                if len(larger['sequence']) != len(smaller['sequence']):
-                    self.warning('Tried to collapse sequences of different '
-                                 'lengths.  AIs are {} {}'.format(
-                                     larger['ai'], smaller['ai']))
-                elif dnautils.equal(larger['sequence'], smaller['sequence']):
-                    # Add the smaller sequence's copy number to the larger
-                    larger['cn'] += smaller['cn']
-                    # If the smaller sequence matches the larger, collapse it
-                    # to the larger
-                    self._session.add(SequenceCollapse(**{
-                        'sample_id': smaller['sample_id'],
-                        'seq_ai': smaller['ai'],
-                        'collapse_to_subject_seq_ai': larger['ai'],
-                        'collapse_to_subject_sample_id': larger['sample_id'],
-                        'collapse_to_subject_seq_id': larger['seq_id'],
-                        'instances_in_subject': 0,
-                        'copy_number_in_subject': 0,
-                        'samples_in_subject': 0,
-                    }))
-                    instances += 1
-                    samples.add(smaller['sample_id'])
-                    # Delete the smaller sequence from the list to process
-                    # since it's been collapsed
-                    del to_process[i]
+            for j in matches:
+                smaller = to_process[j]
+                # Add the smaller sequence's copy number to the larger
+                larger['cn'] += smaller['cn']
+                # Collapse the smaller sequence to the larger
+                self._session.add(SequenceCollapse(**{
+                    'sample_id': smaller['sample_id'],
+                    'seq_ai': smaller['ai'],
+                    'collapse_to_subject_seq_ai': larger['ai'],
+                    'collapse_to_subject_sample_id': larger['sample_id'],
+                    'collapse_to_subject_seq_id': larger['seq_id'],
+                    'instances_in_subject': 0,
+                    'copy_number_in_subject': 0,
+                    'samples_in_subject': 0,
+                }))
+                samples.add(smaller['sample_id'])
 
             # Update the larger sequence's copy number and "collapse" to itself
             self._session.add(SequenceCollapse(**{
@@ -80,16 +189,11 @@ class CollapseWorker(concurrent.Worker):
                 'collapse_to_subject_sample_id': larger['sample_id'],
                 'collapse_to_subject_seq_id': larger['seq_id'],
                 'collapse_to_subject_seq_ai': larger['ai'],
-                'instances_in_subject': instances,
+                'instances_in_subject': len(matches) + 1,
                 'copy_number_in_subject': larger['cn'],
                 'samples_in_subject': len(samples),
             }))
 
-        self._session.commit()
-        self._tasks += 1
-        if self._tasks > 0 and self._tasks % 100 == 0:
-            self.info('Collapsed {} buckets'.format(self._tasks))
-
     def cleanup(self):
         self.info('Committing collapsed sequences')
         self._session.commit()
@@ -103,13 +207,18 @@ def run_collapse(session, args):
 
     subjects = (args.subject_ids or [e.id for e in session.query(Subject.id)])
     for subject in subjects:
-        if session.query(Sample).filter(
+        new_samples = [s.id for s in session.query(Sample.id).filter(
                 Sample.subject_id == subject,
                 ~exists().where(
                     SequenceCollapse.sample_id == Sample.id
-                )).first() is None:
+                ))]
+        if len(new_samples) == 0:
             logger.info('Subject {} already collapsed.  Skipping.'.format(
                 subject))
+        elif args.incremental:
+            logger.info('Incrementally collapsing {} new samples for subject '
+                        '{}'.format(len(new_samples), subject))
+            subject_ids.append(subject)
         else:
             logger.info('Resetting collapse info for subject {}'.format(
                 subject))
@@ -121,6 +230,9 @@ def run_collapse(session, args):
                     SequenceCollapse.sample_id == sample.id
                 ).delete(synchronize_session=False)
                 sample.sample_stats = []
+                session.query(SampleStatBin).filter(
+                    SampleStatBin.sample_id == sample.id
+                ).delete(synchronize_session=False)
             logger.info('Resetting clone info for subject {}'.format(subject))
             session.query(Clone).filter(Clone.subject_id == subject).delete()
             subject_ids.append(subject)
@@ -137,7 +249,13 @@ def run_collapse(session, args):
             Sequence.cdr3_num_nts, Sequence._insertions, Sequence._deletions
         ).filter(
             Sequence.subject_id == subject_id
-        ).group_by(
+        )
+        if args.incremental:
+            # Only buckets with uncollapsed sequences need to be processed
+            buckets = buckets.outerjoin(SequenceCollapse).filter(
+                SequenceCollapse.seq_ai.is_(None)
+            )
+        buckets = buckets.group_by(
             Sequence.subject_id, Sequence.v_gene, Sequence.j_gene,
             Sequence.cdr3_num_nts, Sequence._insertions, Sequence._deletions
         )
@@ -150,4 +268,6 @@ def run_collapse(session, args):
         tasks.add_worker(CollapseWorker(config.init_db(args.db_config)))
     tasks.start()
 
+    dirty.mark_subject_samples(session, subject_ids, 'collapse')
+    session.commit()
     session.close()
@@ -2,12 +2,13 @@ import json
 
 import numpy as np
 
-from sqlalchemy import and_, func
+from sqlalchemy import and_, case, func
 
 import immunedb.common.config as config
+import immunedb.common.dirty as dirty
 import immunedb.common.modification_log as mod_log
-from immunedb.common.models import (Clone, NoResult, Sample, SampleStats,
-                                    SelectionPressure, Sequence)
+from immunedb.common.models import (Clone, NoResult, Sample, SampleStatBin,
+                                    SampleStats, SelectionPressure, Sequence)
 import immunedb.util.concurrent as concurrent
 import immunedb.util.lookups as lookups
 from immunedb.util.log import logger
@@ -27,25 +28,30 @@ _dist_fields = [
     'sp_cdr'
 ]
 
+# Distributions of these fields are counted by category rather than with
+# fixed-size numeric histograms
+_categorical_fields = set(['v_gene', 'j_gene'])
+
 _seq_contexts = {
     'all': {
-        'record_filter': lambda seq: True,
+        'record_filter': lambda seqs: np.ones(len(seqs['functional']),
+                                              dtype=bool),
         'use_copy': True
     },
     'functional': {
-        'record_filter': lambda seq: seq.functional,
+        'record_filter': lambda seqs: seqs['functional'],
         'use_copy': True
     },
     'nonfunctional': {
-        'record_filter': lambda seq: not seq.functional,
+        'record_filter': lambda seqs: ~seqs['functional'],
         'use_copy': True
     },
     'unique': {
-        'record_filter': lambda seq: seq.functional,
+        'record_filter': lambda seqs: seqs['functional'],
         'use_copy': False
     },
     'unique_multiple': {
-        'record_filter': lambda seq: seq.functional and seq.copy_number > 1,
+        'record_filter': lambda seqs: seqs['functional'] & seqs['multiple'],
         'use_copy': False
     },
 }
@@ -53,56 +59,146 @@ _seq_contexts = {
 
 _clone_contexts = {
     'clones_all': {
-        'record_filter': lambda functional: True,
+        'record_filter': lambda functional: np.ones(len(functional),
+                                                    dtype=bool),
     },
     'clones_functional': {
         'record_filter': lambda functional: functional
     },
     'clones_nonfunctional': {
-        'record_filter': lambda functional: not functional
+        'record_filter': lambda functional: ~functional
     },
 }
 
 
+class Histogram(object):
+    """Counts the occurrences of numeric values.  Non-negative integers below
+    ``size`` are counted in a fixed-size array and all other values are
+    counted in a dictionary.
+
+    :param int size: The number of integer bins
+
+    """
+    def __init__(self, size=1024):
+        self._bins = np.zeros(size, dtype=np.int64)
+        self._other = {}
+
+    def add(self, values, weights):
+        """Adds values to the histogram.
+
+        :param numpy.ndarray values: The values, with ``nan`` for missing
+            values which are not counted
+        :param numpy.ndarray weights: The amount to count each value
+
+        """
+        present = ~np.isnan(values)
+        values = values[present]
+        weights = weights[present]
+        binned = ((values >= 0) & (values < len(self._bins)) &
+                  (values == np.floor(values)))
+        self._bins += np.bincount(
+            values[binned].astype(np.int64), weights=weights[binned],
+            minlength=len(self._bins)).astype(np.int64)
+
+        unbinned = ~binned
+        if np.any(unbinned):
+            keys, inverse = np.unique(values[unbinned], return_inverse=True)
+            counts = np.bincount(inverse, weights=weights[unbinned])
+            for key, count in zip(keys, counts):
+                key = float(key)
+                self._other[key] = self._other.get(key, 0) + int(count)
+
+    def items(self):
+        counts = [(float(k), int(self._bins[k]))
+                  for k in np.nonzero(self._bins)[0]]
+        return sorted(counts + list(self._other.items()))
+
+
+class CategoryCounts(object):
+    """Counts the occurrences of categorical values such as gene names."""
+    def __init__(self):
+        self._counts = {}
+
+    def add(self, values, weights):
+        """Adds values to the counts.
+
+        :param numpy.ndarray values: The values, with ``None`` for missing
+            values which are not counted
+        :param numpy.ndarray weights: The amount to count each value
+
+        """
+        present = np.array([v is not None for v in values], dtype=bool)
+        if not np.any(present):
+            return
+        keys, inverse = np.unique(values[present], return_inverse=True)
+        counts = np.bincount(inverse, weights=weights[present])
+        for key, count in zip(keys, counts):
+            self._counts[key] = self._counts.get(key, 0) + int(count)
+
+    def items(self):
+        return self._counts.items()
+
+
+class QualityProfile(object):
+    """Tracks the mean quality at each position with a running sum and count
+    per position."""
+    def __init__(self):
+        self._sums = np.zeros(0, dtype=np.int64)
+        self._counts = np.zeros(0, dtype=np.int64)
+
+    def add(self, qualities):
+        """Adds quality scores to the profile.
+
+        :param numpy.ndarray qualities: A matrix of ASCII-encoded quality
+            strings, one per row, as generated by :py:func:`_get_columns`
+
+        """
+        if qualities.shape[1] > len(self._sums):
+            diff = qualities.shape[1] - len(self._sums)
+            self._sums = np.append(self._sums, np.zeros(diff, np.int64))
+            self._counts = np.append(self._counts, np.zeros(diff, np.int64))
+        valid = qualities != ord(' ')
+        width = qualities.shape[1]
+        self._sums[:width] += np.where(
+            valid, qualities.astype(np.int64) - 33, 0).sum(axis=0)
+        self._counts[:width] += valid.sum(axis=0)
+
+    def means(self):
+        return [
+            (int(pos), float(round(self._sums[pos] / self._counts[pos], 2)))
+            for pos in np.nonzero(self._counts)[0]
+        ]
+
+
 class ContextStats(object):
     def __init__(self, record_filter):
         self._record_filter = record_filter
         self.distributions = {}
 
         for dist in _dist_fields:
-            self.distributions[
-                dist[0] if isinstance(dist, tuple) else dist] = {}
+            if dist in _categorical_fields:
+                self.distributions[dist] = CategoryCounts()
+            else:
+                self.distributions[dist] = Histogram()
 
         self.sequence_cnt = 0
         self.in_frame_cnt = 0
         self.stop_cnt = 0
         self.functional_cnt = 0
 
-    def _update(self, seq_record, in_frame, stop, functional, add):
-        self.sequence_cnt += add
-        if in_frame:
-            self.in_frame_cnt += add
-        if stop:
-            self.stop_cnt += add
-        if functional:
-            self.functional_cnt += add
-
-        for field in _dist_fields:
-            try:
-                value = getattr(seq_record, field)
-                if value is None:
-                    continue
-            except AttributeError:
-                continue
-            if not isinstance(value, str):
-                value = float(value)
-
-            if field not in self.distributions:
-                self.distributions[field] = {}
-            if value not in self.distributions[field]:
-                self.distributions[field][value] = 0
+    def _update(self, records, mask, in_frame, stop, functional, weights,
+                distributions=True):
+        weights = weights[mask]
+        self.sequence_cnt += int(weights.sum())
+        self.in_frame_cnt += int(weights[in_frame[mask]].sum())
+        self.stop_cnt += int(weights[stop[mask]].sum())
+        self.functional_cnt += int(weights[functional[mask]].sum())
+        if not distributions:
+            return
 
-            self.distributions[field][value] += add
+        for field, dist in self.distributions.items():
+            if field in records:
+                dist.add(records[field][mask], weights)
 
 
 class SeqContextStats(ContextStats):
@@ -110,27 +206,31 @@ class SeqContextStats(ContextStats):
         super(SeqContextStats, self).__init__(record_filter)
         self._session = session
         self._use_copy = use_copy
-        self.quality = []
+        self.quality = QualityProfile()
 
-    def _update_quality(self, seq_record):
-        if seq_record.quality is not None:
-            diff = len(seq_record.quality) - len(self.quality)
-            if diff > 0:
-                self.quality.extend([[] for _ in range(0, diff)])
+    def _weights(self, seqs):
+        return seqs['copies'] if self._use_copy else seqs['records']
 
-            for i, b in enumerate(seq_record.quality):
-                if b != ' ':
-                    self.quality[i].append(ord(b) - 33)
+    def add_if_match(self, seqs, mask, distributions=True):
+        mask = mask & self._record_filter(seqs)
+        self._update(seqs, mask, seqs['in_frame'], seqs['stop'],
+                     seqs['functional'], self._weights(seqs), distributions)
+        self.quality.add(seqs['quality'][mask])
 
-    def add_if_match(self, seq_record):
-        if not self._record_filter(seq_record):
-            return
+    def add_bins(self, bins, mask, field):
+        """Adds pre-aggregated bins to the distribution of a field.
 
-        add = int(seq_record.copy_number) if self._use_copy else 1
+        :param dict bins: The columns of the bins as generated by
+            :py:func:`_get_columns`, including ``copies`` and ``records``
+            which are the total copy number and number of sequences in each
+            bin
+        :param numpy.ndarray mask: Which bins to include
+        :param str field: The field the bins are for
 
-        self._update(seq_record, seq_record.in_frame, seq_record.stop,
-                     seq_record.functional, add)
-        self._update_quality(seq_record)
+        """
+        mask = mask & self._record_filter(bins)
+        self.distributions[field].add(bins[field][mask],
+                                      self._weights(bins)[mask])
 
 
 class CloneContextStats(ContextStats):
@@ -138,33 +238,143 @@ class CloneContextStats(ContextStats):
         super(CloneContextStats, self).__init__(record_filter)
         self._seqs = seqs
 
-    def add_if_match(self, clone, in_frame, stop, functional):
-        if not self._record_filter(functional):
-            return
-
-        self._update(clone, in_frame, stop, functional, 1)
+    def add_if_match(self, clones, mask, in_frame, stop, functional):
+        self._update(clones, mask & self._record_filter(functional),
+                     in_frame, stop, functional,
+                     np.ones(len(mask), dtype=np.int64))
+
+
+def _seq_fields():
+    """Gets the expressions for sequence distribution fields."""
+    return {
+        'v_match': Sequence.v_match,
+        'j_match': Sequence.j_match,
+        'j_length': Sequence.j_length,
+        'v_gene': Sequence.v_gene,
+        'j_gene': Sequence.j_gene,
+        'copy_number': Sequence.copy_number,
+        'v_length': Sequence.v_length + Sequence.num_gaps,
+        'v_identity': func.ceil(100 * Sequence.v_match / Sequence.v_length),
+        'cdr3_length': Sequence.cdr3_num_nts,
+    }
+
+
+def _seq_flags():
+    """Gets the expressions needed to determine which variants and contexts
+    include a sequence."""
+    return {
+        'in_frame': Sequence.in_frame,
+        'stop': Sequence.stop,
+        'functional': Sequence.functional,
+        'partial': Sequence.partial,
+        'multiple': Sequence.copy_number > 1,
+        'cdr3_length': Sequence.cdr3_num_nts,
+    }
+
+
+def _batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def _get_columns(rows):
+    """Converts query rows into a dictionary of NumPy arrays keyed by column
+    name.  Categorical fields and CDR3 nucleotides are object arrays, flags
+    are boolean arrays, quality strings are a padded matrix of ASCII values,
+    and all other fields are float arrays with ``nan`` for missing values.
+
+    :param list rows: The rows to convert
+
+    :returns: The columns of ``rows``
+    :rtype: dict
+
+    """
+    columns = {}
+    for name, values in zip(rows[0].keys(), zip(*rows)):
+        if name in _categorical_fields or name == 'cdr3_nt':
+            columns[name] = np.array(values, dtype=object)
+        elif name in ('in_frame', 'stop', 'functional', 'partial',
+                      'multiple'):
+            columns[name] = np.array(values, dtype=bool)
+        elif name == 'quality':
+            values = [q or '' for q in values]
+            width = max(len(q) for q in values)
+            columns[name] = np.frombuffer(
+                ''.join(q.ljust(width) for q in values).encode('ascii'),
+                dtype=np.uint8).reshape(len(values), width)
+        else:
+            columns[name] = np.array(values, dtype=np.float64)
+    for name in ('copies', 'records'):
+        if name in columns:
+            columns[name] = columns[name].astype(np.int64)
+    return columns
+
+
+def _get_variants(min_cdr3, max_cdr3):
+    """Gets each combination of including outliers and only including full
+    reads along with a filter to determine which sequences are included in
+    it.
+
+    :param float min_cdr3: The minimum non-outlier CDR3 length
+    :param float max_cdr3: The maximum non-outlier CDR3 length
+
+    :returns: A dictionary of filters keyed by ``(include_outliers,
+        only_full_reads)``
+    :rtype: dict
+
+    """
+    def record_filter(include_outliers, only_full_reads):
+        def check(seqs):
+            mask = np.ones(len(seqs['partial']), dtype=bool)
+            if only_full_reads:
+                mask &= ~seqs['partial']
+            if not include_outliers and min_cdr3 is not None:
+                cdr3_length = seqs['cdr3_length']
+                present = ~np.isnan(cdr3_length)
+                within = np.zeros(len(mask), dtype=bool)
+                within[present] = (
+                    (cdr3_length[present] >= min_cdr3) &
+                    (cdr3_length[present] <= max_cdr3))
+                mask &= within
+            return mask
+        return check
+
+    return {
+        (include_outliers, only_full_reads): record_filter(include_outliers,
+                                                           only_full_reads)
+        for include_outliers in [True, False]
+        for only_full_reads in [True, False]
+    }
 
 
 class SampleStatsWorker(concurrent.Worker):
-    def __init__(self, session):
+    def __init__(self, session, sql_aggregation=False, store_bins=False,
+                 batch_size=10000):
         self._session = session
+        self._sql_aggregation = sql_aggregation
+        self._store_bins = store_bins
+        self._batch_size = batch_size
 
     def do_task(self, args):
         if args['func'] == 'seq':
             func = self._calculate_seq_stats
         elif args['func'] == 'clone':
             func = self._calculate_clone_stats
-        self.info(('Processing {} for sample {}, include_outliers {}, '
-                   'only_full_reads {}').format(
-                   'sequences' if args['func'] == 'seq' else 'clones',
-                   args['sample_id'], args['include_outliers'],
-                   args['only_full_reads']))
+        self.info('Processing {} for sample {}'.format(
+                  'sequences' if args['func'] == 'seq' else 'clones',
+                  args['sample_id']))
         func(args['sample_id'], args['min_cdr3'], args['max_cdr3'],
-             args['include_outliers'], args['only_full_reads'])
+             args['no_result_cnt'])
         self._session.commit()
 
     def _add_stat(self, stats, sample_id, include_outliers,
-                  only_full_reads):
+                  only_full_reads, no_result_cnt):
         for name, stat in stats.items():
             ss = SampleStats(
                 sample_id=sample_id,
@@ -175,89 +385,173 @@ class SampleStatsWorker(concurrent.Worker):
                 in_frame_cnt=stat.in_frame_cnt,
                 stop_cnt=stat.stop_cnt,
                 functional_cnt=stat.functional_cnt,
-                no_result_cnt=self._session.query(NoResult).filter(
-                    NoResult.sample_id == sample_id).count(),
+                no_result_cnt=no_result_cnt,
             )
 
+            dists = {
+                '{}_dist'.format(dname): list(dist.items())
+                for dname, dist in stat.distributions.items()
+            }
             if hasattr(stat, 'quality'):
-                quality_dist = []
-                for pos, quals in enumerate(stat.quality):
-                    if len(quals) > 0:
-                        quality_dist.append((pos, round(np.mean(quals), 2)))
-                ss.quality_dist = json.dumps(quality_dist)
+                dists['quality_dist'] = stat.quality.means()
             else:
-                ss.quality_dist = json.dumps([])
+                dists['quality_dist'] = []
 
-            for dname, dist in stat.distributions.items():
-                setattr(ss, '{}_dist'.format(dname),
-                        json.dumps([(k, v) for k, v in dist.items()]))
+            for field, dist in dists.items():
+                setattr(ss, field, json.dumps(dist))
             self._session.add(ss)
 
-    def _calculate_seq_stats(self, sample_id, min_cdr3, max_cdr3,
-                             include_outliers, only_full_reads):
-        seq_statistics = {}
-        for name, stat in _seq_contexts.items():
-            seq_statistics[name] = SeqContextStats(self._session, **stat)
+            if self._store_bins:
+                self._session.bulk_insert_mappings(SampleStatBin, [{
+                    'sample_id': sample_id,
+                    'filter_type': name,
+                    'outliers': include_outliers,
+                    'full_reads': only_full_reads,
+                    'field': field,
+                    'key': json.dumps(key),
+                    'value': value
+                } for field, dist in dists.items() for key, value in dist])
 
-        # TODO: This should be automatically generated from _dist_fields
+    def _calculate_seq_stats(self, sample_id, min_cdr3, max_cdr3,
+                             no_result_cnt):
+        """Calculates the sequence statistics for every combination of
+        including outliers and only including full reads with one scan of the
+        sample's sequences.  Sequences are accumulated in batches so memory
+        use does not depend on the size of the sample.
+
+        :param int sample_id: The ID of the sample
+        :param float min_cdr3: The minimum non-outlier CDR3 length
+        :param float max_cdr3: The maximum non-outlier CDR3 length
+        :param int no_result_cnt: The number of sequences in the sample
+            which could not be identified
+
+        """
+        variants = _get_variants(min_cdr3, max_cdr3)
+        seq_statistics = {
+            variant: {
+                name: SeqContextStats(self._session, **stat)
+                for name, stat in _seq_contexts.items()
+            } for variant in variants
+        }
+
+        # With SQL aggregation only the columns needed to build quality
+        # profiles and counts are streamed
+        if self._sql_aggregation:
+            self._aggregate_seq_distributions(sample_id, variants,
+                                              seq_statistics)
+            fields = _seq_flags()
+        else:
+            fields = _seq_fields()
+            fields.update(_seq_flags())
+        fields['quality'] = Sequence.quality
         query = self._session.query(
-            Sequence.quality,
-            Sequence.sample_id,
-            Sequence.v_match,
-            Sequence.j_match,
-            Sequence.j_length,
-            Sequence.v_gene,
-            Sequence.j_gene,
-            Sequence.in_frame,
-            Sequence.stop,
-            Sequence.functional,
-            Sequence.copy_number,
-            (Sequence.v_length + Sequence.num_gaps).label('v_length'),
-            (
-                func.ceil(100 * Sequence.v_match / Sequence.v_length)
-            ).label('v_identity'),
-            Sequence.cdr3_num_nts.label('cdr3_length'),
+            Sequence.copy_number.label('copies'),
+            *[expr.label(name) for name, expr in fields.items()]
         ).filter(
             Sequence.sample_id == sample_id
         )
 
-        if not include_outliers and min_cdr3 is not None:
-            query = query.filter(Sequence.cdr3_num_nts >= min_cdr3,
-                                 Sequence.cdr3_num_nts <= max_cdr3)
-        if only_full_reads:
-            query = query.filter(Sequence.partial == 0)
-
-        for seq in query:
-            for name, stat in seq_statistics.items():
-                stat.add_if_match(seq)
-
-        self._add_stat(seq_statistics, sample_id, include_outliers,
-                       only_full_reads)
+        for batch in _batches(query.yield_per(self._batch_size),
+                              self._batch_size):
+            seqs = _get_columns(batch)
+            seqs['records'] = np.ones(len(batch), dtype=np.int64)
+            for variant, record_filter in variants.items():
+                mask = record_filter(seqs)
+                for stat in seq_statistics[variant].values():
+                    stat.add_if_match(
+                        seqs, mask, distributions=not self._sql_aggregation)
+
+        for (include_outliers, only_full_reads), stats in \
+                seq_statistics.items():
+            self._add_stat(stats, sample_id, include_outliers,
+                           only_full_reads, no_result_cnt)
+
+    def _aggregate_seq_distributions(self, sample_id, variants,
+                                     seq_statistics):
+        """Calculates the sequence distributions with one grouped query per
+        field, so only the bins are transferred from the database.  Bins are
+        further grouped by the fields which determine the variants and
+        contexts which include them.
+
+        :param int sample_id: The ID of the sample
+        :param dict variants: The variant filters from
+            :py:func:`_get_variants`
+        :param dict seq_statistics: The statistics for each context keyed by
+            variant
+
+        """
+        for field, expr in _seq_fields().items():
+            columns = _seq_flags()
+            columns[field] = expr
+            labels = [e.label(name) for name, e in columns.items()]
+            query = self._session.query(
+                func.sum(Sequence.copy_number).label('copies'),
+                func.count(Sequence.seq_id).label('records'),
+                *labels
+            ).filter(
+                Sequence.sample_id == sample_id
+            ).group_by(*labels)
+
+            rows = query.all()
+            if len(rows) == 0:
+                continue
+            bins = _get_columns(rows)
+            for variant, record_filter in variants.items():
+                mask = record_filter(bins)
+                for stat in seq_statistics[variant].values():
+                    stat.add_bins(bins, mask, field)
 
     def _calculate_clone_stats(self, sample_id, min_cdr3, max_cdr3,
-                               include_outliers, only_full_reads):
-        clone_statistics = {}
-        for name, stat in _clone_contexts.items():
-            clone_statistics[name] = CloneContextStats(seqs=None, **stat)
-
+                               no_result_cnt):
+        """Calculates the clone statistics for every combination of including
+        outliers and only including full reads with one grouped query.  Only
+        the full read filter affects clone statistics, so averages for full
+        reads are calculated alongside those for all reads.
+
+        :param int sample_id: The ID of the sample
+        :param float min_cdr3: The minimum non-outlier CDR3 length
+        :param float max_cdr3: The maximum non-outlier CDR3 length
+        :param int no_result_cnt: The number of sequences in the sample
+            which could not be identified
+
+        """
+        clone_statistics = {
+            only_full_reads: {
+                name: CloneContextStats(seqs=None, **stat)
+                for name, stat in _clone_contexts.items()
+            } for only_full_reads in [True, False]
+        }
+
+        def full(expr):
+            return case([(Sequence.partial == 0, expr)])
+
+        averaged = {
+            'v_match': Sequence.v_match,
+            'j_match': Sequence.j_match,
+            'j_length': Sequence.j_length,
+            'v_length': Sequence.v_length + Sequence.num_gaps,
+            'v_identity': 100 * Sequence.v_match / Sequence.v_length,
+        }
         # TODO: This should be automatically generated from _dist_fields
         query = self._session.query(
             Sequence.clone_id,
-            func.round(func.avg(Sequence.v_match)).label('v_match'),
-            func.round(func.avg(Sequence.j_match)).label('j_match'),
-            func.round(func.avg(Sequence.j_length)).label('j_length'),
+            Clone.cdr3_nt,
             Sequence.v_gene,
             Sequence.j_gene,
-            func.count(Sequence.seq_id).label('copy_number'),
-            func.round(
-                func.avg(Sequence.v_length + Sequence.num_gaps)
-            ).label('v_length'),
-            func.round(
-                func.avg(100 * Sequence.v_match / Sequence.v_length)
-            ).label('v_identity'),
             Sequence.cdr3_num_nts.label('cdr3_length'),
             SelectionPressure.sigma_fwr.label('sp_fwr'),
             SelectionPressure.sigma_cdr.label('sp_cdr'),
+            func.count(Sequence.seq_id).label('copy_number'),
+            func.count(full(Sequence.seq_id)).label('full_copy_number'),
+            *[
+                func.round(func.avg(expr)).label(field)
+                for field, expr in averaged.items()
+            ] + [
+                func.round(func.avg(full(expr))).label('full_' + field)
+                for field, expr in averaged.items()
+            ]
+        ).join(
+            Clone, Clone.id == Sequence.clone_id
         ).join(
             SelectionPressure,
             and_(
@@ -266,25 +560,39 @@ class SampleStatsWorker(concurrent.Worker):
             ),
             isouter=True
         ).filter(
-            Sequence.sample_id == sample_id,
-            ~Sequence.clone_id.is_(None)
-        )
-
-        if only_full_reads:
-            query = query.filter(Sequence.partial == 0)
-        query = query.group_by(Sequence.clone_id)
-
-        for clone in query:
-            clone_info = self._session.query(Clone.cdr3_nt).filter(
-                Clone.id == clone.clone_id).first()
-            in_frame = len(clone_info.cdr3_nt) % 3 == 0
-            stop = '*' in lookups.aas_from_nts(clone_info.cdr3_nt)
-            functional = in_frame and not stop
-            for name, stat in clone_statistics.items():
-                stat.add_if_match(clone, in_frame, stop, functional)
-
-        self._add_stat(clone_statistics, sample_id, include_outliers,
-                       only_full_reads)
+            Sequence.sample_id == sample_id
+        ).group_by(Sequence.clone_id)
+
+        for batch in _batches(query.yield_per(self._batch_size),
+                              self._batch_size):
+            clones = _get_columns(batch)
+            in_frame = np.array([len(c.cdr3_nt) % 3 == 0 for c in batch],
+                                dtype=bool)
+            stop = np.array([
+                '*' in lookups.aas_from_nts(c.cdr3_nt) for c in batch
+            ], dtype=bool)
+            functional = in_frame & ~stop
+
+            everything = np.ones(len(batch), dtype=bool)
+            for stat in clone_statistics[False].values():
+                stat.add_if_match(clones, everything, in_frame, stop,
+                                  functional)
+
+            # Use the values calculated from only full reads in place of
+            # those from all reads
+            full_clones = dict(clones)
+            for field in list(averaged) + ['copy_number']:
+                full_clones[field] = clones['full_' + field]
+            for stat in clone_statistics[True].values():
+                stat.add_if_match(full_clones,
+                                  full_clones['copy_number'] > 0, in_frame,
+                                  stop, functional)
+
+        for include_outliers in [True, False]:
+            for only_full_reads in [True, False]:
+                self._add_stat(clone_statistics[only_full_reads], sample_id,
+                               include_outliers, only_full_reads,
+                               no_result_cnt)
 
 
 def _get_cdr3_bounds(session, sample_id):
@@ -314,9 +622,9 @@ def _queue_tasks(session, sample_id, force, tasks):
         sample_id))
     existing_seq = session.query(Sequence).filter(
         Sequence.sample_id == sample_id)
-    existing_nores = session.query(NoResult).filter(
-        NoResult.sample_id == sample_id)
-    if existing_seq.first() is None and existing_nores.first() is None:
+    no_result_cnt = session.query(NoResult).filter(
+        NoResult.sample_id == sample_id).count()
+    if existing_seq.first() is None and no_result_cnt == 0:
         logger.warning('\tSKIPPING since there are no sequences in the '
                        'sample')
         return
@@ -331,24 +639,29 @@ def _queue_tasks(session, sample_id, force, tasks):
         return
 
     min_cdr3, max_cdr3 = _get_cdr3_bounds(session, sample_id)
-    for include_outliers in [True, False]:
-        for only_full_reads in [True, False]:
-            tasks.add_task({
-                'func': 'seq',
-                'sample_id': sample_id,
-                'min_cdr3': min_cdr3,
-                'max_cdr3': max_cdr3,
-                'include_outliers': include_outliers,
-                'only_full_reads': only_full_reads
-            })
-            tasks.add_task({
-                'func': 'clone',
-                'sample_id': sample_id,
-                'min_cdr3': min_cdr3,
-                'max_cdr3': max_cdr3,
-                'include_outliers': include_outliers,
-                'only_full_reads': only_full_reads
-            })
+    for func_type in ['seq', 'clone']:
+        tasks.add_task({
+            'func': func_type,
+            'sample_id': sample_id,
+            'min_cdr3': min_cdr3,
+            'max_cdr3': max_cdr3,
+            'no_result_cnt': no_result_cnt,
+        })
+
+
+def delete_stats(session, sample_ids):
+    """Deletes the statistics, including any stored distribution bins, for a
+    set of samples.
+
+    :param Session session: The database session
+    :param list sample_ids: The IDs of the samples
+
+    """
+    for model in (SampleStats, SampleStatBin):
+        session.query(model).filter(
+            model.sample_id.in_(sample_ids)
+        ).delete(synchronize_session=False)
+    session.commit()
 
 
 def run_sample_stats(session, args):
@@ -361,20 +674,29 @@ def run_sample_stats(session, args):
     else:
         samples = args.sample_ids
 
+    dirty_samples = dirty.get_dirty(session, 'sample_stats', samples)
     if args.force:
-        q = session.query(SampleStats).filter(
-            SampleStats.sample_id.in_(samples))
-        q.delete(synchronize_session=False)
-        session.commit()
+        delete_stats(session, samples)
+    elif len(dirty_samples) > 0:
+        logger.info('Deleting old stats for {} changed samples'.format(
+            len(dirty_samples)))
+        delete_stats(session, list(dirty_samples))
 
     tasks = concurrent.TaskQueue()
     for sample_id in samples:
         _queue_tasks(session, sample_id, args.force, tasks)
 
     for i in range(0, args.nproc):
-        session = config.init_db(args.db_config)
-        tasks.add_worker(SampleStatsWorker(session))
+        tasks.add_worker(SampleStatsWorker(
+            config.init_db(args.db_config),
+            sql_aggregation=args.sql_aggregation,
+            store_bins=args.store_bins))
 
     tasks.start()
-    session.commit()
+    dirty.clear(session, 'sample_stats', dirty_samples, [
+        s.sample_id for s in dirty.query_in(
+            session.query(SampleStats.sample_id).distinct(),
+            SampleStats.sample_id, dirty_samples
+        )
+    ])
     session.close()
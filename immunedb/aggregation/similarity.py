@@ -0,0 +1,246 @@
+from collections import OrderedDict
+
+import numpy as np
+
+import immunedb.util.distance as distance
+
+
+class PigeonholeIndex(object):
+    """Indexes one representative CDR3 per clone so candidate clones for a
+    query can be found without comparing against every clone.
+
+    The CDR3 is split into ``max_dist + 1`` segments.  If two CDR3s are within
+    ``max_dist`` of one another, at least one segment must have no mismatches,
+    meaning it is either identical or contains a wildcard in one of the two
+    sequences.  A query with a wildcard in a segment could match any indexed
+    CDR3 in that segment, so every indexed CDR3 is a candidate for it.
+
+    :param int length: The length of the indexed CDR3s
+    :param int max_dist: The maximum distance a query may be from a match
+
+    """
+    def __init__(self, length, max_dist):
+        if max_dist < 0 or max_dist + 1 > length:
+            self._segments = []
+        else:
+            self._segments = [
+                (s[0], s[-1] + 1)
+                for s in np.array_split(np.arange(length), max_dist + 1)
+            ]
+        self._exact = [{} for _ in self._segments]
+        self._wild = [[] for _ in self._segments]
+        self._size = 0
+
+    def add(self, seq):
+        """Adds an encoded CDR3 to the index, assigning it the next key."""
+        key = self._size
+        for i, (start, end) in enumerate(self._segments):
+            segment = seq[start:end]
+            if (segment == distance.WILDCARD).any():
+                self._wild[i].append(key)
+            else:
+                self._exact[i].setdefault(segment.tobytes(), []).append(key)
+        self._size += 1
+
+    def candidates(self, seq):
+        """Gets the sorted keys of all indexed CDR3s which may be within the
+        maximum distance of ``seq``."""
+        if len(self._segments) == 0:
+            return np.arange(self._size)
+        keys = set()
+        for i, (start, end) in enumerate(self._segments):
+            segment = seq[start:end]
+            if (segment == distance.WILDCARD).any():
+                return np.arange(self._size)
+            keys.update(self._exact[i].get(segment.tobytes(), []))
+            keys.update(self._wild[i])
+        return np.array(sorted(keys), dtype=np.int64)
+
+
+class GreedySimilarityClusterer(object):
+    """Assigns CDR3s to clones in a greedy fashion: each CDR3 is placed in the
+    first clone (in order of creation) for which it is similar to every
+    member.
+
+    All CDR3s in a bucket are encoded once and distances are computed against
+    many members at a time.  Candidate clones are first pruned with a
+    :py:class:`PigeonholeIndex` over each clone's first member.
+
+    :param list cdr3s: The CDR3s of every sequence in the bucket
+    :param int norm_len: The length by which distances are normalized
+    :param float min_similarity: Minimum fraction to be considered similar
+    :param str wildcards: Characters which match any other character
+
+    """
+    def __init__(self, cdr3s, norm_len, min_similarity,
+                 wildcards=distance.WILDCARDS):
+        self._seqs = distance.encode(cdr3s, wildcards=wildcards)
+        self._max_dist = distance.max_distance(norm_len, min_similarity)
+        self._index = PigeonholeIndex(self._seqs.shape[1], self._max_dist)
+        self._anchors = []
+        self._labels = np.full(len(cdr3s), -1, dtype=np.int64)
+
+    @property
+    def num_clones(self):
+        return len(self._anchors)
+
+    def add_clone(self, rows):
+        """Creates a new clone from the given row indexes.
+
+        :param list rows: The indexes of the CDR3s in the clone
+
+        :returns: The index of the new clone
+        :rtype: int
+
+        """
+        clone = len(self._anchors)
+        self._anchors.append(rows[0])
+        self._index.add(self._seqs[rows[0]])
+        self._labels[rows] = clone
+        return clone
+
+    def assign(self, row):
+        """Adds the CDR3 at index ``row`` to the first clone to which it is
+        similar.
+
+        :param int row: The index of the CDR3 to assign
+
+        :returns: The index of the clone or ``None`` if no clone is similar
+        :rtype: int
+
+        """
+        seq = self._seqs[row]
+        candidates = self._index.candidates(seq)
+        if len(candidates) == 0:
+            return None
+
+        anchors = self._seqs[np.array(self._anchors)[candidates]]
+        candidates = candidates[
+            distance.hamming_to_many(seq, anchors) <= self._max_dist
+        ]
+        if len(candidates) == 0:
+            return None
+
+        # The extra trailing element is indexed by unassigned rows (label -1)
+        is_candidate = np.zeros(self.num_clones + 1, dtype=bool)
+        is_candidate[candidates] = True
+        members = np.nonzero(is_candidate[self._labels])[0]
+        failures = np.bincount(
+            self._labels[members],
+            weights=distance.hamming_to_many(
+                seq, self._seqs[members]) > self._max_dist,
+            minlength=self.num_clones
+        )
+        for clone in candidates:
+            if failures[clone] == 0:
+                self._labels[row] = clone
+                return clone
+        return None
+
+
+class DisjointSet(object):
+    """A union-find structure over the integers ``0`` to ``size - 1`` with
+    path compression and union by size.
+
+    :param int size: The number of elements
+
+    """
+    def __init__(self, size):
+        self._parents = list(range(size))
+        self._sizes = [1] * size
+
+    def find(self, i):
+        """Gets the representative element of the set containing ``i``."""
+        root = i
+        while self._parents[root] != root:
+            root = self._parents[root]
+        while self._parents[i] != root:
+            self._parents[i], i = root, self._parents[i]
+        return root
+
+    def union(self, i, j):
+        """Merges the sets containing ``i`` and ``j``.
+
+        :returns: The representative element of the merged set
+        :rtype: int
+
+        """
+        i, j = self.find(i), self.find(j)
+        if i == j:
+            return i
+        if self._sizes[i] < self._sizes[j]:
+            i, j = j, i
+        self._parents[j] = i
+        self._sizes[i] += self._sizes[j]
+        return i
+
+    def labels(self):
+        """Labels each element with the index of its set, where sets are
+        numbered in order of their first element.
+
+        :returns: The label of each element
+        :rtype: numpy.ndarray
+
+        """
+        roots = {}
+        return np.array([
+            roots.setdefault(self.find(i), len(roots))
+            for i in range(len(self._parents))
+        ], dtype=np.int64)
+
+
+class SingleLinkageClusterer(object):
+    """Clusters CDR3s with single-linkage: two CDR3s are in the same clone if
+    there is a chain of CDR3s between them where each consecutive pair is
+    similar.
+
+    Identical CDR3s are clustered once.  Candidate pairs are blocked with a
+    :py:class:`PigeonholeIndex` whose segments act as positional k-mers, so
+    only CDR3s sharing a segment are compared.
+
+    :param list cdr3s: The CDR3s of every sequence in the bucket
+    :param int norm_len: The length by which distances are normalized
+    :param float min_similarity: Minimum fraction to be considered similar
+    :param str wildcards: Characters which match any other character
+
+    """
+    def __init__(self, cdr3s, norm_len, min_similarity,
+                 wildcards=distance.WILDCARDS):
+        self._wildcards = wildcards
+        self._unique = list(OrderedDict.fromkeys(cdr3s))
+        positions = {cdr3: i for i, cdr3 in enumerate(self._unique)}
+        self._rows = np.array([positions[c] for c in cdr3s], dtype=np.int64)
+        self._max_dist = distance.max_distance(norm_len, min_similarity)
+        self._sets = DisjointSet(len(self._unique))
+
+    def link(self, rows):
+        """Forces the CDR3s at the given row indexes into the same clone.
+
+        :param list rows: The indexes of the CDR3s to link
+
+        """
+        for row in rows[1:]:
+            self._sets.union(self._rows[rows[0]], self._rows[row])
+
+    def cluster(self):
+        """Links every pair of similar CDR3s.
+
+        :returns: The clone label of each CDR3, numbered in order of first
+            appearance
+        :rtype: numpy.ndarray
+
+        """
+        seqs = distance.encode(self._unique, wildcards=self._wildcards)
+        index = PigeonholeIndex(seqs.shape[1], self._max_dist)
+        for i, seq in enumerate(seqs):
+            candidates = index.candidates(seq)
+            index.add(seq)
+            if len(candidates) == 0:
+                continue
+            close = candidates[
+                distance.hamming_to_many(seq, seqs[candidates]) <=
+                self._max_dist
+            ]
+            for other in close:
+                self._sets.union(i, other)
+        return self._sets.labels()[self._rows]
@@ -4,14 +4,18 @@ import math
 import re
 
 from sqlalchemy import and_, desc, distinct
+from sqlalchemy.orm import defer
 from sqlalchemy.orm.strategy_options import Load
 from sqlalchemy.sql import func
 from sqlalchemy.sql.expression import false, true
 
-from immunedb.common.models import (Clone, CloneStats, Sample, SampleStats,
+from immunedb.common.models import (Clone, CloneStats,
+                                    deserialize_clone_mutations, Sample,
+                                    SampleStatBin, SampleStats,
                                     SelectionPressure, Sequence,
                                     SequenceCollapse, Subject)
 from immunedb.common.mutations import threshold_mutations
+from immunedb.trees import deserialize_tree, expand_tree, get_tree_nodes
 
 
 _clone_filters = {
@@ -237,7 +241,7 @@ def get_clone_mutations(session, clone_id, threshold_type, threshold_val,
         CloneStats.clone_id == clone_id,
         CloneStats.sample_id == sample_id
     ).first()
-    all_mutations = json.loads(clone_stats.mutations)
+    all_mutations = deserialize_clone_mutations(clone_stats.mutations)
     total_seqs = clone_stats.unique_cnt
 
     result = {
@@ -280,7 +284,7 @@ def get_clone_sequences(session, clone_id, get_collapse, paging):
             'read_start': start_ptrn.match(seq.sequence).span()[1] or 0,
             'copy_number_in_subject': int(copy_number_in_subject),
             'instances_in_subject': int(instances_in_subject),
-            'mutations': json.loads(seq.mutations_from_clone),
+            'mutations': seq.clone_mutations,
             'v_extent': seq.get_v_extent(in_clone=True),
             'j_length': seq.j_length,
             'collapse_to': []
@@ -339,9 +343,18 @@ def get_selection_pressure(session, clone_id):
     return pressure.values()
 
 
-def get_clone_tree(session, clone_id):
+def get_clone_tree(session, clone_id, skeleton=False):
     tree = session.query(Clone.tree).filter(Clone.id == clone_id).first().tree
-    return json.loads(tree) if tree is not None else None
+    if not skeleton:
+        return deserialize_tree(tree)
+    tree = deserialize_tree(tree, expand=False)
+    return expand_tree(tree, details=False) if tree is not None else None
+
+
+def get_clone_tree_nodes(session, clone_id, node_ids):
+    tree = deserialize_tree(session.query(Clone.tree).filter(
+        Clone.id == clone_id).first().tree, expand=False)
+    return get_tree_nodes(tree, node_ids) if tree is not None else None
 
 
 def get_clone_overlap(session, sample_ids, filter_type, order_by='total_cnt',
@@ -437,6 +450,57 @@ def get_grouping(sample, grouping):
         return sample.metadata_dict.get(grouping, None)
 
 
+def _has_stat_bins(session, samples, filter_type, include_outliers,
+                   include_partials):
+    """Determines if every sample with statistics for a filter also has its
+    distribution bins stored in :py:class:`SampleStatBin`."""
+    with_stats = session.query(
+        func.count(distinct(SampleStats.sample_id))
+    ).filter(
+        SampleStats.sample_id.in_(samples),
+        SampleStats.filter_type == filter_type,
+        SampleStats.outliers == include_outliers,
+        SampleStats.full_reads != include_partials
+    ).scalar()
+    with_bins = session.query(
+        func.count(distinct(SampleStatBin.sample_id))
+    ).filter(
+        SampleStatBin.sample_id.in_(samples),
+        SampleStatBin.filter_type == filter_type,
+        SampleStatBin.outliers == include_outliers,
+        SampleStatBin.full_reads != include_partials
+    ).scalar()
+    return with_stats > 0 and with_bins == with_stats
+
+
+def _sum_stat_bins(session, samples, filter_type, include_outliers,
+                   include_partials, fields):
+    """Sums the stored distribution bins of a set of samples.
+
+    :returns: The summed value of each key keyed by field
+    :rtype: dict
+
+    """
+    dists = {field: {} for field in fields}
+    query = session.query(
+        SampleStatBin.field,
+        SampleStatBin.key,
+        func.sum(SampleStatBin.value).label('value')
+    ).filter(
+        SampleStatBin.sample_id.in_(samples),
+        SampleStatBin.filter_type == filter_type,
+        SampleStatBin.outliers == include_outliers,
+        SampleStatBin.full_reads != include_partials,
+        SampleStatBin.field.in_(fields)
+    ).group_by(SampleStatBin.field, SampleStatBin.key)
+    for row in query:
+        value = row.value
+        if row.field != 'quality_dist':
+            value = int(value)
+        dists[row.field][json.loads(row.key)] = value
+    return dists
+
+
 def get_v_usage(session, samples, filter_type, include_outliers,
                 include_partials, grouping, by_family):
     """Gets the V-Gene usage percentages for samples"""
@@ -449,15 +513,33 @@ def get_v_usage(session, samples, filter_type, include_outliers,
     data = {}
     totals = {}
     prefix = ''
-    for s in session.query(SampleStats)\
-            .filter(SampleStats.filter_type == filter_type,
-                    SampleStats.outliers == include_outliers,
-                    SampleStats.full_reads != include_partials,
-                    SampleStats.sample_id.in_(samples)):
-        dist = json.loads(s.v_gene_dist)
-
+    use_bins = _has_stat_bins(session, samples, filter_type,
+                              include_outliers, include_partials)
+    query = session.query(SampleStats)\
+        .filter(SampleStats.filter_type == filter_type,
+                SampleStats.outliers == include_outliers,
+                SampleStats.full_reads != include_partials,
+                SampleStats.sample_id.in_(samples))
+    if use_bins:
+        query = query.options(defer(SampleStats.v_gene_dist))
+
+    dists = {}
+    for s in query:
         group_key = get_grouping(s.sample, grouping)
+        if use_bins:
+            dists.setdefault(group_key, []).append(s.sample_id)
+        else:
+            dists.setdefault(group_key, []).extend(
+                json.loads(s.v_gene_dist))
+    if use_bins:
+        dists = {
+            group_key: list(_sum_stat_bins(
+                session, group_samples, filter_type, include_outliers,
+                include_partials, ['v_gene_dist'])['v_gene_dist'].items())
+            for group_key, group_samples in dists.items()
+        }
 
+    for group_key, dist in dists.items():
         if group_key not in data:
             data[group_key] = {}
 
@@ -566,11 +648,22 @@ def analyze_samples(session, samples, filter_type, include_outliers,
     ]
 
     group_sizes = {}
+    group_samples = {}
+    # If the distribution bins are stored they are summed in the database
+    # rather than loading the JSON distributions
+    use_bins = _has_stat_bins(session, samples, filter_type,
+                              include_outliers, include_partials)
+    query = session.query(SampleStats).filter(
+        SampleStats.sample_id.in_(samples),
+        SampleStats.outliers == include_outliers,
+        SampleStats.full_reads != include_partials)
+    if use_bins:
+        query = query.options(*[
+            defer(getattr(SampleStats, f)) for f in dist_fields
+        ])
+
     # Iterate over all filter types in the samples
-    for stat in session.query(SampleStats).filter(
-            SampleStats.sample_id.in_(samples),
-            SampleStats.outliers == include_outliers,
-            SampleStats.full_reads != include_partials):
+    for stat in query:
         # Update the number of sequences in each filter
         if stat.filter_type not in counts:
             counts[stat.filter_type] = 0
@@ -617,6 +710,9 @@ def analyze_samples(session, samples, filter_type, include_outliers,
                 stats[group_key] = {}
                 group_sizes[group_key] = 0
             group_sizes[group_key] += 1
+            if use_bins:
+                group_samples.setdefault(group_key, []).append(stat.sample_id)
+                continue
 
             fields = _fields_to_dict(dist_fields, stat)
 
@@ -629,6 +725,11 @@ def analyze_samples(session, samples, filter_type, include_outliers,
                         stats[group_key][field][x] = 0
                     stats[group_key][field][x] += freq
 
+    for group_key, group_sample_ids in group_samples.items():
+        stats[group_key] = _sum_stat_bins(
+            session, group_sample_ids, filter_type, include_outliers,
+            include_partials, dist_fields)
+
     for group, key_dict in stats.items():
         for key, vals in key_dict.items():
             if key == 'quality_dist':
@@ -698,7 +799,7 @@ def get_sequence(session, sample_id, seq_id):
     ret['v_extent'] = seq.get_v_extent(in_clone=False)
     ret['mutations'] = {}
     if seq.mutations_from_clone:
-        ret['mutations'] = json.loads(seq.mutations_from_clone)
+        ret['mutations'] = seq.clone_mutations
 
     ret['clone'] = _clone_to_dict(seq.clone) if seq.clone is not None else None
     ret['collapse_info'] = trace_seq_collapses(session, seq)
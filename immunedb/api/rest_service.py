@@ -156,7 +156,20 @@ def create_app(db_config, allow_shutdown=False):
     @app.route('/clone/lineage/<clone_id>', method=['POST', 'OPTIONS'])
     @with_session
     def clone_lineage(session, clone_id):
-        return create_response(queries.get_clone_tree(session, clone_id))
+        fields = bottle.request.json or {}
+        return create_response(queries.get_clone_tree(
+            session, clone_id, fields.get('skeleton', False)))
+
+    @app.route('/clone/lineage/<clone_id>/nodes', method=['POST', 'OPTIONS'])
+    @with_session
+    def clone_lineage_nodes(session, clone_id):
+        fields = bottle.request.json or {}
+        try:
+            node_ids = [int(n) for n in fields.get('node_ids', [])]
+        except (TypeError, ValueError):
+            return create_response(code=400)
+        return create_response(queries.get_clone_tree_nodes(
+            session, clone_id, node_ids))
 
     @app.route('/clone/pressure/<clone_id>', method=['POST', 'OPTIONS'])
     @with_session
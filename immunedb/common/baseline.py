@@ -1,17 +1,23 @@
 import collections
 import csv
-from functools import partial
+import hashlib
+import json
 import math
 import os
-import json
 import shlex
 import subprocess
 
+from sqlalchemy.sql import text
+
 import immunedb.common.config as config
-from immunedb.common.models import (Clone, CloneStats, SelectionPressure,
+import immunedb.common.dirty as dirty
+import immunedb.common.focused_selection as focused_selection
+from immunedb.common.models import (Clone, CloneStats, mutation_positions,
+                                    SelectionPressure, SelectionPressureCache,
                                     Sequence, SequenceCollapse)
 import immunedb.common.modification_log as mod_log
 import immunedb.util.concurrent as concurrent
+import immunedb.util.funcs as funcs
 from immunedb.util.log import logger
 
 TEST_FOCUSED = 1
@@ -27,6 +33,22 @@ CONSTANT_BOUNDARIES = [1, 26, 38, 55, 65, 104]
 SEQ_CLONAL = 1
 FIX_INDELS = 1
 
+# Incremented when changes invalidate cached selection pressure results
+CACHE_VERSION = 3
+
+
+def get_boundaries(cdr3_num_nts):
+    """Gets the codon region boundaries given to BASELINe for a clone.
+
+    :param int cdr3_num_nts: The number of nucleotides in the clone's CDR3
+
+    :returns: The first codon of FWR1 followed by the last codon of each
+        region through the CDR3
+    :rtype: list
+
+    """
+    return CONSTANT_BOUNDARIES + [CONSTANT_BOUNDARIES[-1] + cdr3_num_nts // 3]
+
 
 def get_selection(session, clone_id, script_path, samples=None,
                   min_mut_count=1,
@@ -37,97 +59,212 @@ def get_selection(session, clone_id, script_path, samples=None,
                   sub_model=SUB_UNIFORM,
                   mut_model=MUT_UNIFORM):
     clone = session.query(Clone).filter(Clone.id == clone_id).first()
-    last_region = CONSTANT_BOUNDARIES[-1] + clone.cdr3_num_nts // 3
-    boundaries = '{}:{}'.format(':'.join(map(str, CONSTANT_BOUNDARIES)),
-                                last_region)
-    if samples is not None:
-        unique_id = '_{}_{}'.format(clone_id, '_'.join(map(str, samples)))
-    else:
-        unique_id = '_{}_{}'.format(clone_id, '_ALL')
+    seqs = _get_input_seqs(session, clone, samples, min_mut_count,
+                           max_mut_count)
+    return get_selections(
+        [(clone, seqs)], script_path, temp_dir=temp_dir,
+        test_type=test_type, species=species, sub_model=sub_model,
+        mut_model=mut_model)[0]
+
+
+def get_selections(inputs, script_path, temp_dir='/tmp',
+                   test_type=TEST_FOCUSED,
+                   species=SPECIES_HUMAN,
+                   sub_model=SUB_UNIFORM,
+                   mut_model=MUT_UNIFORM):
+    """Calculates selection pressure for many inputs with one invocation of
+    BASELINe.  Region boundaries are specified per invocation, so every clone
+    must have the same CDR3 length.  If BASELINe fails for a batch, each
+    input is retried on its own so one bad clone does not lose the others.
+
+    :param list inputs: Tuples of ``(clone, seqs)``, each of which is
+        analyzed as one clonal group
+    :param str script_path: The path to the BASELINe main script
+    :param str temp_dir: The directory for temporary input and output files
+
+    :returns: The BASELINe output for each input, in the same order, or
+        ``None`` for inputs without a result
+    :rtype: list
+
+    """
+    cdr3_lengths = set(clone.cdr3_num_nts for clone, _ in inputs)
+    if len(cdr3_lengths) != 1:
+        raise ValueError('All clones in a batch must have the same CDR3 '
+                         'length')
+    boundaries = ':'.join(map(str, get_boundaries(cdr3_lengths.pop())))
+    first_clone = inputs[0][0]
+    unique_id = '_{}_{}'.format(first_clone.id, os.getpid())
     input_path = os.path.join(temp_dir, 'clone{}.fasta'.format(unique_id))
     out_path = os.path.join(temp_dir, 'output{}'.format(unique_id))
-    read_path = os.path.join(temp_dir, 'output{}{}.txt'.format(unique_id,
-                             clone.id))
+    read_path = os.path.join(temp_dir, 'output{}{}.txt'.format(
+        unique_id, first_clone.id))
+    data_path = os.path.join(temp_dir, 'output{}{}.RData'.format(
+        unique_id, first_clone.id))
 
-    _make_input_file(session, input_path, clone, samples, min_mut_count,
-                     max_mut_count)
+    with open(input_path, 'w+') as fh:
+        for i, (clone, seqs) in enumerate(inputs):
+            _write_clone(fh, i, clone.consensus_germline, seqs)
     cmd = 'Rscript {} {} {} {} {} {} {} {} {} {} {}'.format(
         script_path, test_type, species,
         sub_model, mut_model, SEQ_CLONAL,
         FIX_INDELS, boundaries, input_path, out_path,
-        clone.id)
+        first_clone.id)
     proc = subprocess.Popen(shlex.split(cmd),
                             cwd=os.path.dirname(script_path),
                             stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE)
-    proc.communicate()
+    _, stderr = proc.communicate()
+
+    output = None
+    if proc.returncode != 0:
+        logger.warning('BASELINe exited with code {} for clones {}: {}'.format(
+            proc.returncode, ', '.join(str(c.id) for c, _ in inputs),
+            stderr.decode('utf-8', 'replace').strip()))
+    elif not os.path.exists(read_path):
+        logger.warning('BASELINe produced no output for clones {}: {}'.format(
+            ', '.join(str(c.id) for c, _ in inputs),
+            stderr.decode('utf-8', 'replace').strip()))
+    else:
+        with open(read_path) as fh:
+            output = _parse_output(fh, len(inputs))
+
+    for path in (input_path, read_path, data_path):
+        if os.path.exists(path):
+            os.unlink(path)
+
+    if output is None:
+        if len(inputs) == 1:
+            return [None]
+        return [
+            get_selections([clone_input], script_path, temp_dir=temp_dir,
+                           test_type=test_type, species=species,
+                           sub_model=sub_model, mut_model=mut_model)[0]
+            for clone_input in inputs
+        ]
+    return output
 
-    with open(read_path) as fh:
-        output = _parse_output(session, clone, fh)
 
-    os.unlink(input_path)
-    os.unlink(read_path)
-    os.unlink(os.path.join(
-        temp_dir, 'output{}{}.RData'.format(unique_id, clone.id)))
+def get_script_identity(script_path):
+    """Gets an identifier for a BASELINe installation.  BASELINe is run from
+    its own directory and loads the R files beside its main script, so all
+    of them are hashed.
 
-    return output
+    :param str script_path: The path to the BASELINe main script
 
+    :returns: The absolute path of the script and the SHA-256 hex digest of
+        the R files in its directory
+    :rtype: dict
+
+    """
+    script_path = os.path.abspath(script_path)
+    script_dir = os.path.dirname(script_path)
+    digest = hashlib.sha256()
+    for fn in sorted(os.listdir(script_dir)):
+        path = os.path.join(script_dir, fn)
+        if path == script_path or fn.lower().endswith('.r'):
+            digest.update(fn.encode('utf-8'))
+            with open(path, 'rb') as fh:
+                digest.update(fh.read())
+    return {'path': script_path, 'sha256': digest.hexdigest()}
+
+
+def get_input_hash(parameters, germline, seqs, boundaries):
+    """Gets a hash identifying a selection pressure calculation.  The order
+    of the sequences does not affect the result so it is ignored.
+
+    Changes to how results are calculated which are not reflected in
+    ``parameters`` must increment ``CACHE_VERSION`` so stale results are not
+    reused.
+
+    :param dict parameters: The method and test parameters used to calculate
+        selection pressure, including the identity of the BASELINe script
+        from :py:func:`get_script_identity` if it is used
+    :param str germline: The germline of the clone
+    :param list seqs: The thresholded sequences
+    :param list boundaries: The region boundaries from
+        :py:func:`get_boundaries`
+
+    :returns: The SHA-256 hex digest of the input and test parameters
+    :rtype: str
+
+    """
+    return hashlib.sha256(json.dumps({
+        'version': CACHE_VERSION,
+        'parameters': parameters,
+        'boundaries': boundaries,
+        'germline': germline,
+        'seqs': sorted(seqs),
+    }, sort_keys=True).encode('ascii')).hexdigest()
+
+
+def _write_clone(fh, index, germline, seqs):
+    fh.write('>>>CLONE{}\n'.format(index))
+    fh.write('>>germline{}\n'.format(index))
+    fh.write('{}\n'.format(germline))
+    for i, seq in enumerate(seqs):
+        fh.write('>{}\n{}\n'.format(i, seq))
+
+
+def _get_input_seqs(session, clone, samples, min_mut_count, max_mut_count):
+    seqs = session.query(
+        Sequence.sequence,
+        Sequence.mutations_from_clone
+    ).join(SequenceCollapse).filter(
+        Sequence.clone == clone
+    )
+    if samples is None:
+        seqs = seqs.filter(SequenceCollapse.copy_number_in_subject > 0)
+    else:
+        seqs = seqs.filter(Sequence.sample_id.in_(samples),
+                           Sequence.copy_number > 0)
+
+    if min_mut_count > 1 or max_mut_count is not None:
+        removes = collections.Counter()
+        seqs = seqs.all()
+        # Iterate over each sequence and increment the count for each
+        # mutation in the counter
+        for seq in seqs:
+            removes.update({
+                (i, seq.sequence[i]): 1 for i in
+                mutation_positions(seq.mutations_from_clone)
+            })
+
+        # Filter out the mutations
+        removes = [
+            mut for mut, cnt in removes.items()
+            if cnt < min_mut_count or cnt > (max_mut_count or -1)
+        ]
+
+        # Remove the remaining mutations
+        updated_seqs = []
+        for seq in seqs:
+            ns = list(seq.sequence)
+            for pos, to_nt in removes:
+                if ns[pos] == to_nt:
+                    ns[pos] = clone.consensus_germline[pos]
+            updated_seqs.append(''.join(ns))
+        return updated_seqs
+    return [s.sequence for s in seqs]
 
-def _make_input_file(session, input_path, clone, samples, min_mut_count,
-                     max_mut_count):
-    with open(input_path, 'w+') as fh:
-        fh.write('>>>CLONE\n')
-        fh.write('>>germline\n')
-        fh.write('{}\n'.format(clone.consensus_germline))
-
-        seqs = session.query(
-            Sequence.sequence,
-            Sequence.mutations_from_clone
-        ).join(SequenceCollapse).filter(
-            Sequence.clone == clone
-        )
-        if samples is None:
-            seqs = seqs.filter(SequenceCollapse.copy_number_in_subject > 0)
-        else:
-            seqs = seqs.filter(Sequence.sample_id.in_(samples),
-                               Sequence.copy_number > 0)
-
-        if min_mut_count > 1 or max_mut_count is not None:
-            removes = collections.Counter()
-            seqs = seqs.all()
-            # Iterate over each sequence and increment the count for each
-            # mutation in the counter
-            for seq in seqs:
-                removes.update({
-                    (i, seq.sequence[i]): 1 for i in
-                    map(int, json.loads(seq.mutations_from_clone).keys())
-                })
-
-            # Filter out the mutations
-            removes = [
-                mut for mut, cnt in removes.items()
-                if cnt < min_mut_count or cnt > (max_mut_count or -1)
-            ]
 
-            # Remove the remaining mutations
-            updated_seqs = []
-            for seq in seqs:
-                ns = list(seq.sequence)
-                for pos, to_nt in removes:
-                    if ns[pos] == to_nt:
-                        ns[pos] = clone.consensus_germline[pos]
-                updated_seqs.append(''.join(ns))
-        else:
-            updated_seqs = [s.sequence for s in seqs]
+def _parse_output(fh, num_inputs):
+    """Parses BASELINe output into the result for each clonal group.  Rows
+    are matched to groups only by the germline ID written by
+    :py:func:`_write_clone`; rows without a recognized ID are ignored.
 
-        for i, seq in enumerate(updated_seqs):
-            fh.write('>{}\n{}\n'.format(i, seq))
+    :param file fh: The output file
+    :param int num_inputs: The number of clonal groups in the input
 
+    :returns: The result for each group, or ``None`` where there was no
+        result
+    :rtype: list
 
-def _parse_output(session, clone, fh):
+    """
+    outputs = [None] * num_inputs
     reader = csv.DictReader(fh, delimiter='\t')
     for row in reader:
         if row['Type'] == 'Sequence':
+            row_id = row['ID'].strip()
             del row['Type']
             del row['ID']
             row = {k: v.strip() for k, v in row.items()}
@@ -135,7 +272,14 @@ def _parse_output(session, clone, fh):
                 k: v.strip() if v == 'NA' else float(v.strip()) for k, v in
                 row.items()
             }
-            return row
+            if not (row_id.startswith('germline') and row_id[8:].isdigit()):
+                logger.debug('Ignoring BASELINe output row with unknown '
+                             'ID {}'.format(row_id))
+                continue
+            index = int(row_id[8:])
+            if index < num_inputs:
+                outputs[index] = row
+    return outputs
 
 
 def na_to_null(v):
@@ -144,65 +288,169 @@ def na_to_null(v):
 
 class SelectionPressureWorker(concurrent.Worker):
     """A worker class for calculating selection pressure.  This worker will
-    accept one clone at a time for parallelization.
+    accept a batch of clones with the same CDR3 length at a time for
+    parallelization, running BASELINe once for the batch.
 
     :param Session session: The database session
+    :param str baseline_path: The path to the BASELINe main script
+    :param str baseline_temp: The directory for temporary BASELINe files
+    :param list thresholds: The mutation thresholds to calculate
+    :param str method: ``baseline`` to run BASELINe or ``native`` to use
+        :py:mod:`immunedb.common.focused_selection` in-process
+    :param bool use_cache: If set, results are reused from and saved to
+        :py:class:`SelectionPressureCache`
 
     """
-    def __init__(self, session, baseline_path, baseline_temp, thresholds):
+    def __init__(self, session, baseline_path, baseline_temp, thresholds,
+                 method='baseline', use_cache=True):
         self._session = session
         self._baseline_path = baseline_path
         self._baseline_temp = baseline_temp
         self._thresholds = thresholds
-
-    def do_task(self, clone_id):
+        self._method = method
+        self._use_cache = use_cache
+
+        self._test_parameters = {
+            'test_type': TEST_FOCUSED,
+            'species': SPECIES_HUMAN,
+            'sub_model': SUB_UNIFORM,
+            'mut_model': MUT_UNIFORM,
+        }
+        # Everything which determines the results, used to key the cache
+        self._parameters = dict(self._test_parameters, method=method)
+        if method == 'baseline':
+            self._parameters.update({
+                'seq_clonal': SEQ_CLONAL,
+                'fix_indels': FIX_INDELS,
+                'script': get_script_identity(baseline_path),
+            })
+
+    def do_task(self, clone_ids):
         """Starts the task of calculation of clonal selection pressure.
 
-        :param int args: The clone_id
+        :param list clone_ids: The IDs of the clones
 
         """
+        existing = set(c.clone_id for c in self._session.query(
+            SelectionPressure.clone_id
+        ).filter(
+            SelectionPressure.clone_id.in_(clone_ids)
+        ).distinct())
+        clones = self._session.query(Clone).filter(
+            Clone.id.in_([c for c in clone_ids if c not in existing])
+        ).order_by(Clone.id).all()
+        if len(clones) == 0:
+            return
+        self.info('Clones {} through {}'.format(clones[0].id, clones[-1].id))
 
-        if self._session.query(SelectionPressure).filter(
-                SelectionPressure.clone_id == clone_id).count() > 0:
+        inputs = []
+        for clone in clones:
+            for stat in self._session.query(
+                    CloneStats.sample_id, CloneStats.unique_cnt
+                    ).filter(CloneStats.clone_id == clone.id):
+                inputs.extend(self._get_sample_inputs(
+                    clone, stat.sample_id, int(stat.unique_cnt)))
+        if len(inputs) == 0:
             return
-        self.info('Clone {}'.format(clone_id))
-        sample_ids = [c.sample_id for c in self._session.query(
-                CloneStats.sample_id
-            ).filter(
-                CloneStats.clone_id == clone_id
-            )
-        ]
 
-        for sample_id in sample_ids:
-            self._process_sample(clone_id, sample_id)
+        seqs = [
+            _get_input_seqs(self._session, clone, samples, min_seqs,
+                            max_seqs)
+            for clone, samples, _, min_seqs, max_seqs in inputs
+        ]
+        hashes = [
+            get_input_hash(self._parameters, clone.consensus_germline,
+                           input_seqs, get_boundaries(clone.cdr3_num_nts))
+            for (clone, _, _, _, _), input_seqs in zip(inputs, seqs)
+        ]
+        results = self._get_cached(hashes) if self._use_cache else {}
+
+        # Calculate each distinct input which was not cached
+        to_calculate = {}
+        for i, input_hash in enumerate(hashes):
+            if input_hash not in results:
+                to_calculate.setdefault(input_hash, i)
+        if len(to_calculate) > 0:
+            self.info('Calculating {} of {} inputs; {} cached'.format(
+                len(to_calculate), len(inputs), len(results)))
+            calculated = dict(zip(
+                to_calculate, self._calculate(
+                    [(inputs[i][0], seqs[i])
+                     for i in to_calculate.values()])))
+            if self._use_cache:
+                self._add_cached(calculated)
+            results.update(calculated)
+
+        pressures = [results[input_hash] for input_hash in hashes]
+        for (clone, samples, threshold, _, _), pressure in zip(inputs,
+                                                               pressures):
+            if pressure is None:
+                self.warning('No selection pressure result for clone {}, '
+                             'threshold {}'.format(clone.id, threshold))
+                continue
+            self._add_pressure(clone.id,
+                               samples[0] if samples is not None else None,
+                               threshold, pressure)
         self._session.commit()
 
-    def _process_sample(self, clone_id, sample_id):
-        """Processes selection pressure for one sample (or the aggregate of all
-        samples).  If ``sample_id`` is None the pressure for all sequences in
-        the clone is calculated.  If ``single`` is specified, the clone only
-        occurs in one sample and the entry with ``sample_id=None`` should be
-        the same as for the one sample.
+    def _calculate(self, inputs):
+        """Calculates selection pressure with the worker's method.
 
-        :param int clone_id: The ID of the clone
-        :param int sample_id: The ID of a sample in which the clone exists
+        :param list inputs: Tuples of ``(clone, seqs)``
+
+        :returns: The result for each input, keyed as in BASELINe's output
+        :rtype: list
 
         """
+        if self._method == 'native':
+            return [
+                focused_selection.get_selection(
+                    clone.consensus_germline, seqs,
+                    get_boundaries(clone.cdr3_num_nts))
+                for clone, seqs in inputs
+            ]
+        return get_selections(inputs, self._baseline_path,
+                              temp_dir=self._baseline_temp,
+                              **self._test_parameters)
+
+    def _get_cached(self, hashes):
+        return {
+            c.input_hash: json.loads(c.result)
+            for c in self._session.query(SelectionPressureCache).filter(
+                SelectionPressureCache.input_hash.in_(set(hashes)))
+        }
+
+    def _add_cached(self, results):
+        params = [{
+            'input_hash': input_hash,
+            'result': json.dumps(result)
+        } for input_hash, result in results.items() if result is not None]
+        if len(params) > 0:
+            # Another worker may have cached the same input concurrently
+            self._session.connection(
+                mapper=SelectionPressureCache
+            ).execute(text('''
+                INSERT IGNORE INTO selection_pressure_cache
+                    (input_hash, result)
+                VALUES (:input_hash, :result)
+            '''), params)
+
+    def _get_sample_inputs(self, clone, sample_id, total_seqs):
+        """Gets the BASELINe inputs for one sample (or the aggregate of all
+        samples).  If ``sample_id`` is None the pressure for all sequences in
+        the clone is calculated.
 
-        total_seqs = int(self._session.query(CloneStats.unique_cnt).filter(
-            CloneStats.clone_id == clone_id,
-            CloneStats.sample_id == sample_id
-        ).one().unique_cnt)
+        :param Clone clone: The clone
+        :param int sample_id: The ID of a sample in which the clone exists
+        :param int total_seqs: The number of unique sequences in the clone in
+            the sample
 
-        base_call = partial(
-            get_selection,
-            session=self._session,
-            clone_id=clone_id,
-            script_path=self._baseline_path,
-            samples=[sample_id] if sample_id is not None else None,
-            temp_dir=self._baseline_temp
-        )
+        :returns: A tuple of ``(clone, samples, threshold, min_mut_count,
+            max_mut_count)`` for each threshold
+        :rtype: list
 
+        """
+        inputs = []
         for threshold in self._thresholds:
             if threshold.endswith('E'):
                 min_seqs = max_seqs = int(threshold[:-1])
@@ -213,36 +461,40 @@ class SelectionPressureWorker(concurrent.Worker):
                     else threshold
                 )
                 max_seqs = None
-
-            pressure = base_call(min_mut_count=min_seqs,
-                                 max_mut_count=max_seqs)
-            pressure = {k: na_to_null(v) for k, v in pressure.items()}
-            self._session.add(SelectionPressure(
-                clone_id=clone_id,
-                sample_id=sample_id,
-                threshold=threshold,
-
-                expected_fwr_s=pressure['Expected_FWR_S'],
-                expected_cdr_s=pressure['Expected_CDR_S'],
-                expected_fwr_r=pressure['Expected_FWR_R'],
-                expected_cdr_r=pressure['Expected_CDR_R'],
-
-                observed_fwr_s=pressure['Observed_FWR_S'],
-                observed_cdr_s=pressure['Observed_CDR_S'],
-                observed_fwr_r=pressure['Observed_FWR_R'],
-                observed_cdr_r=pressure['Observed_CDR_R'],
-
-                sigma_fwr=pressure['Focused_Sigma_FWR'],
-                sigma_cdr=pressure['Focused_Sigma_CDR'],
-
-                sigma_fwr_cilower=pressure['Focused_CIlower_FWR'],
-                sigma_fwr_ciupper=pressure['Focused_CIupper_FWR'],
-                sigma_cdr_cilower=pressure['Focused_CIlower_CDR'],
-                sigma_cdr_ciupper=pressure['Focused_CIupper_CDR'],
-
-                sigma_p_fwr=pressure['Focused_P_FWR'],
-                sigma_p_cdr=pressure['Focused_P_CDR'],
+            inputs.append((
+                clone, [sample_id] if sample_id is not None else None,
+                threshold, min_seqs, max_seqs
             ))
+        return inputs
+
+    def _add_pressure(self, clone_id, sample_id, threshold, pressure):
+        pressure = {k: na_to_null(v) for k, v in pressure.items()}
+        self._session.add(SelectionPressure(
+            clone_id=clone_id,
+            sample_id=sample_id,
+            threshold=threshold,
+
+            expected_fwr_s=pressure['Expected_FWR_S'],
+            expected_cdr_s=pressure['Expected_CDR_S'],
+            expected_fwr_r=pressure['Expected_FWR_R'],
+            expected_cdr_r=pressure['Expected_CDR_R'],
+
+            observed_fwr_s=pressure['Observed_FWR_S'],
+            observed_cdr_s=pressure['Observed_CDR_S'],
+            observed_fwr_r=pressure['Observed_FWR_R'],
+            observed_cdr_r=pressure['Observed_CDR_R'],
+
+            sigma_fwr=pressure['Focused_Sigma_FWR'],
+            sigma_cdr=pressure['Focused_Sigma_CDR'],
+
+            sigma_fwr_cilower=pressure['Focused_CIlower_FWR'],
+            sigma_fwr_ciupper=pressure['Focused_CIupper_FWR'],
+            sigma_cdr_cilower=pressure['Focused_CIlower_CDR'],
+            sigma_cdr_ciupper=pressure['Focused_CIupper_CDR'],
+
+            sigma_p_fwr=pressure['Focused_P_FWR'],
+            sigma_p_cdr=pressure['Focused_P_CDR'],
+        ))
 
     def cleanup(self):
         self._session.commit()
@@ -266,19 +518,43 @@ def run_selection_pressure(session, args):
     logger.info('Creating task queue to calculate selection pressure for {} '
                 'clones.'.format(len(clones)))
 
+    dirty_clones = dirty.get_dirty(session, 'clone_pressure', clones)
     if args.regen:
         logger.info('Deleting old selection pressure')
         for clone in clones:
             session.query(SelectionPressure).filter(
                 SelectionPressure.clone_id == clone).delete()
         session.commit()
+    elif len(dirty_clones) > 0:
+        logger.info('Deleting old selection pressure for {} changed '
+                    'clones'.format(len(dirty_clones)))
+        for chunk in dirty.id_chunks(dirty_clones):
+            session.query(SelectionPressure).filter(
+                SelectionPressure.clone_id.in_(chunk)
+            ).delete(synchronize_session=False)
+        session.commit()
 
-    for cid in clones:
-        tasks.add_task(cid)
+    # BASELINe region boundaries depend on the CDR3 length, so clones are
+    # batched by it
+    by_cdr3_length = {}
+    for clone in dirty.query_in(
+            session.query(Clone.id, Clone.cdr3_num_nts).order_by(Clone.id),
+            Clone.id, clones):
+        by_cdr3_length.setdefault(clone.cdr3_num_nts, []).append(clone.id)
+    for cdr3_length, clone_ids in sorted(by_cdr3_length.items()):
+        for batch in funcs.chunks(clone_ids, args.batch_size):
+            tasks.add_task(batch)
 
     for i in range(0, args.nproc):
-        session = config.init_db(args.db_config)
-        tasks.add_worker(SelectionPressureWorker(session, args.baseline_path,
-                                                 args.temp, args.thresholds))
+        tasks.add_worker(SelectionPressureWorker(
+            config.init_db(args.db_config), args.baseline_path, args.temp,
+            args.thresholds, method=args.method,
+            use_cache=not args.no_cache))
 
     tasks.start()
+    dirty.clear(session, 'clone_pressure', dirty_clones, [
+        c.clone_id for c in dirty.query_in(
+            session.query(SelectionPressure.clone_id).distinct(),
+            SelectionPressure.clone_id, dirty_clones
+        )
+    ])
@@ -0,0 +1,142 @@
+from sqlalchemy.sql import text
+
+from immunedb.common.models import DirtyEntity, Sample
+import immunedb.util.funcs as funcs
+
+# The stages which recompute results for each type of entity
+CLONE_STAGES = ('clone_stats', 'clone_pressure', 'clone_tree')
+SAMPLE_STAGES = ('sample_stats',)
+# The number of entity IDs to include in each ``IN`` clause
+CHUNK_SIZE = 10000
+
+
+def id_chunks(entity_ids, chunk_size=CHUNK_SIZE):
+    """Splits entity IDs into sorted chunks so they can be used in ``IN``
+    clauses of a bounded size.
+
+    :param iterable entity_ids: The IDs of the entities
+    :param int chunk_size: The maximum number of IDs in each chunk
+
+    :returns: Lists of at most ``chunk_size`` IDs
+    :rtype: generator
+
+    """
+    return funcs.chunks(sorted(entity_ids), chunk_size)
+
+
+def query_in(query, column, entity_ids, chunk_size=CHUNK_SIZE):
+    """Runs a query for each chunk of entity IDs, filtering ``column`` to
+    the chunk.
+
+    :param Query query: The query to run
+    :param Column column: The column containing the entity IDs
+    :param iterable entity_ids: The IDs of the entities
+    :param int chunk_size: The maximum number of IDs in each query
+
+    :returns: The rows of every query
+    :rtype: generator
+
+    """
+    for chunk in id_chunks(entity_ids, chunk_size):
+        for row in query.filter(column.in_(chunk)):
+            yield row
+
+
+def _mark(session, stages, entity_ids, reason):
+    entity_ids = set(entity_ids)
+    if len(entity_ids) == 0:
+        return
+    session.connection(mapper=DirtyEntity).execute(text('''
+        INSERT INTO dirty_entities (stage, entity_id, reason, generation)
+        VALUES (:stage, :entity_id, :reason, 1)
+        ON DUPLICATE KEY UPDATE
+            reason=VALUES(reason), generation=generation + 1
+    '''), [{
+        'stage': stage,
+        'entity_id': entity_id,
+        'reason': reason
+    } for stage in stages for entity_id in entity_ids])
+
+
+def mark_clones(session, clone_ids, reason, stages=CLONE_STAGES):
+    """Marks clones as needing their results recomputed.
+
+    :param Session session: The database session
+    :param list clone_ids: The IDs of the clones
+    :param str reason: A short description of why the clones were marked
+    :param tuple stages: The stages which must recompute the clones
+
+    """
+    _mark(session, stages, clone_ids, reason)
+
+
+def mark_samples(session, sample_ids, reason, stages=SAMPLE_STAGES):
+    """Marks samples as needing their results recomputed.
+
+    :param Session session: The database session
+    :param list sample_ids: The IDs of the samples
+    :param str reason: A short description of why the samples were marked
+    :param tuple stages: The stages which must recompute the samples
+
+    """
+    _mark(session, stages, sample_ids, reason)
+
+
+def mark_subject_samples(session, subject_ids, reason):
+    """Marks all samples in subjects as needing their results recomputed.
+
+    :param Session session: The database session
+    :param list subject_ids: The IDs of the subjects
+    :param str reason: A short description of why the samples were marked
+
+    """
+    subject_ids = list(subject_ids)
+    if len(subject_ids) == 0:
+        return
+    mark_samples(session, [s.id for s in session.query(Sample.id).filter(
+        Sample.subject_id.in_(subject_ids))], reason)
+
+
+def get_dirty(session, stage, entity_ids=None):
+    """Gets the entities marked for a stage.
+
+    :param Session session: The database session
+    :param str stage: The stage
+    :param list entity_ids: If specified, only entities in this list are
+        returned
+
+    :returns: The generation of each marked entity keyed by its ID
+    :rtype: dict
+
+    """
+    query = session.query(
+        DirtyEntity.entity_id, DirtyEntity.generation
+    ).filter(DirtyEntity.stage == stage)
+    if entity_ids is not None:
+        query = query_in(query, DirtyEntity.entity_id, set(entity_ids))
+    return {d.entity_id: d.generation for d in query}
+
+
+def clear(session, stage, dirty, entity_ids):
+    """Clears marks for a stage once entities have been recomputed.  Marks
+    which were made again since ``dirty`` was fetched are kept.
+
+    :param Session session: The database session
+    :param str stage: The stage
+    :param dict dirty: The marks as returned by :py:func:`get_dirty`
+    :param list entity_ids: The IDs of the entities which were successfully
+        recomputed
+
+    """
+    params = [{
+        'stage': stage,
+        'entity_id': entity_id,
+        'generation': dirty[entity_id]
+    } for entity_id in entity_ids if entity_id in dirty]
+    if len(params) > 0:
+        session.connection(mapper=DirtyEntity).execute(text('''
+            DELETE FROM dirty_entities
+            WHERE stage=:stage AND entity_id=:entity_id
+                AND generation=:generation
+        '''), params)
+    session.commit()
@@ -0,0 +1,247 @@
+import itertools
+
+import numpy as np
+
+from immunedb.common.models import MUTATION_TYPES
+from immunedb.common.mutations import call_mutations
+import immunedb.util.lookups as lookups
+
+# The grid of selection strengths over which the posterior is evaluated
+SIGMAS = np.linspace(-20, 20, 4001)
+# BASELINe's fitted Beta prior parameter for each number of mutations from 1
+# to 60; larger numbers use the last value
+BAYESIAN_FITTED = (
+    0.407277142798302, 0.554007336744485, 0.63777155771234,
+    0.693989162719009, 0.735450014674917, 0.767972534429806,
+    0.794557287143399, 0.816906816601605, 0.83606796225341,
+    0.852729446430296, 0.867370424541641, 0.880339760590323,
+    0.891900995024999, 0.902259181289864, 0.911577919359,
+    0.919990301665853, 0.927606458124537, 0.934518806350661,
+    0.940805863754375, 0.946534836475137, 0.951763879264356,
+    0.956543854251393, 0.960919563006662, 0.964930871001201,
+    0.968613366483838, 0.97199831604512, 0.975112870930034,
+    0.977980985016652, 0.980623886947461, 0.983060382706303,
+    0.985307182001815, 0.987379180544648, 0.989289692578526,
+    0.991050689007002, 0.992673077856591, 0.994166873039519,
+    0.995541415064961, 0.996805491719282, 0.997967454981327,
+    0.999035311706599, 1.00001681564829, 1.00091957212838,
+    1.00174969093993, 1.00251359138451, 1.00321718047427,
+    1.00386550466612, 1.00446294419512, 1.00501331889616,
+    1.00552004245657, 1.00598611932735, 1.00641433282576,
+    1.00680727439051, 1.00716735433929, 1.00749682048208,
+    1.00779776751648, 1.00807215062062, 1.00832180051339,
+    1.00854844161436, 1.00875366856766, 1.00893898103548,
+)
+
+
+def _get_codon_classes():
+    """Gets the number of possible replacement and silent point mutations at
+    each position of each codon.  Mutations to stop codons are excluded."""
+    classes = {}
+    for codon in itertools.product('ACGT', repeat=3):
+        codon = ''.join(codon)
+        aa = lookups.aa_from_codon(codon)
+        positions = []
+        for i in range(3):
+            replacement = silent = 0
+            for base in 'ACGT':
+                if base == codon[i]:
+                    continue
+                mutant = lookups.aa_from_codon(
+                    codon[:i] + base + codon[i + 1:])
+                if mutant == '*':
+                    continue
+                elif mutant == aa:
+                    silent += 1
+                else:
+                    replacement += 1
+            positions.append((replacement, silent))
+        classes[codon] = tuple(positions)
+    return classes
+
+
+_CODON_CLASSES = _get_codon_classes()
+_BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+
+def get_codon_regions(boundaries, num_codons):
+    """Gets the region of each codon.
+
+    :param list boundaries: The first codon of FWR1 followed by the last codon
+        of FWR1, CDR1, FWR2, CDR2, FWR3, and CDR3, all 1-based, as given to
+        BASELINe
+    :param int num_codons: The number of codons in the germline
+
+    :returns: ``'FWR'``, ``'CDR'``, or ``None`` for each codon
+    :rtype: list
+
+    """
+    regions = [None] * num_codons
+    for i, (start, end) in enumerate(zip(boundaries, boundaries[1:])):
+        if i > 0:
+            start += 1
+        for codon in range(start - 1, min(end, num_codons)):
+            regions[codon] = 'FWR' if i % 2 == 0 else 'CDR'
+    return regions
+
+
+def get_expected(germline, seqs, regions):
+    """Gets the expected frequency of replacement and silent mutations in
+    each region, assuming every position is equally mutable and every
+    substitution equally likely.  Like BASELINe, positions which are an
+    ``N`` or gap in every sequence are excluded since no mutation could be
+    observed there.
+
+    :param str germline: The germline sequence
+    :param list seqs: The sequences, gapped to match the germline
+    :param list regions: The region of each codon as returned by
+        :py:func:`get_codon_regions`
+
+    :returns: The frequencies keyed by ``(region, 'R' or 'S')``, which sum to
+        one, or ``None`` if no mutations are possible
+    :rtype: dict
+
+    """
+    covered = np.zeros(len(germline), dtype=bool)
+    for seq in seqs:
+        bases = np.frombuffer(seq[:len(germline)].upper().encode('ascii'),
+                              dtype=np.uint8)
+        covered[:len(bases)] |= np.isin(bases, _BASES)
+
+    counts = {(r, t): 0 for r in ('CDR', 'FWR') for t in ('R', 'S')}
+    for i, region in enumerate(regions):
+        codon = germline[i * 3:i * 3 + 3].upper()
+        if (region is None or codon not in _CODON_CLASSES or
+                lookups.aa_from_codon(codon) == '*'):
+            continue
+        for j, (replacement, silent) in enumerate(_CODON_CLASSES[codon]):
+            if covered[i * 3 + j]:
+                counts[(region, 'R')] += replacement
+                counts[(region, 'S')] += silent
+
+    total = sum(counts.values())
+    if total == 0:
+        return None
+    return {k: v / total for k, v in counts.items()}
+
+
+def get_observed(germline, seqs, regions):
+    """Gets the number of replacement and silent mutations in each region.
+    Like BASELINe's clonal mode, mutations shared by multiple sequences are
+    counted once.
+
+    :param str germline: The germline sequence
+    :param list seqs: The sequences, gapped to match the germline
+    :param list regions: The region of each codon as returned by
+        :py:func:`get_codon_regions`
+
+    :returns: The counts keyed by ``(region, 'R' or 'S')``
+    :rtype: dict
+
+    """
+    counts = {(r, t): 0 for r in ('CDR', 'FWR') for t in ('R', 'S')}
+    if len(seqs) == 0:
+        return counts
+    calls = call_mutations(germline, seqs)
+    _, unique = np.unique(calls['pos'] * 256 + calls['to_nts'],
+                          return_index=True)
+
+    stop = ord('*')
+    for pos, mtype, from_aa, intermediate_aa in zip(
+            calls['pos'][unique], calls['types'][unique],
+            calls['from_aas'][unique], calls['intermediate_aas'][unique]):
+        region = regions[pos // 3] if pos // 3 < len(regions) else None
+        if (region is None or MUTATION_TYPES[mtype] == 'unknown' or
+                stop in (from_aa, intermediate_aa)):
+            continue
+        counts[(region,
+                'S' if MUTATION_TYPES[mtype] == 'synonymous' else 'R')] += 1
+    return counts
+
+
+def focused_test(replacements, silents, expected_r, expected_s):
+    """Calculates the posterior distribution of the selection strength with
+    the focused test.  Replacement mutations in one region are tested against
+    silent mutations in all regions so selection in the other region does
+    not affect the result.
+
+    :param int replacements: The number of replacement mutations in the
+        region
+    :param int silents: The number of silent mutations in all regions
+    :param float expected_r: The expected frequency of replacement
+        mutations in the region
+    :param float expected_s: The expected frequency of silent mutations in
+        all regions
+
+    :returns: A tuple of the mean selection strength, the lower and upper
+        bounds of its 95% credible interval, and the probability that the
+        selection strength has the opposite sign, or ``None`` for each if
+        there are no mutations.  As in BASELINe, the probability is negated
+        when the selection strength is negative.
+    :rtype: tuple
+
+    """
+    total = replacements + silents
+    if total == 0 or expected_r <= 0 or expected_s <= 0:
+        return None, None, None, None
+
+    # The probability of a replacement under each selection strength, as log
+    # probabilities for stability
+    log_odds = np.log(expected_r / expected_s) + SIGMAS
+    log_theta = -np.logaddexp(0, -log_odds)
+    log_not_theta = -np.logaddexp(0, log_odds)
+    # BASELINe's Beta prior on the probability, transformed to the selection
+    # strength
+    prior = BAYESIAN_FITTED[min(int(total), len(BAYESIAN_FITTED)) - 1]
+    log_density = ((replacements + prior) * log_theta +
+                   (silents + prior) * log_not_theta)
+    density = np.exp(log_density - log_density.max())
+    density /= density.sum()
+
+    sigma = float(np.dot(SIGMAS, density))
+    cdf = np.cumsum(density)
+    lower, upper = np.interp([.025, .975], cdf, SIGMAS)
+    below_zero = float(np.interp(0, SIGMAS, cdf))
+    p = below_zero if sigma > 0 else 1 - below_zero
+    if sigma < 0:
+        p = -p
+    return sigma, float(lower), float(upper), p
+
+
+def get_selection(germline, seqs, boundaries):
+    """Calculates selection pressure with BASELINe's focused test using
+    uniform mutability and substitution models.  The result is keyed like
+    BASELINe's output so the two can be used interchangeably.
+
+    :param str germline: The germline sequence
+    :param list seqs: The sequences, gapped to match the germline
+    :param list boundaries: The region boundaries, as described in
+        :py:func:`get_codon_regions`
+
+    :returns: The observed and expected mutations and the selection strength
+        in each region
+    :rtype: dict
+
+    """
+    regions = get_codon_regions(boundaries, len(germline) // 3)
+    observed = get_observed(germline, seqs, regions)
+    expected = get_expected(germline, seqs, regions)
+
+    result = {}
+    for (region, mtype), count in observed.items():
+        result['Observed_{}_{}'.format(region, mtype)] = count
+        result['Expected_{}_{}'.format(region, mtype)] = (
+            expected[(region, mtype)] if expected else None)
+
+    silents = observed[('CDR', 'S')] + observed[('FWR', 'S')]
+    for region in ('CDR', 'FWR'):
+        if expected is None:
+            stats = (None, None, None, None)
+        else:
+            stats = focused_test(
+                observed[(region, 'R')], silents,
+                expected[(region, 'R')],
+                expected[('CDR', 'S')] + expected[('FWR', 'S')])
+        for name, value in zip(('Sigma', 'CIlower', 'CIupper', 'P'), stats):
+            result['Focused_{}_{}'.format(name, region)] = value
+    return result
@@ -1,5 +1,10 @@
+import base64
 import datetime
 import json
+import re
+import zlib
+
+import numpy as np
 
 from sqlalchemy import (Column, Boolean, Float, Integer, String, DateTime,
                         ForeignKey, UniqueConstraint, Index, event)
@@ -20,6 +25,16 @@ MAX_GENE_LEN = 64
 MAX_INDEL_LEN = 64
 CDR3_OFFSET = 309
 
+# The types of mutations in the order they are numbered in compact encodings
+MUTATION_TYPES = (None, 'unknown', 'synonymous', 'conservative',
+                  'nonconservative')
+# Prefix of mutations stored in the compact encoding rather than JSON
+COMPACT_PREFIX = '#'
+_TYPE_BITS = 3
+# Positions at or beyond this do not fit in the compact encoding
+_MAX_COMPACT_POSITION = 1 << (16 - _TYPE_BITS)
+_JSON_POSITION = re.compile(r'"(\d+)"\s*:')
+
 
 def deserialize_gaps(gaps):
     if gaps is None:
@@ -38,6 +53,126 @@ def serialize_gaps(gaps):
     )
 
 
+def serialize_mutations(mutations, compact=False):
+    """Serializes the mutations of a sequence from its clone.  The compact
+    encoding packs each mutation's position and type into a 16-bit integer.
+
+    :param dict mutations: The type of mutation at each position
+    :param bool compact: If set, uses the compact encoding instead of JSON.
+        JSON is still used if any position is too large to be packed.
+
+    :returns: The serialized mutations
+    :rtype: str
+
+    """
+    if not compact or any(int(pos) >= _MAX_COMPACT_POSITION
+                          for pos in mutations):
+        return json.dumps(mutations)
+    packed = np.array([
+        (int(pos) << _TYPE_BITS) | MUTATION_TYPES.index(mtype)
+        for pos, mtype in mutations.items()
+    ], dtype='<u2')
+    return COMPACT_PREFIX + base64.b64encode(packed.tobytes()).decode('ascii')
+
+
+def _unpack_mutations(value):
+    return np.frombuffer(base64.b64decode(value[len(COMPACT_PREFIX):]),
+                         dtype='<u2')
+
+
+def deserialize_mutations(value):
+    """Deserializes the mutations of a sequence from its clone in either
+    encoding.
+
+    :param str value: The serialized mutations
+
+    :returns: The type of mutation at each position
+    :rtype: dict
+
+    """
+    if value is None:
+        return None
+    if not value.startswith(COMPACT_PREFIX):
+        return {int(pos): mtype for pos, mtype in json.loads(value).items()}
+    return {
+        int(m >> _TYPE_BITS): MUTATION_TYPES[m & ((1 << _TYPE_BITS) - 1)]
+        for m in _unpack_mutations(value)
+    }
+
+
+def mutation_positions(value):
+    """Gets only the positions of the mutations of a sequence from its clone
+    without fully deserializing them.
+
+    :param str value: The serialized mutations
+
+    :returns: The mutated positions
+    :rtype: list
+
+    """
+    if value is None:
+        return None
+    if not value.startswith(COMPACT_PREFIX):
+        return [int(pos) for pos in _JSON_POSITION.findall(value)]
+    return (_unpack_mutations(value) >> _TYPE_BITS).tolist()
+
+
+def serialize_clone_mutations(mutations, compact=False):
+    """Serializes the aggregate mutations of a clone.  The compact encoding is
+    compressed JSON.
+
+    :param dict mutations: The mutations as generated by
+        :py:class:`immunedb.common.mutations.ContextualMutations`
+    :param bool compact: If set, uses the compact encoding instead of JSON
+
+    :returns: The serialized mutations
+    :rtype: str
+
+    """
+    value = json.dumps(mutations)
+    if not compact:
+        return value
+    return COMPACT_PREFIX + base64.b64encode(
+        zlib.compress(value.encode('utf-8'))).decode('ascii')
+
+
+def deserialize_clone_mutations(value):
+    """Deserializes the aggregate mutations of a clone in either encoding.
+
+    :param str value: The serialized mutations
+
+    :returns: The mutations
+    :rtype: dict
+
+    """
+    if value is None:
+        return None
+    if value.startswith(COMPACT_PREFIX):
+        value = zlib.decompress(
+            base64.b64decode(value[len(COMPACT_PREFIX):])).decode('utf-8')
+    return json.loads(value)
+
+
+def get_clone_sequence(sequence, insertions, clone_insertions):
+    """Gets a sequence within the context of its clone by adding gaps for
+    insertions other sequences in the clone have.
+
+    :param str sequence: The sequence
+    :param list insertions: The sequence's insertions
+    :param list clone_insertions: The clone's insertions
+
+    :returns: The gapped sequence
+    :rtype: str
+
+    """
+    for ins in sorted(clone_insertions):
+        if ins in insertions:
+            continue
+        pos, size = ins
+        sequence = sequence[:pos] + ('-' * size) + sequence[pos:]
+    return sequence
+
+
 class Study(Base):
     """A study which aggregates related samples.
 
@@ -215,6 +350,48 @@ class SampleStats(Base):
     no_result_cnt = Column(Integer)
 
 
+class SampleStatBin(Base):
+    """A single bin of one distribution in :py:class:`SampleStats`.  These
+    are optionally stored alongside the JSON distributions so distributions
+    can be aggregated across samples in the database.
+
+    :param int id: The ID of the bin
+    :param int sample_id: The ID of the sample for which the statistics were \
+        generated
+    :param Relationship sample: Reference to the associated \
+        :py:class:`Sample` instance
+
+    :param str filter_type: The type of filter for the statistics
+        (e.g. functional)
+    :param bool outliers: If outliers were included in the statistics
+    :param bool full_reads: If only full reads were included in the statistics
+
+    :param str field: The name of the distribution column in \
+        :py:class:`SampleStats` (e.g. v_gene_dist)
+    :param str key: The JSON encoded key of the bin
+    :param float value: The value of the bin
+
+    """
+    __tablename__ = 'sample_stat_bins'
+    __table_args__ = (
+        Index('bin_cover', 'filter_type', 'outliers', 'full_reads', 'field',
+              'sample_id', 'key', 'value'),
+        {'mysql_row_format': 'DYNAMIC'})
+
+    id = Column(Integer, primary_key=True)
+    sample_id = Column(Integer, ForeignKey(Sample.id), index=True)
+    sample = relationship(Sample, backref=backref(
+        'sample_stat_bins', cascade='all, delete-orphan'))
+
+    filter_type = Column(String(length=255))
+    outliers = Column(Boolean)
+    full_reads = Column(Boolean)
+
+    field = Column(String(length=32))
+    key = Column(String(length=128))
+    value = Column(Float(precision=53))
+
+
 class Clone(Base):
     """A group of sequences likely originating from the same germline
 
@@ -229,7 +406,8 @@ class Clone(Base):
     :param Relationship subject: Reference to the associated \
         :py:class:`Subject` instance
     :param str germline: The germline sequence for this clone
-    :param str tree: The textual representation of the clone's lineage tree
+    :param str tree: The clone's lineage tree, optionally compressed.  Use \
+        :py:func:`immunedb.trees.deserialize_tree` to read it.
     :param int parent_id: The (possibly null) ID of the clone's parent
 
     """
@@ -354,7 +532,8 @@ class CloneStats(Base):
     :param int total_cnt: The number of total sequences in the clone in the \
         sample
 
-    :param str mutations: A JSON stanza of mutation count information
+    :param str mutations: A JSON stanza of mutation count information, \
+        optionally compressed.  Use :py:attr:`mutations_dict` to read it.
 
     """
     __tablename__ = 'clone_stats'
@@ -385,9 +564,14 @@ class CloneStats(Base):
     top_copy_seq_copies = Column(Integer)
     top_copy_seq = relationship('Sequence')
 
+    @property
+    def mutations_dict(self):
+        """Returns the deserialized mutations of the clone"""
+        return deserialize_clone_mutations(self.mutations)
+
     @property
     def v_mutations(self):
-        muts = json.loads(self.mutations).get('regions', {})
+        muts = self.mutations_dict.get('regions', {})
         aggregate = 0
         for region in ['FR1', 'CDR1', 'FR2', 'CDR2', 'FR3']:
             region_muts = muts.get(region, {})
@@ -459,6 +643,24 @@ class SelectionPressure(Base):
         return {field: getattr(self, field) for field in fields}
 
 
+class SelectionPressureCache(Base):
+    """A cached selection pressure result keyed by a hash of its input so
+    unchanged clones need not be recalculated.
+
+    :param int id: The ID of the cache entry
+    :param str input_hash: The SHA-256 hex digest of the germline, sequences,
+        and test parameters
+    :param str result: The result, keyed as in BASELINe's output, as JSON
+
+    """
+    __tablename__ = 'selection_pressure_cache'
+    __table_args__ = {'mysql_row_format': 'DYNAMIC'}
+
+    id = Column(Integer, primary_key=True)
+    input_hash = Column(String(length=64), unique=True, nullable=False)
+    result = Column(MEDIUMTEXT)
+
+
 class Sequence(Base):
     """Represents a single unique sequence.
 
@@ -524,7 +726,9 @@ class Sequence(Base):
     :param int clone_id: The clone ID to which this sequence belongs
     :param Relationship clone: Reference to the associated :py:class:`Clone` \
         instance
-    :param str mutations_from_clone: A JSON stanza with mutation information
+    :param str mutations_from_clone: A JSON stanza with mutation \
+        information or its compact encoding.  Use \
+        :py:attr:`clone_mutations` to read it.
 
 
     """
@@ -613,6 +817,16 @@ class Sequence(Base):
                          order_by=seq_id))
     mutations_from_clone = Column(MEDIUMTEXT)
 
+    @property
+    def clone_mutations(self):
+        """Returns the type of each mutation from the clone by position"""
+        return deserialize_mutations(self.mutations_from_clone)
+
+    @property
+    def clone_mutation_positions(self):
+        """Returns the positions of mutations from the clone"""
+        return mutation_positions(self.mutations_from_clone)
+
     @hybrid_property
     def deletions(self):
         """Returns the list of deletion position/length pairs"""
@@ -661,16 +875,10 @@ class Sequence(Base):
         adding insertions from other sequences to this one.
 
         """
-        seq = self.sequence
         if self.clone is None:
-            return seq
-        for ins in sorted(self.clone.insertions):
-            if ins in self.insertions:
-                continue
-            pos, size = ins
-            seq = seq[:pos] + ('-' * size) + seq[pos:]
-
-        return seq
+            return self.sequence
+        return get_clone_sequence(self.sequence, self.insertions,
+                                  self.clone.insertions)
 
     @property
     def regions(self):
@@ -776,6 +984,31 @@ class ModificationLog(Base):
     info = Column(String(length=1024))
 
 
+class DirtyEntity(Base):
+    """Marks a clone or sample whose downstream results in one pipeline stage
+    are out of date.
+
+    :param int id: The ID of the mark
+    :param str stage: The stage which must recompute results for the entity
+    :param int entity_id: The ID of the clone or sample
+    :param str reason: A short description of why the entity was marked
+    :param int generation: The number of times the entity has been marked
+        for the stage, used to avoid clearing marks made during recomputation
+
+    """
+    __tablename__ = 'dirty_entities'
+    __table_args__ = (
+        UniqueConstraint('stage', 'entity_id'),
+        {'mysql_row_format': 'DYNAMIC'}
+    )
+
+    id = Column(Integer, primary_key=True)
+    stage = Column(String(length=32), nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    reason = Column(String(length=128))
+    generation = Column(Integer, nullable=False, server_default='1')
+
+
 class SequenceCollapse(Base):
     """A one to many table that links sequence from different samples that
     collapse to one another.  This is used instead of a field in
@@ -2,8 +2,10 @@ import csv
 import dnautils
 import sys
 
+import immunedb.common.dirty as dirty
 from immunedb.common.models import (Clone, NoResult, SampleMetadata, Sample,
-                                    SampleStats, Sequence, SequenceCollapse)
+                                    SampleStatBin, SampleStats, Sequence,
+                                    SequenceCollapse)
 from immunedb.identification.metadata import NA_VALUES
 from immunedb.util.log import logger
 
@@ -71,10 +73,18 @@ def update_metadata(session, args):
             Sample.name.like('%' + SENTINEL)):
         sample.name = sample.name[:-len(SENTINEL)]
 
-    if session.query(Clone.id).filter(~Clone.tree.is_(None)).count() > 0:
-        logger.warning('This database has at least one clonal lineage '
-                       'constructed.  All lineages will need to be updated '
-                       'to reflect the modified metadata.')
+    # Lineages include sample metadata so must be regenerated
+    subject_ids = set(s.subject_id for s in session.query(
+        Sample.subject_id).filter(Sample.id.in_(sample_ids.values())))
+    tree_clones = [c.id for c in session.query(Clone.id).filter(
+        Clone.subject_id.in_(subject_ids), ~Clone.tree.is_(None))]
+    if len(tree_clones) > 0:
+        logger.warning('{} clonal lineages have been marked to be updated '
+                       'to reflect the modified metadata.  Re-run '
+                       'immunedb_clone_trees to update them.'.format(
+                           len(tree_clones)))
+        dirty.mark_clones(session, tree_clones, 'metadata',
+                          stages=('clone_tree',))
     session.commit()
 
 
@@ -114,6 +124,9 @@ def combine_samples(session, args):
     session.query(SampleStats).filter(
         SampleStats.sample_id.in_(all_samples)
     ).delete(synchronize_session=False)
+    session.query(SampleStatBin).filter(
+        SampleStatBin.sample_id.in_(all_samples)
+    ).delete(synchronize_session=False)
 
     for group_id, samples in groups.items():
         final_sample_id = min(samples)
@@ -143,6 +156,7 @@ def combine_samples(session, args):
             Sample.id.in_(samples - set([final_sample_id]))
         ).delete(synchronize_session=False)
 
+    dirty.mark_subject_samples(session, all_subjects, 'combined samples')
     session.commit()
     logger.info('Sequences successfully collapsed: please re-run '
                 'immunedb_collapse and later pipeline steps.')
@@ -1,10 +1,113 @@
-import json
+from collections import OrderedDict
+import itertools
 
+import numpy as np
 from sqlalchemy import distinct
 
-from immunedb.common.models import Sequence, SequenceCollapse
+from immunedb.common.models import (CloneStats, COMPACT_PREFIX,
+                                    deserialize_clone_mutations,
+                                    deserialize_gaps, deserialize_mutations,
+                                    get_clone_sequence, MUTATION_TYPES,
+                                    Sample, Sequence, SequenceCollapse,
+                                    serialize_clone_mutations,
+                                    serialize_mutations)
 import immunedb.util.lookups as lookups
 import immunedb.util.funcs as funcs
+from immunedb.util.log import logger
+
+# Nucleotides are encoded as their index in ``_BASES`` and any other character
+# as ``_UNKNOWN_BASE``.  Codons are then encoded in base 5 and partial codons
+# at the end of a sequence are encoded as ``_PARTIAL_CODON``.
+_BASES = 'ACGT'
+_UNKNOWN_BASE = len(_BASES)
+_PARTIAL_CODON = (_UNKNOWN_BASE + 1) ** 3
+_CODON_WEIGHTS = np.array([25, 5, 1], dtype=np.int64)
+_BASE_CODES = np.full(256, _UNKNOWN_BASE, dtype=np.int64)
+for _i, _base in enumerate(_BASES):
+    _BASE_CODES[ord(_base)] = _i
+    _BASE_CODES[ord(_base.lower())] = _i
+
+# The amino-acid (as its character code) for each encoded codon, or -1
+_CODON_AAS = np.full(_PARTIAL_CODON + 1, -1, dtype=np.int64)
+for _codon in itertools.product(range(_UNKNOWN_BASE), repeat=3):
+    _CODON_AAS[np.dot(_codon, _CODON_WEIGHTS)] = ord(lookups.aa_from_codon(
+        ''.join(_BASES[b] for b in _codon)))
+
+# If each pair of amino-acids (as character codes) are conserved
+_AAS = set(chr(a) for a in _CODON_AAS if a >= 0)
+_CONSERVED = np.zeros((256, 256), dtype=bool)
+for _aa1, _aa2 in itertools.product(_AAS, repeat=2):
+    _CONSERVED[ord(_aa1), ord(_aa2)] = lookups.are_conserved_aas(_aa1, _aa2)
+
+_UNKNOWN, _SYNONYMOUS, _CONSERVATIVE, _NONCONSERVATIVE = range(1, 5)
+
+
+def call_mutations(germline, seqs):
+    """Finds every mutation from the germline in a list of sequences at once
+    by comparing them as a 2-D array.
+
+    :param str germline: The germline of the clone
+    :param list seqs: The sequences, gapped to match the clone
+
+    :returns: A dictionary of parallel arrays with one entry per mutation,
+        in order of sequence then position
+    :rtype: dict
+
+    """
+    germline = np.frombuffer(germline.encode('ascii'), dtype=np.uint8)
+    length = len(germline)
+    matrix = np.frombuffer(''.join(
+        s[:length].ljust(length, '-') for s in seqs
+    ).encode('ascii'), dtype=np.uint8).reshape(len(seqs), length)
+
+    ignored = np.array([ord('N'), ord('-')], dtype=np.uint8)
+    mutated = matrix != germline
+    mutated &= ~np.isin(germline, ignored)
+    mutated &= ~np.isin(matrix, ignored)
+    rows, pos = np.nonzero(mutated)
+
+    offsets = pos % 3
+    starts = pos - offsets
+    partial = starts + 3 > length
+    codon_pos = np.minimum(starts[:, np.newaxis] + np.arange(3),
+                           length - 1)
+
+    germline_bases = _BASE_CODES[germline]
+    germline_codons = np.where(
+        partial, _PARTIAL_CODON,
+        germline_bases[codon_pos].dot(_CODON_WEIGHTS))
+    to_bases = _BASE_CODES[matrix[rows, pos]]
+    # Simulate each point mutation alone
+    intermediate_codons = np.where(
+        partial, _PARTIAL_CODON,
+        germline_codons + (to_bases - germline_bases[pos]) *
+        _CODON_WEIGHTS[offsets])
+    final_codons = np.where(
+        partial, _PARTIAL_CODON,
+        _BASE_CODES[matrix[rows[:, np.newaxis], codon_pos]].dot(
+            _CODON_WEIGHTS))
+
+    from_aas = _CODON_AAS[germline_codons]
+    intermediate_aas = _CODON_AAS[intermediate_codons]
+    known = (from_aas >= 0) & (intermediate_aas >= 0)
+    mtypes = np.where(
+        ~known, _UNKNOWN,
+        np.where(
+            from_aas == intermediate_aas, _SYNONYMOUS,
+            np.where(
+                _CONSERVED[np.maximum(from_aas, 0),
+                           np.maximum(intermediate_aas, 0)],
+                _CONSERVATIVE, _NONCONSERVATIVE)))
+
+    return {
+        'rows': rows,
+        'pos': pos,
+        'to_nts': matrix[rows, pos],
+        'types': mtypes,
+        'from_aas': from_aas,
+        'intermediate_aas': intermediate_aas,
+        'final_aas': _CODON_AAS[final_codons],
+    }
 
 
 class ContextualMutations(object):
@@ -83,6 +186,45 @@ class ContextualMutations(object):
         mut_dict['unique'] += 1
         mut_dict['total'] += copy_number
 
+    def add_mutations(self, mutation, region, from_aa, intermediate_seq_aa,
+                      final_seq_aas, unique, total):
+        """Adds all occurrences of a mutation to the aggregate mutation list at
+        once.
+
+        :param tuple mutation: The mutation in (position, from_nt, to_nt, type)
+            form.
+        :param str region: The region in which the mutation occurs
+        :param char from_aa: The germline amino acid
+        :param char intermediate_seq_aa: The amino acid in the sequence if only
+            the point mutation occurred
+        :param list final_seq_aas: The distinct final mutated amino acids
+        :param int unique: The number of sequences with the mutation
+        :param int total: The total copy number of sequences with the mutation
+
+        """
+        pos, from_nt, to_nt, mtype = mutation
+        for r in (region, 'ALL'):
+            mut_dict = self.region_muts.setdefault(r, {}).setdefault(
+                mtype, {}).setdefault(mutation, {
+                    'pos': pos,
+                    'from_nt': from_nt,
+                    'from_aa': from_aa,
+                    'to_nt': to_nt,
+                    'to_aas': [],
+
+                    'unique': 0,
+                    'total': 0,
+                    'intermediate_aa': intermediate_seq_aa,
+                })
+            for aa in final_seq_aas:
+                if aa not in mut_dict['to_aas']:
+                    mut_dict['to_aas'].append(aa)
+            mut_dict['unique'] += unique
+            mut_dict['total'] += total
+
+        pos_muts = self.position_muts.setdefault(pos, {})
+        pos_muts[mtype] = pos_muts.get(mtype, 0) + unique
+
     def get_all(self):
         # Strip the dictionary keys and just make a list of mutations
         final_regions = {}
@@ -103,36 +245,65 @@ class CloneMutations(object):
         self._session = session
         self._germline = self._clone.consensus_germline
 
-    def _get_codon_at(self, seq, i):
-        aa_off = i - i % 3
-        return seq[aa_off:aa_off + 3]
-
-    def _get_aa_at(self, seq, i):
-        return lookups.aa_from_codon(self._get_codon_at(seq, i))
-
-    def _get_mutation(self, seq, i):
-        if (self._germline[i] != seq[i] and
-                self._germline[i] not in ('N', '-') and
-                seq[i] not in ('N', '-')):
-            grm_aa = self._get_aa_at(self._germline, i)
-            # Simulate this mutation alone
-            off = i % 3
-            grm_codon = self._get_codon_at(self._germline, i)
-            seq_aa = lookups.aa_from_codon(
-                grm_codon[:off] + seq[i] + grm_codon[off+1:])
-
-            if grm_aa is None or seq_aa is None:
-                return 'unknown', seq_aa
-            elif grm_aa != seq_aa:
-                if lookups.are_conserved_aas(grm_aa, seq_aa):
-                    return 'conservative', seq_aa
-                return 'nonconservative', seq_aa
-            else:
-                return 'synonymous', seq_aa
+    def _call_mutations(self, seqs):
+        return call_mutations(self._germline, seqs)
+
+    def _get_context(self, calls, rows, copies):
+        """Aggregates called mutations into a
+        :py:class:`ContextualMutations`.
+
+        :param dict calls: The mutations from :py:meth:`_call_mutations`
+        :param numpy.ndarray rows: A mask of the sequences to include
+        :param numpy.ndarray copies: The copy number of each sequence
+
+        :returns: The mutations of the included sequences
+        :rtype: ContextualMutations
+
+        """
+        context_mutations = ContextualMutations(self._clone.regions)
+        included = rows[calls['rows']]
+        if not included.any():
+            return context_mutations
+        calls = {k: v[included] for k, v in calls.items()}
+
+        # Each distinct position and resulting base is one mutation
+        _, firsts, groups = np.unique(calls['pos'] * 256 + calls['to_nts'],
+                                      return_index=True, return_inverse=True)
+        groups = groups.ravel()
+        uniques = np.bincount(groups)
+        totals = np.bincount(groups, weights=copies[calls['rows']])
+
+        _, aa_firsts = np.unique(
+            groups * 257 + calls['final_aas'] + 1, return_index=True)
+        final_aas = [[] for _ in firsts]
+        for i in sorted(aa_firsts):
+            final_aas[groups[i]].append(_to_aa(calls['final_aas'][i]))
+
+        regions = {}
+        for group in np.argsort(firsts, kind='stable'):
+            i = firsts[group]
+            pos = int(calls['pos'][i])
+            if pos not in regions:
+                regions[pos] = funcs.get_pos_region(
+                    self._clone.regions, self._clone.cdr3_num_nts, pos)
+            mutation = (pos, self._germline[pos], chr(calls['to_nts'][i]),
+                        MUTATION_TYPES[calls['types'][i]])
+            context_mutations.add_mutations(
+                mutation, regions[pos], _to_aa(calls['from_aas'][i]),
+                _to_aa(calls['intermediate_aas'][i]), final_aas[group],
+                int(uniques[group]), int(totals[group]))
+        return context_mutations
 
-        return None, None
+    def _get_seq_mutations(self, calls, num_seqs):
+        """Gets the position and type of each sequence's mutations."""
+        seq_mutations = [{} for _ in range(num_seqs)]
+        for row, pos, mtype in zip(calls['rows'], calls['pos'],
+                                   calls['types']):
+            seq_mutations[row][int(pos)] = MUTATION_TYPES[mtype]
+        return seq_mutations
 
-    def calculate(self, commit_seqs=False, limit_samples=None):
+    def calculate(self, commit_seqs=False, limit_samples=None,
+                  compact=False):
         sample_mutations = {}
 
         if limit_samples is not None:
@@ -151,42 +322,71 @@ class CloneMutations(object):
             if sample_id is None:
                 seqs = seqs.join(SequenceCollapse).filter(
                     SequenceCollapse.copy_number_in_subject > 0
-                )
+                ).all()
+                copies = [s.collapse.copy_number_in_subject for s in seqs]
             else:
                 seqs = seqs.filter(
                     Sequence.sample_id == sample_id
-                )
-            sample_mutations[sample_id] = self._get_contextual_mutations(
-                seqs, commit_seqs, use_sample_copy=sample_id is not None)
+                ).all()
+                copies = [s.copy_number for s in seqs]
+            sample_mutations[sample_id], seq_mutations = (
+                self._get_contextual_mutations(
+                    [s.clone_sequence for s in seqs], copies)
+            )
+            if commit_seqs:
+                for seq, mutations in zip(seqs, seq_mutations):
+                    seq.mutations_from_clone = serialize_mutations(
+                        mutations, compact=compact)
 
         return sample_mutations
 
-    def _get_contextual_mutations(self, seqs, commit_seqs, use_sample_copy):
-        context_mutations = ContextualMutations(self._clone.regions)
-        for seq in seqs:
-            seq_mutations = {}
-            for i in range(0, len(seq.clone_sequence)):
-                mtype, intermediate_aa = self._get_mutation(
-                    seq.clone_sequence, i)
-                if mtype is None:
-                    continue
-
-                from_aa = self._get_aa_at(self._germline, i)
-                seq_mutations[i] = mtype
-
-                mutation = (i, self._germline[i], seq.clone_sequence[i], mtype)
-                copy_field = (
-                    seq.copy_number if use_sample_copy else
-                    seq.collapse.copy_number_in_subject
-                )
-                context_mutations.add_mutation(
-                    seq.clone_sequence, self._clone.cdr3_num_nts,
-                    mutation, from_aa, intermediate_aa,
-                    self._get_aa_at(seq.clone_sequence, i), copy_field)
+    def calculate_for_seqs(self, seqs):
+        """Calculates the mutations in each sample and in the clone as a whole
+        from already fetched sequences.
 
-            if commit_seqs:
-                seq.mutations_from_clone = json.dumps(seq_mutations)
-        return context_mutations
+        :param list seqs: The clone's sequences, each with ``sample_id``,
+            ``ai``, ``sequence``, ``_insertions``, ``copy_number``, and
+            ``copy_number_in_subject`` attributes
+
+        :returns: A tuple of the :py:class:`ContextualMutations` for each
+            sample ID, keyed ``None`` for the whole clone, and the mutations
+            for each sequence keyed by ``(sample_id, ai)``
+        :rtype: tuple
+
+        """
+        calls = self._call_mutations([
+            get_clone_sequence(s.sequence, deserialize_gaps(s._insertions),
+                               self._clone.insertions)
+            for s in seqs
+        ])
+        seq_mutations = {
+            (seq.sample_id, seq.ai): mutations
+            for seq, mutations in zip(
+                seqs, self._get_seq_mutations(calls, len(seqs)))
+        }
+
+        sample_ids = np.array([s.sample_id for s in seqs])
+        sample_copies = np.array([s.copy_number for s in seqs])
+        sample_mutations = {
+            sample_id: self._get_context(
+                calls, sample_ids == sample_id, sample_copies)
+            for sample_id in OrderedDict.fromkeys(s.sample_id for s in seqs)
+        }
+
+        subject_copies = np.array([s.copy_number_in_subject for s in seqs])
+        sample_mutations[None] = self._get_context(
+            calls, subject_copies > 0, subject_copies)
+        return sample_mutations, seq_mutations
+
+    def _get_contextual_mutations(self, seqs, copies):
+        calls = self._call_mutations(seqs)
+        context_mutations = self._get_context(
+            calls, np.ones(len(seqs), dtype=bool), np.array(copies))
+        return context_mutations, self._get_seq_mutations(calls, len(seqs))
+
+
+def _to_aa(code):
+    return chr(code) if code >= 0 else None
 
 
 def threshold_mutations(all_muts, min_required_seqs):
@@ -224,3 +424,65 @@ def threshold_mutations(all_muts, min_required_seqs):
                         mutation['unique']
                     final[region]['counts']['unique'][mtype] += 1
     return final
+
+
+def convert_mutations(session, compact, chunk_size=10000):
+    """Converts all stored sequence and clone mutations to or from the compact
+    encoding.  Values already in the requested encoding are left as-is so the
+    conversion can be resumed if interrupted.
+
+    :param Session session: The database session
+    :param bool compact: If set, converts to the compact encoding, otherwise
+        to JSON
+    :param int chunk_size: The number of records to convert at once
+
+    """
+    def needs_conversion(value):
+        return (value is not None and
+                value.startswith(COMPACT_PREFIX) != compact)
+
+    for sample_id in [s.id for s in session.query(Sample.id)]:
+        last_ai = -1
+        converted = 0
+        while True:
+            seqs = session.query(
+                Sequence.sample_id, Sequence.ai, Sequence.mutations_from_clone
+            ).filter(
+                Sequence.sample_id == sample_id,
+                Sequence.ai > last_ai,
+                ~Sequence.mutations_from_clone.is_(None)
+            ).order_by(Sequence.ai).limit(chunk_size).all()
+            if len(seqs) == 0:
+                break
+            last_ai = seqs[-1].ai
+            updates = [{
+                'sample_id': seq.sample_id,
+                'ai': seq.ai,
+                'mutations_from_clone': serialize_mutations(
+                    deserialize_mutations(seq.mutations_from_clone),
+                    compact=compact)
+            } for seq in seqs if needs_conversion(seq.mutations_from_clone)]
+            session.bulk_update_mappings(Sequence, updates)
+            session.commit()
+            converted += len(updates)
+        logger.info('Converted mutations of {} sequences in sample {}'.format(
+            converted, sample_id))
+
+    last_id = -1
+    converted = 0
+    while True:
+        stats = session.query(CloneStats.id, CloneStats.mutations).filter(
+            CloneStats.id > last_id
+        ).order_by(CloneStats.id).limit(chunk_size).all()
+        if len(stats) == 0:
+            break
+        last_id = stats[-1].id
+        updates = [{
+            'id': stat.id,
+            'mutations': serialize_clone_mutations(
+                deserialize_clone_mutations(stat.mutations), compact=compact)
+        } for stat in stats if needs_conversion(stat.mutations)]
+        session.bulk_update_mappings(CloneStats, updates)
+        session.commit()
+        converted += len(updates)
+    logger.info('Converted mutations of {} clone statistics'.format(converted))
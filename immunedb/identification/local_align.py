@@ -5,16 +5,16 @@ import subprocess
 import shlex
 import io
 
+import numpy as np
 from sqlalchemy import desc
 
-import dnautils
-
 from immunedb.identification import add_sequences, AlignmentException
 from immunedb.identification.vdj_sequence import VDJAlignment, VDJSequence
 from immunedb.identification.genes import (CDR3_OFFSET, GeneName, JGermlines,
                                            VGermlines)
 from immunedb.identification.identify import IdentificationProps
 from immunedb.common.models import NoResult, Sample, Sequence, serialize_gaps
+import immunedb.util.distance as distance
 from immunedb.util.funcs import format_ties, periodic_commit, gap_positions
 import immunedb.util.lookups as lookups
 from immunedb.util.log import logger
@@ -392,22 +392,42 @@ def remove_duplicates(session, sample):
         Sequence.sample_id == sample.id
     ).order_by(Sequence.ai)
 
+    buckets = {}
     for seq in seqs:
+        key = (seq.v_gene, seq.j_gene, seq.cdr3_num_nts)
+        buckets.setdefault(key, []).append(seq)
+
+    for (v_gene, j_gene, cdr3_num_nts), aligned in buckets.items():
         potential_collapse = session.query(
             Sequence
         ).filter(
             Sequence.sample_id == sample.id,
-            Sequence.v_gene == seq.v_gene,
-            Sequence.j_gene == seq.j_gene,
-            Sequence.cdr3_num_nts == seq.cdr3_num_nts,
+            Sequence.v_gene == v_gene,
+            Sequence.j_gene == j_gene,
+            Sequence.cdr3_num_nts == cdr3_num_nts,
         ).order_by(desc(Sequence.copy_number), Sequence.ai)
 
+        by_length = {}
         for other_seq in potential_collapse:
-            if (other_seq.seq_id == seq.seq_id or
-                    len(other_seq.sequence) != len(seq.sequence)):
-                continue
+            by_length.setdefault(len(other_seq.sequence), []).append(
+                other_seq)
+        by_length = {
+            length: (others, distance.encode(
+                [s.sequence for s in others], wildcards='N-'))
+            for length, others in by_length.items()
+        }
 
-            if dnautils.equal(other_seq.sequence, seq.sequence):
+        for seq in aligned:
+            others, encoded = by_length[len(seq.sequence)]
+            row = others.index(seq)
+            dists = distance.hamming_to_many(encoded[row], encoded)
+            # Sequences are re-ranked since earlier merges change copy numbers
+            for i in sorted(np.nonzero(dists == 0)[0],
+                            key=lambda i: (-others[i].copy_number,
+                                           others[i].ai)):
+                other_seq = others[i]
+                if other_seq is seq or other_seq in session.deleted:
+                    continue
                 other_seq.copy_number += seq.copy_number
                 session.delete(seq)
                 break
@@ -2,7 +2,9 @@ import csv
 
 from sqlalchemy.orm import joinedload
 
-from immunedb.common.models import Clone, CloneStats, SampleStats, Sequence
+import immunedb.common.dirty as dirty
+from immunedb.common.models import (Clone, CloneStats, SampleStatBin,
+                                    SampleStats, Sequence)
 from immunedb.aggregation.clones import generate_consensus, push_clone_ids
 from immunedb.importing import ImportException
 
@@ -55,6 +57,7 @@ def import_template(session, in_file, regen):
         session.query(Clone).delete()
         session.query(CloneStats).delete()
         session.query(SampleStats).delete()
+        session.query(SampleStatBin).delete()
         session.commit()
 
     seen_clones = {}
@@ -104,4 +107,7 @@ def import_template(session, in_file, regen):
         session.bulk_update_mappings(Sequence, to_update)
     session.commit()
     generate_consensus(session, db_clone_ids)
-    push_clone_ids(session)
+    subject_ids = set(c['clone'].subject_id for c in seen_clones.values())
+    push_clone_ids(session, subject_ids)
+    dirty.mark_subject_samples(session, subject_ids, 'import')
+    session.commit()
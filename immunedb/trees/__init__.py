@@ -1,8 +1,13 @@
+import base64
 import json
+import zlib
 
 import ete3
+import numpy as np
 
-from immunedb.common.models import Clone, Sequence, SequenceCollapse
+from immunedb.common.models import (COMPACT_PREFIX, Clone, Sample,
+                                    SampleMetadata, Sequence,
+                                    SequenceCollapse)
 import immunedb.util.concurrent as concurrent
 from immunedb.util.log import logger
 
@@ -10,7 +15,8 @@ from immunedb.util.log import logger
 class LineageWorker(concurrent.Worker):
     def __init__(self, session, newick_generator, min_mut_copies,
                  min_mut_samples, min_seq_copies, min_seq_samples,
-                 exclude_stops, full_seq, post_tree_hook=None):
+                 exclude_stops, full_seq, post_tree_hook=None,
+                 max_seqs=None, compact=False):
         self.session = session
         self.newick_generator = newick_generator
         self.min_mut_copies = min_mut_copies
@@ -20,6 +26,8 @@ class LineageWorker(concurrent.Worker):
         self.exclude_stops = exclude_stops
         self.full_seq = full_seq
         self.post_tree_hook = post_tree_hook
+        self.max_seqs = max_seqs
+        self.compact = compact
 
     def get_tree(self, clone, sequences):
         fasta, removed_muts = get_fasta_input(
@@ -37,6 +45,41 @@ class LineageWorker(concurrent.Worker):
             tree = self.post_tree_hook(tree)
         return tree
 
+    def limit_sequences(self, clone_id, sequences):
+        """Limits the sequences in a tree to ``max_seqs`` with
+        :py:func:`sample_sequences`.  Only the fields needed to choose
+        sequences are loaded for the whole clone.
+
+        :param int clone_id: The ID of the clone, used to seed the sampling
+        :param Query sequences: The query for all qualifying sequences
+
+        :returns: A tuple of the query for the chosen sequences and a summary
+            of the sampling, or ``None`` if all sequences were kept
+        :rtype: tuple
+
+        """
+        candidates = sequences.with_entities(
+            Sequence.ai,
+            SequenceCollapse.copy_number_in_subject,
+            SequenceCollapse.samples_in_subject
+        ).all()
+        if len(candidates) <= self.max_seqs:
+            return sequences, None
+
+        chosen = sample_sequences(candidates, self.max_seqs, seed=clone_id)
+        sampling = {
+            'total_seqs': len(candidates),
+            'total_copies': sum(
+                c.copy_number_in_subject for c in candidates),
+            'sampled_seqs': len(chosen),
+            'sampled_copies': sum(
+                c.copy_number_in_subject for c in candidates
+                if c.ai in chosen),
+        }
+        self.info('Sampled {} of {} sequences for clone {}'.format(
+            len(chosen), len(candidates), clone_id))
+        return sequences.filter(Sequence.ai.in_(list(chosen))), sampling
+
     def do_task(self, clone_id):
         clone_inst = self.session.query(Clone).filter(
             Clone.id == clone_id).first()
@@ -57,6 +100,9 @@ class LineageWorker(concurrent.Worker):
             sequences = sequences.filter(Sequence.stop == 0)
 
         sequences = sequences.order_by(Sequence.v_length)
+        sampling = None
+        if self.max_seqs:
+            sequences, sampling = self.limit_sequences(clone_id, sequences)
 
         try:
             tree = self.get_tree(clone_inst, sequences)
@@ -78,14 +124,57 @@ class LineageWorker(concurrent.Worker):
                 'min_seq_samples': self.min_seq_samples,
                 'exclude_stops': self.exclude_stops,
                 'full_seq': self.full_seq,
+                'max_seqs': self.max_seqs,
+                'sampling': sampling,
             },
             'tree': tree_as_dict(tree)
         }
-        clone_inst.tree = json.dumps(final)
+        clone_inst.tree = serialize_tree(final, self.compact)
         self.session.add(clone_inst)
         self.session.commit()
 
 
+def sample_sequences(candidates, max_seqs, seed=0):
+    """Chooses a representative subset of sequences for a tree.  The
+    sequences with the highest copy numbers, up to half of ``max_seqs``, and
+    those found in multiple samples are always kept, preferring higher copy
+    numbers if there are more than ``max_seqs`` of them.  The remaining
+    sequences are chosen at random, weighted by copy number.
+
+    :param list candidates: The sequences, each with ``ai``,
+        ``copy_number_in_subject``, and ``samples_in_subject`` attributes
+    :param int max_seqs: The maximum number of sequences to choose
+    :param int seed: The random seed, so the same sequences are chosen each
+        time a tree is generated
+
+    :returns: The ``ai`` of each chosen sequence
+    :rtype: set
+
+    """
+    by_copies = sorted(candidates,
+                       key=lambda c: (-c.copy_number_in_subject, c.ai))
+    required = [
+        i for i, c in enumerate(by_copies)
+        if i < max_seqs // 2 or c.samples_in_subject > 1
+    ][:max_seqs]
+    kept = len(required)
+    chosen = set(by_copies[i].ai for i in required)
+    required = set(required)
+    remaining = [c for i, c in enumerate(by_copies) if i not in required]
+    if len(remaining) > 0 and kept < max_seqs:
+        # Weighted sampling without replacement using the largest of
+        # log(u) / weight for each sequence
+        weights = np.array([c.copy_number_in_subject for c in remaining],
+                           dtype=np.float64)
+        keys = np.full(len(remaining), -np.inf)
+        positive = weights > 0
+        keys[positive] = np.log(np.random.RandomState(seed).random_sample(
+            len(remaining))[positive]) / weights[positive]
+        for i in np.argsort(-keys, kind='stable')[:max_seqs - kept]:
+            chosen.add(remaining[i].ai)
+    return chosen
+
+
 def get_fasta_input(germline_seq, sequences, min_mut_copies, min_mut_samples,
                     limit=None):
     seqs = {}
@@ -100,8 +189,7 @@ def get_fasta_input(germline_seq, sequences, min_mut_copies, min_mut_samples,
             )
 
         mutations = get_mutations(
-            germline_seq, seq.clone_sequence, map(
-                int, json.loads(seq.mutations_from_clone).keys())
+            germline_seq, seq.clone_sequence, seq.clone_mutation_positions
         )
         if limit:
             mutations = set([m for m in mutations if m[0] < limit])
@@ -126,21 +214,68 @@ def get_fasta_input(germline_seq, sequences, min_mut_copies, min_mut_samples,
     return in_data, removed_muts
 
 
+def get_tree_seqs(session, ais):
+    """Loads everything needed to annotate tree nodes with a fixed number of
+    queries, rather than several per node.
+
+    :param Session session: The database session
+    :param list ais: The ``ai`` of each subject-level sequence in the tree
+
+    :returns: A tuple of the subject-level sequences keyed by ``ai``, the
+        sample-level sequences collapsed to each subject-level sequence keyed
+        by its ``ai``, and the name and metadata of each sample keyed by ID
+    :rtype: tuple
+
+    """
+    ais = list(set(ais))
+    seqs = {s.ai: s for s in session.query(Sequence).filter(
+        Sequence.ai.in_(ais))}
+
+    collapsed = {ai: [] for ai in ais}
+    for seq in session.query(
+        SequenceCollapse.collapse_to_subject_seq_ai,
+        Sequence.seq_id,
+        Sequence.ai,
+        Sequence.copy_number,
+        Sequence.sample_id
+    ).join(
+        Sequence, Sequence.ai == SequenceCollapse.seq_ai
+    ).filter(
+        SequenceCollapse.collapse_to_subject_seq_ai.in_(ais)
+    ).order_by(SequenceCollapse.sample_id, SequenceCollapse.seq_ai):
+        collapsed[seq.collapse_to_subject_seq_ai].append(seq)
+
+    sample_ids = set(s.sample_id for c in collapsed.values() for s in c)
+    samples = {
+        s.id: {'name': s.name, 'metadata': {}}
+        for s in session.query(Sample.id, Sample.name).filter(
+            Sample.id.in_(sample_ids))
+    }
+    for meta in session.query(SampleMetadata).filter(
+            SampleMetadata.sample_id.in_(sample_ids)):
+        samples[meta.sample_id]['metadata'][meta.key] = meta.value
+
+    return seqs, collapsed, samples
+
+
 def add_tree_metadata(session, newick, germline_seq, removed_muts, limit=None):
     tree = ete3.Tree(newick)
+    seqs, collapsed, samples = get_tree_seqs(session, [
+        int(node.name) for node in tree.traverse()
+        if node.name not in ('NoName', 'germline', '')
+    ])
     for node in tree.traverse():
         if node.name not in ('NoName', 'germline', ''):
-            seq = session.query(Sequence).filter(
-                Sequence.ai == node.name
-            ).first()
+            seq = seqs[int(node.name)]
             seq_ids = {}
-            for collapsed_seq in get_seqs_collapsed_to(session, seq):
+            for collapsed_seq in collapsed[seq.ai]:
+                sample = samples[collapsed_seq.sample_id]
                 seq_ids[collapsed_seq.seq_id] = {
                     'ai': collapsed_seq.ai,
                     'copy_number': collapsed_seq.copy_number,
-                    'sample_name': collapsed_seq.sample.name,
-                    'sample_id': collapsed_seq.sample.id,
-                    'metadata': collapsed_seq.sample.metadata_dict
+                    'sample_name': sample['name'],
+                    'sample_id': collapsed_seq.sample_id,
+                    'metadata': dict(sample['metadata'])
                 }
 
             node.name = seq.seq_id
@@ -151,8 +286,7 @@ def add_tree_metadata(session, newick, germline_seq, removed_muts, limit=None):
             modified_seq = remove_muts(seq.sequence,
                                        removed_muts, germline_seq)
             muts = get_mutations(
-                germline_seq, modified_seq,
-                map(int, json.loads(seq.mutations_from_clone).keys())
+                germline_seq, modified_seq, seq.clone_mutation_positions
             )
             if limit:
                 muts = set([m for m in muts if m[0] < limit])
@@ -163,16 +297,6 @@ def add_tree_metadata(session, newick, germline_seq, removed_muts, limit=None):
     return tree
 
 
-def get_seqs_collapsed_to(session, seq):
-    sample_level_seqs = session.query(SequenceCollapse.seq_ai).filter(
-        SequenceCollapse.collapse_to_subject_seq_ai == seq.ai
-    )
-    for sample_seq in sample_level_seqs:
-        yield session.query(
-            Sequence
-        ).filter(Sequence.ai == sample_seq.seq_ai).one()
-
-
 def remove_muts(seq, removes, germline_seq):
     for mut in removes:
         loc, _, to = mut
@@ -238,6 +362,179 @@ def tree_as_dict(tree, root=True):
     }
 
 
+def compact_tree(tree):
+    """Converts a tree as generated by :py:class:`LineageWorker` to its
+    compact representation.  The name and metadata of each sample are stored
+    once and referenced by ID from each sequence, per-node metadata is
+    omitted since it can be derived from the sequences, and nodes and
+    mutations are stored as lists rather than dictionaries.
+
+    :param dict tree: The tree with ``info`` and ``tree`` keys
+
+    :returns: The compact tree with ``info``, ``samples``, and ``tree`` keys
+    :rtype: dict
+
+    """
+    samples = {}
+
+    def compact_node(node):
+        data = node['data']
+        seqs = []
+        for seq_id, seq in data['seq_ids'].items():
+            samples.setdefault(str(seq['sample_id']), {
+                'name': seq['sample_name'],
+                'metadata': seq['metadata']
+            })
+            seqs.append([seq_id, seq['ai'], seq['copy_number'],
+                         seq['sample_id']])
+        return {
+            'node_id': data.get('node_id'),
+            'copy_number': data['copy_number'],
+            'mutations': [[m['pos'], m['from'], m['to']]
+                          for m in data['mutations']],
+            'seqs': seqs,
+            'children': [compact_node(child) for child in node['children']]
+        }
+
+    return {
+        'info': tree['info'],
+        'samples': samples,
+        'tree': compact_node(tree['tree'])
+    }
+
+
+def get_node_details(node, samples):
+    """Gets the sequences and aggregate metadata of a node in a compact tree.
+
+    :param dict node: The node from a tree returned by
+        :py:func:`compact_tree`
+    :param dict samples: The ``samples`` of the compact tree
+
+    :returns: The ``seq_ids`` and ``metadata`` of the node as in
+        :py:func:`tree_as_dict`
+    :rtype: dict
+
+    """
+    seq_ids = {}
+    for seq_id, ai, copy_number, sample_id in node['seqs']:
+        sample = samples[str(sample_id)]
+        seq_ids[seq_id] = {
+            'ai': ai,
+            'copy_number': copy_number,
+            'sample_name': sample['name'],
+            'sample_id': sample_id,
+            'metadata': dict(sample['metadata'])
+        }
+    all_meta = set(
+        [k for seq in seq_ids.values() for k in seq['metadata'].keys()]
+    )
+    return {
+        'seq_ids': seq_ids,
+        'metadata': {k: get_nested(seq_ids, k) for k in all_meta}
+    }
+
+
+def expand_tree(tree, details=True):
+    """Converts a compact tree back to the representation generated by
+    :py:class:`LineageWorker`.
+
+    :param dict tree: The tree as returned by :py:func:`compact_tree`
+    :param bool details: If not set, only the skeleton of the tree is
+        returned.  Each node has its mutations, copy number, and the number
+        of sequences it contains in ``num_seqs`` but not its ``seq_ids`` or
+        ``metadata``, which can be fetched with :py:func:`get_tree_nodes`.
+
+    :returns: The tree with ``info`` and ``tree`` keys
+    :rtype: dict
+
+    """
+    def expand_node(node):
+        data = {
+            'copy_number': node['copy_number'],
+            'mutations': [{
+                'pos': pos,
+                'from': from_nt,
+                'to': to_nt,
+            } for pos, from_nt, to_nt in node['mutations']]
+        }
+        if node['node_id'] is not None:
+            data['node_id'] = node['node_id']
+        if details:
+            data.update(get_node_details(node, tree['samples']))
+        else:
+            data['num_seqs'] = len(node['seqs'])
+        return {
+            'data': data,
+            'children': [expand_node(child) for child in node['children']]
+        }
+
+    return {
+        'info': tree['info'],
+        'tree': expand_node(tree['tree'])
+    }
+
+
+def get_tree_nodes(tree, node_ids):
+    """Gets the details of nodes in a compact tree.
+
+    :param dict tree: The tree as returned by :py:func:`compact_tree`
+    :param list node_ids: The IDs of the nodes
+
+    :returns: The details of each node, as returned by
+        :py:func:`get_node_details`, keyed by node ID
+    :rtype: dict
+
+    """
+    node_ids = set(node_ids)
+    nodes = {}
+    to_visit = [tree['tree']]
+    while to_visit:
+        node = to_visit.pop()
+        if node['node_id'] in node_ids:
+            nodes[node['node_id']] = get_node_details(node, tree['samples'])
+        to_visit.extend(node['children'])
+    return nodes
+
+
+def serialize_tree(tree, compact=False):
+    """Serializes a tree for storage in :py:attr:`Clone.tree`.  The compact
+    encoding is the compressed JSON of :py:func:`compact_tree`.
+
+    :param dict tree: The tree with ``info`` and ``tree`` keys
+    :param bool compact: If set, uses the compact encoding instead of JSON
+
+    :returns: The serialized tree
+    :rtype: str
+
+    """
+    if not compact:
+        return json.dumps(tree)
+    return COMPACT_PREFIX + base64.b64encode(zlib.compress(
+        json.dumps(compact_tree(tree)).encode('utf-8'))).decode('ascii')
+
+
+def deserialize_tree(value, expand=True):
+    """Deserializes a tree in either encoding.
+
+    :param str value: The serialized tree
+    :param bool expand: If set, the tree is returned as generated by
+        :py:class:`LineageWorker`, otherwise it is returned as by
+        :py:func:`compact_tree`
+
+    :returns: The tree
+    :rtype: dict
+
+    """
+    if value is None:
+        return None
+    if value.startswith(COMPACT_PREFIX):
+        tree = json.loads(zlib.decompress(
+            base64.b64decode(value[len(COMPACT_PREFIX):])).decode('utf-8'))
+        return expand_tree(tree) if expand else tree
+    tree = json.loads(value)
+    return tree if expand else compact_tree(tree)
+
+
 def cut_tree(tree, max_muts, d=0):
     max_muts -= len(tree.mutations)
     if tree.is_leaf() or max_muts <= 0:
@@ -1,12 +1,17 @@
+import functools
+import operator
 import shlex
+import time
 from subprocess import Popen, PIPE
 
 import ete3
 
 import immunedb.common.config as config
+import immunedb.common.dirty as dirty
 from immunedb.common.models import Clone
 import immunedb.common.modification_log as mod_log
 from immunedb.trees import instantiate_node, LineageWorker
+import immunedb.trees.nj as nj
 import immunedb.util.concurrent as concurrent
 from immunedb.util.log import logger
 
@@ -17,96 +22,315 @@ def get_newick(fasta_input):
     return proc.communicate(input=fasta_input)[0]
 
 
-def minimize_tree(tree):
-    tree.set_outgroup('germline')
-    tree.search_nodes(name='germline')[0].delete()
-    first = True
-    while True:
-        push_common_mutations_up(tree, first)
-        remove_parent_mutations(tree)
-        rem_null = remove_null_nodes(tree)
-        moved = check_supersets(tree)
-        if not rem_null and not moved and not are_null_nodes(tree):
-            break
-        first = False
-    return tree
+NEWICK_GENERATORS = {
+    'clearcut': get_newick,
+    'nj': nj.get_newick,
+    'rnj': functools.partial(nj.get_newick, relaxed=True),
+}
+
+
+def _bits(mask):
+    while mask:
+        bit = mask & -mask
+        yield bit
+        mask ^= bit
 
 
-def push_common_mutations_up(tree, first):
-    if tree.is_leaf():
-        return tree.mutations
+class TreeMinimizer(object):
+    """Minimizes a tree using a bitset of mutations for each node.
 
-    common_muts = None
-    for child in tree.children:
-        child_muts = push_common_mutations_up(child, first)
-        if common_muts is None:
-            common_muts = child_muts
+    Each distinct mutation is assigned a bit so set operations are integer
+    operations.  After the first pass, only nodes affected by the previous
+    pass are revisited: nodes whose children changed have mutations pushed up
+    again, nodes whose parent or mask changed have parent mutations removed
+    again, and subtrees whose children were found to share no mutations are
+    not checked for supersets until something within them changes.
+
+    :param ete3.Tree tree: The tree to minimize, with a ``mutations`` set on
+        each node
+
+    """
+    def __init__(self, tree):
+        self.tree = tree
+        for node in tree.traverse():
+            if not hasattr(node, 'mutations'):
+                instantiate_node(node)
+        self.mutations = sorted(set(
+            m for node in tree.traverse() for m in node.mutations))
+        bits = {m: 1 << i for i, m in enumerate(self.mutations)}
+        self.masks = {
+            node: sum(bits[m] for m in node.mutations)
+            for node in tree.traverse()
+        }
+        # Nodes whose children changed since mutations were last pushed up
+        self.pending = set(self.masks)
+        # Nodes whose parent or mask changed since parent mutations were
+        # last removed
+        self.moved = set(self.masks)
+        # Nodes whose children share no mutations at any depth
+        self.clean = set()
+        self.changes = 0
+
+    def _removed(self, node):
+        return node.up is None and node is not self.tree
+
+    def _invalidate(self, nodes, stop=None):
+        seen = set()
+        for node in nodes:
+            while node is not None and node is not stop and node not in seen:
+                seen.add(node)
+                self.clean.discard(node)
+                node = node.up
+
+    def _push(self, node, first):
+        if node.is_leaf() or len(node.seq_ids) > 0:
+            return False
+        common = functools.reduce(
+            operator.and_, (self.masks[c] for c in node.children))
+        if first:
+            mask = common or self.masks[node]
         else:
-            common_muts = common_muts.intersection(child_muts)
+            mask = common | self.masks[node]
+        if mask == self.masks[node]:
+            return False
+        self.masks[node] = mask
+        return True
 
-    if len(tree.seq_ids) == 0:
+    def push_common_mutations_up(self, first):
+        """Adds the mutations shared by all children of each unobserved
+        internal node to that node.  On the first pass, the node's mutations
+        are replaced instead if any are shared.
+
+        After the first pass masks only grow, so nodes are revisited until
+        nothing changes rather than strictly in postorder.
+
+        """
+        changed = set()
         if first:
-            tree.mutations = common_muts or tree.mutations
+            for node in self.tree.traverse(strategy='postorder'):
+                if self._push(node, first):
+                    changed.add(node)
         else:
-            tree.mutations = common_muts.union(tree.mutations)
+            stack = list(self.pending)
+            while stack:
+                node = stack.pop()
+                if not self._removed(node) and self._push(node, first):
+                    changed.add(node)
+                    if node.up is not None:
+                        stack.append(node.up)
+        self.pending = set()
+
+        for node in changed:
+            self.moved.add(node)
+            self.moved.update(node.children)
+        self._invalidate(changed)
+
+    def remove_parent_mutations(self):
+        """Removes mutations from each node which its parent also has.
+
+        :returns: The nodes left without mutations
+        :rtype: set
+
+        """
+        updates = {}
+        nulls = set()
+        for node in self.moved:
+            if node.up is None:
+                continue
+            mask = self.masks[node] & ~self.masks[node.up]
+            if mask != self.masks[node]:
+                updates[node] = mask
+            if mask == 0:
+                nulls.add(node)
+        self.moved = set()
+
+        self.masks.update(updates)
+        for node in updates:
+            self.pending.add(node.up)
+        self._invalidate(updates)
+        return nulls
+
+    def remove_null_nodes(self, nulls):
+        """Merges nodes without mutations into their parents.  Nodes are
+        merged in level order below their nearest ancestor with mutations;
+        merges below different ancestors do not affect each other.
+
+        :param set nulls: The nodes without mutations
+
+        :returns: If any nodes were removed
+        :rtype: bool
 
-    return tree.mutations
+        """
+        # The nearest ancestor with mutations and the path of child indices
+        # from it for each node
+        paths = {}
+        for node in nulls:
+            chain = []
+            while node in nulls and node not in paths:
+                chain.append(node)
+                node = node.up
+            ancestor, path = paths.get(node, (node, ()))
+            for node in reversed(chain):
+                path += (node.up.children.index(node),)
+                paths[node] = (ancestor, path)
 
+        groups = {}
+        for node, (ancestor, path) in paths.items():
+            groups.setdefault(ancestor, []).append((len(path), path, node))
 
-def remove_parent_mutations(tree):
-    for node in tree.traverse(strategy='postorder'):
-        if node.up is not None and node.up.name != 'germline':
-            node.mutations = node.mutations.difference(node.up.mutations)
+        parents = []
+        for group in groups.values():
+            for _, _, node in sorted(group, key=lambda g: g[:2]):
+                node.up.seq_ids.update(node.seq_ids)
+                node.up.copy_number += node.copy_number
+                parents.append(node.up)
+                self.pending.add(node.up)
+                self.moved.update(node.children)
+                node.delete(prevent_nondicotomic=False)
+        self._invalidate(parents)
+        return len(nulls) > 0
 
+    def check_supersets(self):
+        """Groups siblings which share mutations under an intermediate node.
 
-def remove_null_nodes(tree):
-    removed = False
-    for node in tree.traverse():
-        if node.up is not None and len(node.mutations) == 0:
-            node.up.seq_ids.update(node.seq_ids)
-            node.up.copy_number += node.copy_number
-            node.delete(prevent_nondicotomic=False)
-            removed = True
-    return removed
+        :returns: If any node was moved under a sibling
+        :rtype: bool
 
+        """
+        if self.tree in self.clean:
+            return False
+        return self._check_supersets(self.tree)
 
-def check_supersets(tree):
-    if tree.is_leaf():
-        return False
+    def _detach(self, child, tree, counts):
+        parent = child.up
+        if parent is tree:
+            for bit in _bits(self.masks[child]):
+                counts[bit] -= 1
+        if parent is not None:
+            self.pending.add(parent)
+            self._invalidate([parent], tree)
+        child.detach()
+        self.changes += 1
 
-    moved = False
-    for c1 in tree.children:
-        for c2 in tree.children:
-            if c1 == c2:
+    def _attach(self, parent, child, tree, counts):
+        parent.add_child(child)
+        if parent is tree:
+            for bit in _bits(self.masks[child]):
+                counts[bit] = counts.get(bit, 0) + 1
+        self.pending.add(parent)
+        self.moved.add(child)
+        self._invalidate([parent], tree)
+        self.changes += 1
+
+    def _check_supersets(self, tree):
+        if tree.is_leaf():
+            return False
+
+        changes = self.changes
+        # The number of children with each mutation
+        counts = {}
+        for child in tree.children:
+            for bit in _bits(self.masks[child]):
+                counts[bit] = counts.get(bit, 0) + 1
+
+        moved = False
+        for c1 in tree.children:
+            if self.masks[c1] and all(
+                    counts[bit] < 2 for bit in _bits(self.masks[c1])):
+                # No sibling shares a mutation with c1 so only its own
+                # subtree can change
+                for _ in range(len(tree.children) - 1):
+                    if moved or c1 in self.clean:
+                        break
+                    moved = self._check_supersets(c1)
                 continue
-            if c1.mutations.issubset(c2.mutations):
-                c1.detach()
-                c2.add_child(c1)
-                moved = True
-            elif c2.mutations.issubset(c1.mutations):
-                c2.detach()
-                c1.add_child(c2)
-                moved = True
-
-            overlap = c1.mutations.intersection(c2.mutations)
-            if len(overlap) > 0:
-                c1.detach()
-                c2.detach()
-                intermediate = instantiate_node(ete3.Tree(name='NoName'))
-                intermediate.mutations = overlap
-                intermediate.add_child(c1)
-                intermediate.add_child(c2)
-                tree.add_child(intermediate)
-            moved = moved or check_supersets(c1)
-
-    return moved
-
-
-def are_null_nodes(tree):
-    for node in tree.traverse():
-        if node.up is not None and len(node.mutations) == 0:
-            return True
-    return False
+
+            for c2 in tree.children:
+                if c1 == c2:
+                    continue
+                m1, m2 = self.masks[c1], self.masks[c2]
+                if m1 & m2 == m1:
+                    self._detach(c1, tree, counts)
+                    self._attach(c2, c1, tree, counts)
+                    moved = True
+                elif m1 & m2 == m2:
+                    self._detach(c2, tree, counts)
+                    self._attach(c1, c2, tree, counts)
+                    moved = True
+
+                overlap = m1 & m2
+                if overlap:
+                    self._detach(c1, tree, counts)
+                    self._detach(c2, tree, counts)
+                    intermediate = instantiate_node(ete3.Tree(name='NoName'))
+                    self.masks[intermediate] = overlap
+                    self._attach(intermediate, c1, tree, counts)
+                    self._attach(intermediate, c2, tree, counts)
+                    self._attach(tree, intermediate, tree, counts)
+                if not moved and c1 not in self.clean:
+                    moved = self._check_supersets(c1)
+
+        if self.changes == changes:
+            self.clean.add(tree)
+        return moved
+
+    def apply(self):
+        """Sets the ``mutations`` of each node from its bitset."""
+        for node in self.tree.traverse():
+            node.mutations = set(
+                self.mutations[bit.bit_length() - 1]
+                for bit in _bits(self.masks[node])
+            )
+
+
+def minimize_tree(tree, max_iterations=None):
+    """Roots a tree at its germline and removes redundant nodes and
+    mutations so each mutation appears once.
+
+    :param ete3.Tree tree: The tree with a node named ``germline``
+    :param int max_iterations: The maximum number of passes to make over the
+        tree.  Defaults to the number of nodes in the tree.
+
+    :returns: The minimized tree
+    :rtype: ete3.Tree
+
+    """
+    start = time.time()
+    tree.set_outgroup('germline')
+    tree.search_nodes(name='germline')[0].delete()
+
+    minimizer = TreeMinimizer(tree)
+    if max_iterations is None:
+        max_iterations = len(minimizer.masks)
+    timings = {'push': 0, 'parent': 0, 'null': 0, 'supersets': 0}
+    for iteration in range(max_iterations):
+        step = time.time()
+        minimizer.push_common_mutations_up(iteration == 0)
+        timings['push'] += time.time() - step
+
+        step = time.time()
+        nulls = minimizer.remove_parent_mutations()
+        timings['parent'] += time.time() - step
+
+        step = time.time()
+        rem_null = minimizer.remove_null_nodes(nulls)
+        timings['null'] += time.time() - step
+
+        step = time.time()
+        moved = minimizer.check_supersets()
+        timings['supersets'] += time.time() - step
+        if not rem_null and not moved:
+            break
+    else:
+        logger.warning('Tree did not converge after {} iterations'.format(
+            max_iterations))
+    minimizer.apply()
+
+    logger.debug('Minimized tree in {} iterations and {}s ({})'.format(
+        iteration + 1, round(time.time() - start, 2),
+        ', '.join('{} {}s'.format(k, round(v, 2))
+                  for k, v in sorted(timings.items()))))
+    return tree
 
 
 def run_clearcut(session, args):
@@ -120,6 +344,16 @@ def run_clearcut(session, args):
         else:
             clones = session.query(Clone.id)
 
+    dirty_clones = dirty.get_dirty(session, 'clone_tree',
+                                   [c.id for c in clones])
+    if len(dirty_clones) > 0:
+        logger.info('Removing trees of {} changed clones'.format(
+            len(dirty_clones)))
+        for chunk in dirty.id_chunks(dirty_clones):
+            session.query(Clone).filter(
+                Clone.id.in_(chunk)
+            ).update({Clone.tree: None}, synchronize_session=False)
+        session.commit()
     if not args.force:
         clones = clones.filter(Clone.tree.is_(None))
     clones = [c.id for c in clones]
@@ -133,14 +367,22 @@ def run_clearcut(session, args):
         tasks.add_task(clone_id)
 
     for _ in range(0, args.nproc):
-        session = config.init_db(args.db_config)
         tasks.add_worker(LineageWorker(
-            session, get_newick,
+            config.init_db(args.db_config),
+            NEWICK_GENERATORS[args.tree_method],
             args.min_mut_copies, args.min_mut_samples,
             args.min_seq_copies,
             args.min_seq_samples,
             args.exclude_stops,
             args.full_seq,
-            post_tree_hook=minimize_tree))
+            post_tree_hook=minimize_tree,
+            max_seqs=args.max_tree_seqs,
+            compact=args.compact_trees))
 
     tasks.start()
+    dirty.clear(session, 'clone_tree', dirty_clones, [
+        c.id for c in dirty.query_in(
+            session.query(Clone.id).filter(~Clone.tree.is_(None)),
+            Clone.id, dirty_clones
+        )
+    ])
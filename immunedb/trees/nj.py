@@ -0,0 +1,135 @@
+import numpy as np
+
+import immunedb.util.distance as distance
+
+
+def parse_fasta(fasta_input):
+    """Parses FASTA text, as generated by :py:func:`get_fasta_input`, into
+    parallel lists of names and sequences.
+
+    :param str fasta_input: The FASTA text
+
+    :returns: A tuple of the sequence names and sequences
+    :rtype: tuple
+
+    """
+    names = []
+    seqs = []
+    for record in fasta_input.split('>')[1:]:
+        name, seq = record.split('\n', 1)
+        names.append(name.strip())
+        seqs.append(seq.replace('\n', ''))
+    return names, seqs
+
+
+def get_distances(encoded):
+    """Gets the pairwise proportion of differing bases between sequences,
+    ignoring positions where either sequence has a gap or ``N``.
+
+    :param numpy.ndarray encoded: Sequences encoded with
+        :py:func:`immunedb.util.distance.encode`
+
+    :returns: A symmetric distance matrix
+    :rtype: numpy.ndarray
+
+    """
+    mismatches = distance.pairwise(encoded, encoded).astype(np.float64)
+    valid = (encoded != distance.WILDCARD).astype(np.float64)
+    compared = valid.dot(valid.T)
+    return np.divide(mismatches, compared, out=np.zeros_like(mismatches),
+                     where=compared > 0)
+
+
+def _relaxed_pair(dists, row_sums, size):
+    """Finds a pair of nodes which minimize each other's row of the
+    neighbor-joining Q matrix without computing the full matrix."""
+    def best(i):
+        q = (size - 2) * dists[i, :size] - row_sums[:size]
+        q[i] = np.inf
+        return int(np.argmin(q))
+
+    i = 0
+    j = best(i)
+    for _ in range(size):
+        k = best(j)
+        if k == i:
+            break
+        i, j = j, k
+    return i, j
+
+
+def neighbor_join(dists, names, relaxed=False):
+    """Builds a tree with neighbor-joining.
+
+    :param numpy.ndarray dists: A symmetric distance matrix
+    :param list names: The name of each row of ``dists``
+    :param bool relaxed: If set, joins the first pair of nodes found to be
+        mutual nearest neighbors rather than the global best pair, which
+        avoids computing the full Q matrix at every step
+
+    :returns: The tree in newick format
+    :rtype: str
+
+    """
+    dists = np.array(dists, dtype=np.float64)
+    nodes = [str(n) for n in names]
+    size = len(nodes)
+    if size == 0:
+        return ''
+    elif size == 1:
+        return '{};'.format(nodes[0])
+
+    row_sums = dists.sum(axis=1)
+    while size > 2:
+        if relaxed:
+            i, j = _relaxed_pair(dists, row_sums, size)
+        else:
+            q = ((size - 2) * dists[:size, :size] - row_sums[:size, None] -
+                 row_sums[None, :size])
+            np.fill_diagonal(q, np.inf)
+            i, j = np.unravel_index(np.argmin(q), q.shape)
+        i, j = min(i, j), max(i, j)
+
+        d_ij = dists[i, j]
+        len_i = max(0, .5 * d_ij + (row_sums[i] - row_sums[j]) /
+                    (2 * (size - 2)))
+        len_j = max(0, d_ij - len_i)
+        joined = .5 * (dists[i, :size] + dists[j, :size] - d_ij)
+        joined[i] = 0
+
+        # Replace i with the new node and move the last node into j
+        row_sums[:size] += joined - dists[i, :size] - dists[j, :size]
+        dists[i, :size] = joined
+        dists[:size, i] = joined
+        row_sums[i] = joined.sum()
+        nodes[i] = '({}:{:.6f},{}:{:.6f})'.format(nodes[i], len_i,
+                                                  nodes[j], len_j)
+        last = size - 1
+        if j != last:
+            dists[j, :size] = dists[last, :size]
+            dists[:size, j] = dists[:size, last]
+            dists[j, j] = 0
+            row_sums[j] = row_sums[last]
+            nodes[j] = nodes[last]
+        size = last
+
+    half = dists[0, 1] / 2
+    return '({}:{:.6f},{}:{:.6f});'.format(nodes[0], half, nodes[1], half)
+
+
+def get_newick(fasta_input, relaxed=False):
+    """Generates a newick tree for FASTA input in-process.  This can be used in
+    place of :py:func:`immunedb.trees.clearcut.get_newick`.
+
+    :param str fasta_input: The aligned FASTA sequences
+    :param bool relaxed: If set, uses relaxed neighbor-joining
+
+    :returns: The tree in newick format
+    :rtype: str
+
+    """
+    names, seqs = parse_fasta(fasta_input)
+    if len(seqs) < 2:
+        return ''
+    return neighbor_join(get_distances(distance.encode(seqs, wildcards='N-')),
+                         names, relaxed=relaxed)
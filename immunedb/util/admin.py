@@ -9,6 +9,7 @@ import string
 import subprocess
 
 import immunedb.common.config as config
+import immunedb.common.mutations as mutations
 from immunedb.util.log import logger
 
 
@@ -168,3 +169,10 @@ def restore(main_parser, args):
         if stderr:
             logger.warning(stderr)
     return True
+
+
+def convert_mutations(main_parser, args):
+    session = config.init_db(args.db_config)
+    mutations.convert_mutations(session, compact=args.to == 'compact')
+    session.close()
+    return True
@@ -0,0 +1,146 @@
+import numpy as np
+
+# Characters which match any other character, mirroring ``dnautils.hamming``
+# (``N`` and ``-``) plus ``X`` which is used for unknown amino-acids.
+WILDCARDS = 'NX-'
+# ``N`` is asparagine in amino-acid sequences, so only ``X`` and gaps match
+# any residue.
+NT_WILDCARDS = 'N-'
+AA_WILDCARDS = 'X-'
+WILDCARD = 0
+# The approximate number of bytes of temporary mismatch arrays to allocate
+# when comparing many sequences to many others.
+MAX_CHUNK_BYTES = 2 ** 26
+
+
+def encode(seqs, wildcards=WILDCARDS):
+    """Packs a list of equal-length strings into a 2-D ``uint8`` array with
+    one row per string.  Wildcard characters are encoded as ``WILDCARD``.
+
+    :param list seqs: The equal-length strings to encode
+    :param str wildcards: Characters which match any other character
+
+    :returns: An array of shape ``(len(seqs), length)``
+    :rtype: numpy.ndarray
+
+    """
+    if len(seqs) == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    length = len(seqs[0])
+    if any(len(s) != length for s in seqs):
+        raise ValueError('Sequences have unequal lengths.')
+    encoded = np.frombuffer(
+        ''.join(seqs).encode('ascii'), dtype=np.uint8
+    ).reshape(len(seqs), length).copy()
+    encoded[np.isin(encoded, list(wildcards.encode('ascii')))] = WILDCARD
+    return encoded
+
+
+def hamming_to_many(seq, others):
+    """Gets the hamming distance between one encoded sequence and many others,
+    ignoring positions where either has a wildcard.
+
+    :param numpy.ndarray seq: A single encoded sequence
+    :param numpy.ndarray others: A 2-D array of encoded sequences
+
+    :returns: The distance from ``seq`` to each row of ``others``
+    :rtype: numpy.ndarray
+
+    """
+    mismatches = (others != seq) & (others != WILDCARD)
+    mismatches &= (seq != WILDCARD)
+    return mismatches.sum(axis=1)
+
+
+def level_wildcards(level):
+    """Gets the wildcard characters for CDR3s at a given level.
+
+    :param str level: Either ``aa`` or ``nt``
+
+    :returns: The characters which match any other character
+    :rtype: str
+
+    """
+    return AA_WILDCARDS if level == 'aa' else NT_WILDCARDS
+
+
+def iter_pairwise(seqs, others, max_bytes=MAX_CHUNK_BYTES):
+    """Iterates over the hamming distances between every pair of rows in
+    ``seqs`` and ``others`` in chunks of rows from ``seqs`` so that no more
+    than roughly ``max_bytes`` of temporary memory is used at once.
+
+    :param numpy.ndarray seqs: A 2-D array of encoded sequences
+    :param numpy.ndarray others: A 2-D array of encoded sequences
+    :param int max_bytes: The approximate memory limit for each chunk
+
+    :returns: Tuples of ``(offset, distances)`` where ``distances`` has one
+        row for each of ``seqs[offset:offset + len(distances)]`` and one
+        column for each row of ``others``
+    :rtype: generator
+
+    """
+    row_bytes = max(1, others.shape[0] * others.shape[1])
+    chunk_size = max(1, max_bytes // row_bytes)
+    others_wild = others == WILDCARD
+    for offset in range(0, seqs.shape[0], chunk_size):
+        chunk = seqs[offset:offset + chunk_size, np.newaxis, :]
+        mismatches = chunk != others
+        mismatches &= chunk != WILDCARD
+        mismatches &= ~others_wild
+        yield offset, mismatches.sum(axis=2)
+
+
+def pairwise(seqs, others, max_bytes=MAX_CHUNK_BYTES):
+    """Gets the hamming distance between every pair of rows in ``seqs`` and
+    ``others``.
+
+    :param numpy.ndarray seqs: A 2-D array of encoded sequences
+    :param numpy.ndarray others: A 2-D array of encoded sequences
+    :param int max_bytes: The approximate memory limit for each chunk
+
+    :returns: A ``(len(seqs), len(others))`` matrix of distances
+    :rtype: numpy.ndarray
+
+    """
+    dists = np.zeros((seqs.shape[0], others.shape[0]), dtype=np.int64)
+    for offset, chunk in iter_pairwise(seqs, others, max_bytes):
+        dists[offset:offset + chunk.shape[0]] = chunk
+    return dists
+
+
+def all_within(seqs, others, max_dist, max_bytes=MAX_CHUNK_BYTES):
+    """Determines if every row of ``seqs`` is within ``max_dist`` of every
+    row of ``others``, stopping at the first chunk with a failing pair.
+
+    :param numpy.ndarray seqs: A 2-D array of encoded sequences
+    :param numpy.ndarray others: A 2-D array of encoded sequences
+    :param int max_dist: The maximum allowed distance
+    :param int max_bytes: The approximate memory limit for each chunk
+
+    :returns: If all pairs are within ``max_dist``
+    :rtype: bool
+
+    """
+    for _, chunk in iter_pairwise(seqs, others, max_bytes):
+        if (chunk > max_dist).any():
+            return False
+    return True
+
+
+def max_distance(norm_len, min_similarity):
+    """Gets the largest hamming distance for which
+    ``1 - dist / norm_len >= min_similarity``, evaluated exactly as the
+    pairwise similarity checks do.
+
+    :param int norm_len: The length by which distances are normalized
+    :param float min_similarity: Minimum fraction to be considered similar
+
+    :returns: The maximum allowed distance or -1 if none is allowed
+    :rtype: int
+
+    """
+    allowed = -1
+    for dist in range(0, norm_len + 1):
+        if 1 - dist / norm_len >= min_similarity:
+            allowed = dist
+    return allowed
@@ -1,8 +1,8 @@
-from collections import Counter
 import itertools
 import re
 
 import dnautils
+import numpy as np
 
 
 def chunks(l, n):
@@ -39,7 +39,8 @@ def flatten(iterable):
 
 
 def consensus(strings):
-    """Gets the unweighted consensus from a list of strings
+    """Gets the unweighted consensus from a list of strings.  Ties are broken
+    in favor of the character which appears in the earliest string.
 
     :param list strings: A set of equal-length strings.
 
@@ -47,8 +48,23 @@ def consensus(strings):
     :rtype: str
 
     """
-    chrs = [Counter(chars).most_common(1)[0][0] for chars in zip(*strings)]
-    return ''.join(chrs)
+    if len(strings) == 0:
+        return ''
+    length = min(len(s) for s in strings)
+    chars = np.frombuffer(
+        ''.join(s[:length] for s in strings).encode('ascii'), dtype=np.uint8
+    ).reshape(len(strings), length)
+    cols = np.broadcast_to(np.arange(length), chars.shape)
+    rows = np.broadcast_to(np.arange(len(strings))[:, np.newaxis],
+                           chars.shape)
+
+    counts = np.zeros((length, 256), dtype=np.int64)
+    np.add.at(counts, (cols, chars), 1)
+    first_seen = np.full((length, 256), len(strings), dtype=np.int64)
+    np.minimum.at(first_seen, (cols, chars), rows)
+
+    best = np.argmax(counts * (len(strings) + 1) - first_seen, axis=1)
+    return best.astype(np.uint8).tobytes().decode('ascii')
 
 
 def get_regions(insertions):
@@ -103,6 +103,7 @@ class BaseTest(object):
             self.sample_stats()
             self.trees()
             self.selection()
+            self.native_selection()
 
         def initial_regression(self):
             self.regression(
@@ -172,7 +173,8 @@ class BaseTest(object):
             run_collapse(
                 self.session,
                 NamespaceMimic(
-                    subject_ids=None
+                    subject_ids=None,
+                    incremental=False
                 )
             )
             self.session.commit()
@@ -230,7 +232,8 @@ class BaseTest(object):
                 NamespaceMimic(
                     clone_ids=None,
                     subject_ids=None,
-                    regen=False
+                    regen=False,
+                    compact_mutations=False
                 )
             )
             self.session.commit()
@@ -257,7 +260,9 @@ class BaseTest(object):
                 self.session,
                 NamespaceMimic(
                     sample_ids=None,
-                    force=False
+                    force=False,
+                    sql_aggregation=False,
+                    store_bins=False
                 )
             )
             self.session.commit()
@@ -284,7 +289,10 @@ class BaseTest(object):
                     min_count=1,
                     min_seq_copies=0,
                     min_samples=1,
-                    exclude_stops=False
+                    exclude_stops=False,
+                    tree_method='clearcut',
+                    max_tree_seqs=None,
+                    compact_trees=False
                 )
             )
             self.session.commit()
@@ -314,6 +322,9 @@ class BaseTest(object):
                     regen=False,
                     temp='/tmp',
                     thresholds=['1', '2', '85%'],
+                    batch_size=50,
+                    method='baseline',
+                    no_cache=False,
                 )
             )
             self.session.commit()
@@ -329,6 +340,51 @@ class BaseTest(object):
                  'sigma_cdr_ciupper', 'sigma_p_fwr', 'sigma_p_cdr')
             )
 
+        def native_selection(self):
+            run_selection_pressure(
+                self.session,
+                NamespaceMimic(
+                    baseline_path=None,
+                    clone_ids=range(1, 6),
+                    subject_ids=None,
+                    regen=True,
+                    temp='/tmp',
+                    thresholds=['1', '2', '85%'],
+                    batch_size=50,
+                    method='native',
+                    no_cache=False,
+                )
+            )
+            self.session.commit()
+
+            # The stored results are from BASELINe, which rounds expected
+            # frequencies and statistics to three decimals.  Its credible
+            # intervals are slightly wider than the native ones, by up to
+            # 0.02.
+            path = self.get_path('selection_pressure.json')
+            with open(path) as fh:
+                checks = json.load(fh)
+            key = ('clone_id', 'sample_id', 'threshold')
+            keys = set([])
+            for record in self.session.query(SelectionPressure):
+                agg_key = self.get_key(record, key)
+                keys.add(agg_key)
+                self.assertIn(agg_key, checks)
+                for fld, value in checks[agg_key].items():
+                    if fld.startswith('observed'):
+                        delta = 0
+                    elif fld.startswith('expected'):
+                        delta = .001
+                    elif fld.endswith(('cilower', 'ciupper')):
+                        delta = .03
+                    else:
+                        delta = .005
+                    self.assertAlmostEqual(
+                        getattr(record, fld), value, delta=delta,
+                        msg=self.err(path, key, agg_key, fld, value,
+                                     getattr(record, fld)))
+            self.assertEqual(set(checks.keys()), keys)
+
 
 class NamespaceMimic(object):
     def __init__(self, **kwargs):
@@ -20,6 +20,14 @@ fi
 setup
 coverage erase
 coverage run --source=immunedb -p -m nose tests/tests_parser.py
+coverage run --source=immunedb -p -m nose tests/tests_distance.py
+coverage run --source=immunedb -p -m nose tests/tests_nj.py
+coverage run --source=immunedb -p -m nose tests/tests_minimize.py
+coverage run --source=immunedb -p -m nose tests/tests_tree_sampling.py
+coverage run --source=immunedb -p -m nose tests/tests_tree_storage.py
+coverage run --source=immunedb -p -m nose tests/tests_mutations.py
+coverage run --source=immunedb -p -m nose tests/tests_focused_selection.py
+coverage run --source=immunedb -p -m nose tests/tests_baseline.py
 coverage run --source=immunedb -p -m nose tests/tests_import.py
 coverage run --source=immunedb -p -m nose tests/tests_pipeline.py
 coverage run --source=immunedb -p -m nose tests/run_server.py &
@@ -99,3 +99,9 @@ class ApiTest(unittest.TestCase):
             'order_field': 'id',
             'order_dir': 'desc'
         })
+
+    def test_invalid_lineage_nodes(self):
+        for node_ids in (['a'], [None], 5):
+            response = self.request('/clone/lineage/1/nodes',
+                                    {'node_ids': node_ids})
+            self.assertEqual(response.status_code, 400, node_ids)
@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import immunedb.common.baseline as baseline
+
+
+class BaselineCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.script_dir = tempfile.mkdtemp()
+        self.script_path = os.path.join(self.script_dir, 'Baseline_Main.r')
+        for fn in ('Baseline_Main.r', 'Baseline_Functions.r'):
+            with open(os.path.join(self.script_dir, fn), 'w') as fh:
+                fh.write('# {}\n'.format(fn))
+
+    def tearDown(self):
+        shutil.rmtree(self.script_dir)
+
+    def test_script_identity(self):
+        identity = baseline.get_script_identity(self.script_path)
+        self.assertEqual(identity['path'], self.script_path)
+
+        # Files other than R scripts are ignored
+        with open(os.path.join(self.script_dir, 'output.txt'), 'w') as fh:
+            fh.write('output')
+        self.assertEqual(baseline.get_script_identity(self.script_path),
+                         identity)
+
+        # Changes to the functions BASELINe loads change the identity
+        with open(os.path.join(self.script_dir, 'Baseline_Functions.r'),
+                  'a') as fh:
+            fh.write('# changed\n')
+        self.assertNotEqual(
+            baseline.get_script_identity(self.script_path)['sha256'],
+            identity['sha256'])
+
+    def test_input_hash(self):
+        args = ('ACGT', ['ACGA', 'ACGC'], baseline.get_boundaries(30))
+        native = {'method': 'native'}
+        script = {'method': 'baseline',
+                  'script': baseline.get_script_identity(self.script_path)}
+
+        # The order of sequences is ignored
+        self.assertEqual(
+            baseline.get_input_hash(native, *args),
+            baseline.get_input_hash(native, 'ACGT', ['ACGC', 'ACGA'],
+                                    baseline.get_boundaries(30)))
+        self.assertNotEqual(baseline.get_input_hash(native, *args),
+                            baseline.get_input_hash(script, *args))
+
+        with open(self.script_path, 'a') as fh:
+            fh.write('# changed\n')
+        changed = dict(script, script=baseline.get_script_identity(
+            self.script_path))
+        self.assertNotEqual(baseline.get_input_hash(script, *args),
+                            baseline.get_input_hash(changed, *args))
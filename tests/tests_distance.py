@@ -0,0 +1,134 @@
+import random
+import unittest
+
+import numpy as np
+
+from immunedb.aggregation.similarity import (GreedySimilarityClusterer,
+                                             PigeonholeIndex,
+                                             SingleLinkageClusterer)
+import immunedb.util.distance as distance
+
+
+def hamming(s1, s2):
+    return sum(1 for a, b in zip(s1, s2)
+               if a != b and a not in 'NX-' and b not in 'NX-')
+
+
+class DistanceTest(unittest.TestCase):
+    def setUp(self):
+        rand = random.Random(0)
+        self.seqs = [''.join(rand.choice('ACGTNX-') for _ in range(12))
+                     for _ in range(40)]
+
+    def test_encode_unequal(self):
+        with self.assertRaises(ValueError):
+            distance.encode(['ACGT', 'ACG'])
+
+    def test_hamming_to_many(self):
+        encoded = distance.encode(self.seqs)
+        dists = distance.hamming_to_many(encoded[0], encoded)
+        self.assertEqual(
+            list(dists), [hamming(self.seqs[0], s) for s in self.seqs])
+
+    def test_pairwise_chunked(self):
+        encoded = distance.encode(self.seqs)
+        full = distance.pairwise(encoded, encoded)
+        chunked = distance.pairwise(encoded, encoded, max_bytes=1)
+        self.assertTrue(np.array_equal(full, chunked))
+        for i, s1 in enumerate(self.seqs):
+            for j, s2 in enumerate(self.seqs):
+                self.assertEqual(full[i, j], hamming(s1, s2))
+
+    def test_max_distance(self):
+        self.assertEqual(distance.max_distance(20, .85), 3)
+        self.assertEqual(distance.max_distance(20, 1), 0)
+
+    def test_greedy_clusterer(self):
+        rand = random.Random(1)
+        bases = [''.join(rand.choice('ACDN') for _ in range(10))
+                 for _ in range(4)]
+        cdr3s = []
+        for _ in range(60):
+            seq = list(rand.choice(bases))
+            seq[rand.randrange(10)] = rand.choice('ACDN')
+            cdr3s.append(''.join(seq))
+
+        clones = []
+        expected = []
+        for i, cdr3 in enumerate(cdr3s):
+            for k, members in enumerate(clones):
+                if all(1 - hamming(cdr3s[m], cdr3) / 10 >= .8
+                       for m in members):
+                    members.append(i)
+                    expected.append(k)
+                    break
+            else:
+                clones.append([i])
+                expected.append(len(clones) - 1)
+
+        clusterer = GreedySimilarityClusterer(cdr3s, 10, .8)
+        found = []
+        for i in range(len(cdr3s)):
+            clone = clusterer.assign(i)
+            if clone is None:
+                clone = clusterer.add_clone([i])
+            found.append(clone)
+        self.assertEqual(found, expected)
+
+    def test_single_linkage_clusterer(self):
+        rand = random.Random(2)
+        bases = [''.join(rand.choice('ACDN') for _ in range(10))
+                 for _ in range(5)]
+        cdr3s = []
+        for _ in range(80):
+            seq = list(rand.choice(bases))
+            for _ in range(rand.randrange(3)):
+                seq[rand.randrange(10)] = rand.choice('ACDN')
+            cdr3s.append(''.join(seq))
+
+        labels = list(range(len(cdr3s)))
+        for i, s1 in enumerate(cdr3s):
+            for j, s2 in enumerate(cdr3s):
+                if 1 - hamming(s1, s2) / 10 >= .8:
+                    old = labels[j]
+                    labels = [labels[i] if e == old else e for e in labels]
+        expected = []
+        for label in labels:
+            if label not in expected:
+                expected.append(label)
+        expected = [expected.index(e) for e in labels]
+
+        found = SingleLinkageClusterer(cdr3s, 10, .8).cluster()
+        self.assertEqual(list(found), expected)
+
+    def test_pigeonhole_candidates(self):
+        rand = random.Random(3)
+        for _ in range(200):
+            length = rand.randint(4, 12)
+            max_dist = rand.randint(0, 3)
+            seqs = distance.encode([
+                ''.join(rand.choice('ACNX-') for _ in range(length))
+                for _ in range(30)
+            ])
+            index = PigeonholeIndex(length, max_dist)
+            for i, seq in enumerate(seqs):
+                candidates = set(index.candidates(seq))
+                index.add(seq)
+                dists = distance.hamming_to_many(seq, seqs[:i])
+                for j in range(i):
+                    if dists[j] <= max_dist:
+                        self.assertIn(j, candidates)
+
+    def test_aa_wildcards(self):
+        encoded = distance.encode(['CNR', 'CDR'],
+                                  wildcards=distance.level_wildcards('aa'))
+        self.assertEqual(list(distance.hamming_to_many(encoded[0], encoded)),
+                         [0, 1])
+        clusterer = SingleLinkageClusterer(['CNRW', 'CDRW'], 4, 1,
+                                           wildcards=distance.AA_WILDCARDS)
+        self.assertEqual(list(clusterer.cluster()), [0, 1])
+
+        # The similarity method keeps treating N as a wildcard
+        clusterer = GreedySimilarityClusterer(['CNRW', 'CDRW'], 4, 1)
+        clusterer.add_clone([0])
+        self.assertEqual(clusterer.assign(1), 0)
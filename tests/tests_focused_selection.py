@@ -0,0 +1,162 @@
+import json
+import unittest
+
+import numpy as np
+
+from immunedb.common.baseline import get_boundaries
+import immunedb.common.focused_selection as focused_selection
+from immunedb.common.models import Clone
+
+
+class FocusedSelectionTest(unittest.TestCase):
+    def test_regions(self):
+        self.assertEqual(
+            focused_selection.get_codon_regions([1, 2, 4], 5),
+            ['FWR', 'FWR', 'CDR', 'CDR', None])
+
+    def test_observed(self):
+        # GAA -> E, TTT -> F, AAA -> K, GGG -> G
+        germline = 'GAATTTAAAGGG'
+        regions = focused_selection.get_codon_regions([1, 2, 4], 4)
+        observed = focused_selection.get_observed(germline, [
+            # GAG (E) is silent and shared, so only counted once
+            'GAGTTTAAAGGG',
+            'GAGTTTAAAGGG',
+            # ACA (T) is a replacement and GGA (G) is silent
+            'GAATTTACAGGA',
+        ], regions)
+        self.assertEqual(observed, {
+            ('FWR', 'R'): 0, ('FWR', 'S'): 1,
+            ('CDR', 'R'): 1, ('CDR', 'S'): 1,
+        })
+
+        expected = focused_selection.get_expected(germline, [germline],
+                                                  regions)
+        self.assertAlmostEqual(sum(expected.values()), 1)
+
+    def test_expected_coverage(self):
+        # AAA (K) has two replacements and a stop at its first position,
+        # three replacements at its second, and two replacements and a
+        # silent mutation at its third.  GGG (G) has three replacements at
+        # each of its first two positions and three silent mutations at its
+        # third.
+        germline = 'AAAGGG'
+        regions = focused_selection.get_codon_regions([1, 1, 2], 2)
+        self.assertEqual(
+            focused_selection.get_expected(germline, ['AAAGGG'], regions),
+            {('FWR', 'R'): 7 / 17, ('FWR', 'S'): 1 / 17,
+             ('CDR', 'R'): 6 / 17, ('CDR', 'S'): 3 / 17})
+        # Positions without a base in any sequence are excluded
+        self.assertEqual(
+            focused_selection.get_expected(
+                germline, ['NNAGGN', '-AAGG-'], regions),
+            {('FWR', 'R'): 5 / 12, ('FWR', 'S'): 1 / 12,
+             ('CDR', 'R'): 6 / 12, ('CDR', 'S'): 0})
+        self.assertIsNone(
+            focused_selection.get_expected(germline, ['NNN---'], regions))
+
+    def test_focused(self):
+        # With observed mutations in the expected proportions there is no
+        # selection
+        sigma, lower, upper, p = focused_selection.focused_test(
+            200, 100, .5, .25)
+        self.assertAlmostEqual(sigma, 0, places=1)
+        self.assertTrue(lower < 0 < upper)
+        self.assertTrue(abs(p) > .4)
+
+        sigma, lower, upper, p = focused_selection.focused_test(
+            100, 10, .5, .25)
+        self.assertTrue(0 < lower < sigma < upper)
+        self.assertTrue(p < .001)
+
+        self.assertEqual(focused_selection.focused_test(0, 0, .5, .25),
+                         (None, None, None, None))
+
+    def test_matches_baseline(self):
+        # Results from BASELINe stored by the pipeline regression test
+        with open('tests/data/regression/pipeline/'
+                  'selection_pressure.json') as fh:
+            expected = json.load(fh)
+        for key, pressure in sorted(expected.items()):
+            silents = pressure['observed_cdr_s'] + pressure['observed_fwr_s']
+            expected_s = (pressure['expected_cdr_s'] +
+                          pressure['expected_fwr_s'])
+            for region in ('cdr', 'fwr'):
+                result = focused_selection.focused_test(
+                    pressure['observed_{}_r'.format(region)], silents,
+                    pressure['expected_{}_r'.format(region)], expected_s)
+                stored = [pressure[field.format(region)] for field in (
+                    'sigma_{}', 'sigma_{}_cilower', 'sigma_{}_ciupper',
+                    'sigma_p_{}')]
+                if stored[0] is None:
+                    self.assertEqual(result, (None, None, None, None))
+                    continue
+                for value, stored_value in zip(result, stored):
+                    self.assertAlmostEqual(value, stored_value, delta=.03,
+                                           msg='{} {}'.format(key, region))
+
+    def test_matches_baseline_inputs(self):
+        # Recalculates the pipeline regression clones from their germlines
+        # and sequences.  BASELINe rounds to three decimals and its credible
+        # intervals are slightly wider than the native ones.
+        path = 'tests/data/regression/pipeline/'
+        with open(path + 'post_clones_clones.json') as fh:
+            clones = json.load(fh)
+        with open(path + 'post_clones_assignment.json') as fh:
+            assignments = json.load(fh)
+        with open(path + 'post_local_align_seqs.json') as fh:
+            seqs = json.load(fh)
+        with open(path + 'selection_pressure.json') as fh:
+            stored = json.load(fh)
+
+        # Each stored field with its key in the result and tolerance
+        fields = {}
+        for region in ('cdr', 'fwr'):
+            for mtype in ('r', 's'):
+                for kind, delta in (('observed', 0), ('expected', .001)):
+                    fields['{}_{}_{}'.format(kind, region, mtype)] = (
+                        '{}_{}_{}'.format(kind.capitalize(), region.upper(),
+                                          mtype.upper()), delta)
+            for field, name, delta in (
+                    ('sigma_{}', 'Sigma', .005),
+                    ('sigma_{}_cilower', 'CIlower', .03),
+                    ('sigma_{}_ciupper', 'CIupper', .03),
+                    ('sigma_p_{}', 'P', .005)):
+                fields[field.format(region)] = (
+                    'Focused_{}_{}'.format(name, region.upper()), delta)
+
+        for clone_id in range(1, 6):
+            clone_fields = clones[str(clone_id)]
+            clone = Clone(germline=clone_fields['germline'],
+                          cdr3_nt=clone_fields['cdr3_nt'],
+                          cdr3_num_nts=clone_fields['cdr3_num_nts'])
+            clone.insertions = clone_fields['insertions']
+            result = focused_selection.get_selection(
+                clone.consensus_germline,
+                [seqs[seq_id]['sequence']
+                 for seq_id, a in sorted(assignments.items())
+                 if a['clone_id'] == clone_id],
+                get_boundaries(clone.cdr3_num_nts))
+            for field, value in stored['{}-None-1'.format(
+                    clone_id)].items():
+                name, delta = fields[field]
+                self.assertAlmostEqual(
+                    result[name], value, delta=delta,
+                    msg='clone {} {}'.format(clone_id, field))
+
+    def test_random_mutations(self):
+        rand = np.random.RandomState(0)
+        germline = ''.join(rand.choice(list('ACGT'), 360))
+        seqs = []
+        for _ in range(200):
+            seq = list(germline)
+            for pos in rand.choice(len(seq), 10, replace=False):
+                seq[pos] = rand.choice(list('ACGT'))
+            seqs.append(''.join(seq))
+
+        result = focused_selection.get_selection(
+            germline, seqs, [1, 26, 38, 55, 65, 104, 116])
+        for region in ('CDR', 'FWR'):
+            self.assertTrue(result['Focused_CIlower_{}'.format(region)] <
+                            0 <
+                            result['Focused_CIupper_{}'.format(region)])
@@ -0,0 +1,90 @@
+import random
+import unittest
+
+import ete3
+
+import immunedb.trees.clearcut as clearcut
+from immunedb.trees import instantiate_node
+
+
+def make_tree(newick, mutations):
+    tree = ete3.Tree(newick)
+    for node in tree.traverse():
+        instantiate_node(node)
+        if node.name in mutations:
+            node.seq_ids = {node.name: {}}
+            node.copy_number = 1
+            node.mutations = set(mutations[node.name])
+    return tree
+
+
+def random_tree(rand, num_seqs, num_muts):
+    tree = ete3.Tree()
+    tree.populate(num_seqs + 1, names_library=['germline'] + [
+        str(i) for i in range(num_seqs)])
+    muts = [(i, 'A', 'C') for i in range(num_muts)]
+    inherited = {}
+    for node in tree.traverse('preorder'):
+        instantiate_node(node)
+        inherited[node] = inherited.get(node.up, set()) | set(
+            rand.sample(muts, rand.randint(0, 2)))
+        if node.is_leaf() and node.name != 'germline':
+            node.seq_ids = {node.name: {}}
+            node.copy_number = rand.randint(1, 5)
+            node.mutations = inherited[node]
+    return tree
+
+
+def as_tuple(tree):
+    return (''.join(sorted(tree.mutations)), sorted(tree.seq_ids),
+            [as_tuple(c) for c in tree.children])
+
+
+class MinimizeTreeTest(unittest.TestCase):
+    def test_shared(self):
+        tree = clearcut.minimize_tree(make_tree(
+            '(germline,((1,2),3));', {'1': 'abc', '2': 'abd', '3': 'ae'}))
+        self.assertEqual(as_tuple(tree), (
+            'a', [], [
+                ('b', [], [('c', ['1'], []), ('d', ['2'], [])]),
+                ('e', ['3'], [])
+            ]
+        ))
+
+    def test_observed_ancestor(self):
+        tree = clearcut.minimize_tree(make_tree(
+            '(germline,(1,(2,3)));', {'1': 'a', '2': 'ab', '3': 'ac'}))
+        self.assertEqual(as_tuple(tree), (
+            'a', ['1'], [('b', ['2'], []), ('c', ['3'], [])]
+        ))
+
+    def test_superset(self):
+        tree = clearcut.minimize_tree(make_tree(
+            '(germline,(1,(2,3)));', {'1': 'ab', '2': 'abc', '3': 'd'}))
+        self.assertEqual(as_tuple(tree), (
+            '', [], [('d', ['3'], []), ('ab', ['1'], [('c', ['2'], [])])]
+        ))
+
+    def test_random(self):
+        rand = random.Random(0)
+        for max_iterations in (None, 1):
+            for _ in range(20):
+                random.seed(rand.random())
+                tree = random_tree(rand, rand.randint(2, 100), 30)
+                seq_ids = set(
+                    s for n in tree.traverse() for s in n.seq_ids)
+                copies = sum(n.copy_number for n in tree.traverse())
+                tree = clearcut.minimize_tree(
+                    tree, max_iterations=max_iterations)
+
+                self.assertEqual(
+                    seq_ids, set(s for n in tree.traverse()
+                                 for s in n.seq_ids))
+                self.assertEqual(
+                    copies, sum(n.copy_number for n in tree.traverse()))
+                if max_iterations is None:
+                    for leaf in tree.get_leaves():
+                        path = [n.mutations for n in [leaf] +
+                                leaf.get_ancestors()]
+                        self.assertEqual(sum(len(m) for m in path),
+                                         len(set.union(*path)))
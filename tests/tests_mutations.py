@@ -0,0 +1,167 @@
+import random
+import unittest
+
+from immunedb.common.models import (Clone, deserialize_clone_mutations,
+                                    deserialize_mutations,
+                                    mutation_positions,
+                                    serialize_clone_mutations,
+                                    serialize_mutations)
+from immunedb.common.mutations import CloneMutations, ContextualMutations
+import immunedb.util.lookups as lookups
+
+
+class Seq(object):
+    def __init__(self, sample_id, ai, sequence, copy_number,
+                 copy_number_in_subject):
+        self.sample_id = sample_id
+        self.ai = ai
+        self.sequence = sequence
+        self._insertions = None
+        self.copy_number = copy_number
+        self.copy_number_in_subject = copy_number_in_subject
+
+
+def reference_mutations(clone, seqs, copies):
+    """Calls mutations one sequence and position at a time."""
+    germline = clone.consensus_germline
+
+    def aa_at(seq, i):
+        return lookups.aa_from_codon(seq[i - i % 3:i - i % 3 + 3])
+
+    context = ContextualMutations(clone.regions)
+    all_mutations = []
+    for seq, copy_number in zip(seqs, copies):
+        seq_mutations = {}
+        for i in range(len(seq)):
+            if (germline[i] == seq[i] or germline[i] in 'N-' or
+                    seq[i] in 'N-'):
+                continue
+            codon = germline[i - i % 3:i - i % 3 + 3]
+            from_aa = aa_at(germline, i)
+            intermediate_aa = lookups.aa_from_codon(
+                codon[:i % 3] + seq[i] + codon[i % 3 + 1:])
+            if from_aa is None or intermediate_aa is None:
+                mtype = 'unknown'
+            elif from_aa == intermediate_aa:
+                mtype = 'synonymous'
+            elif lookups.are_conserved_aas(from_aa, intermediate_aa):
+                mtype = 'conservative'
+            else:
+                mtype = 'nonconservative'
+            seq_mutations[i] = mtype
+            context.add_mutation(
+                seq, clone.cdr3_num_nts, (i, germline[i], seq[i], mtype),
+                from_aa, intermediate_aa, aa_at(seq, i), copy_number)
+        all_mutations.append(seq_mutations)
+    return context, all_mutations
+
+
+class CloneMutationsTest(unittest.TestCase):
+    def setUp(self):
+        # GAA -> E, TTT -> F, AAA -> K, GGG -> G
+        self.clone = Clone(germline='GAATTTAAAGGG', cdr3_nt='',
+                           cdr3_num_nts=0)
+
+    def test_types(self):
+        seqs = [
+            # GAC (D) is conservative, TTC is synonymous, NAA is skipped
+            Seq(1, 1, 'GACTTCNAAGGG', 2, 2),
+            # GAC again and TCT (S) is nonconservative
+            Seq(1, 2, 'GACTCTAAAGG-', 3, 0),
+            Seq(2, 3, 'GAATTTAAATGG', 1, 4),
+        ]
+        sample_muts, seq_muts = CloneMutations(
+            None, self.clone).calculate_for_seqs(seqs)
+
+        self.assertEqual(seq_muts[(1, 1)], {2: 'conservative',
+                                            5: 'synonymous'})
+        self.assertEqual(seq_muts[(1, 2)], {2: 'conservative',
+                                            4: 'nonconservative'})
+        self.assertEqual(seq_muts[(2, 3)], {9: 'nonconservative'})
+
+        sample = sample_muts[1].get_all()
+        conservative = sample['regions']['ALL']['conservative']
+        self.assertEqual(len(conservative), 1)
+        self.assertEqual(conservative[0]['unique'], 2)
+        self.assertEqual(conservative[0]['total'], 5)
+        self.assertEqual(conservative[0]['from_aa'], 'E')
+        self.assertEqual(conservative[0]['to_aas'], ['D'])
+        self.assertEqual(sample['positions'][2], {'conservative': 2})
+
+        # The overall mutations exclude sequences without subject copies and
+        # are weighted by subject copy number
+        overall = sample_muts[None].get_all()['regions']['ALL']
+        self.assertEqual(overall['conservative'][0]['total'], 2)
+        self.assertEqual(overall['nonconservative'][0]['pos'], 9)
+        self.assertEqual(overall['nonconservative'][0]['total'], 4)
+        self.assertEqual(overall['nonconservative'][0]['to_aas'], ['W'])
+
+    def test_random(self):
+        rand = random.Random(0)
+        stops = ['TAA', 'TAG', 'TGA']
+        for _ in range(200):
+            length = rand.choice([30, 31, 32])
+            germline = ''.join(
+                rand.choice(stops) if rand.random() < .2 else
+                ''.join(rand.choice('ACGTTGN-') for _ in range(3))
+                for _ in range(11))[:length]
+            clone = Clone(germline=germline, cdr3_nt='', cdr3_num_nts=0)
+            seqs = []
+            for ai in range(rand.randrange(8)):
+                seq = list(germline)
+                for _ in range(rand.randrange(6)):
+                    seq[rand.randrange(length)] = rand.choice('ACGTNa-')
+                for _ in range(rand.randrange(2)):
+                    start = rand.randrange(length) // 3 * 3
+                    seq[start:start + 3] = rand.choice(stops)
+                seqs.append(Seq(rand.choice([1, 2]), ai,
+                                ''.join(seq)[:length - rand.choice([0, 2])],
+                                rand.randint(1, 4), rand.choice([0, 3])))
+            seqs.sort(key=lambda s: (s.sample_id, s.ai))
+
+            sample_muts, seq_muts = CloneMutations(
+                None, clone).calculate_for_seqs(seqs)
+            for sample_id in set(s.sample_id for s in seqs) | set([None]):
+                if sample_id is None:
+                    included = [s for s in seqs
+                                if s.copy_number_in_subject > 0]
+                    copies = [s.copy_number_in_subject for s in included]
+                else:
+                    included = [s for s in seqs if s.sample_id == sample_id]
+                    copies = [s.copy_number for s in included]
+                context, mutations = reference_mutations(
+                    clone, [s.sequence for s in included], copies)
+                self.assertEqual(sample_muts[sample_id].get_all(),
+                                 context.get_all())
+                for seq, seq_mutations in zip(included, mutations):
+                    self.assertEqual(seq_muts[(seq.sample_id, seq.ai)],
+                                     seq_mutations)
+
+
+class MutationEncodingTest(unittest.TestCase):
+    def test_round_trip(self):
+        mutations = {12: 'conservative', 5: 'synonymous',
+                     300: 'nonconservative', 7: 'unknown'}
+        for compact in (False, True):
+            value = serialize_mutations(mutations, compact=compact)
+            self.assertEqual(deserialize_mutations(value), mutations)
+            self.assertEqual(mutation_positions(value), [12, 5, 300, 7])
+
+        clone_mutations = {'regions': {}, 'positions': {'5': {'unknown': 1}}}
+        for compact in (False, True):
+            value = serialize_clone_mutations(clone_mutations,
+                                              compact=compact)
+            self.assertEqual(deserialize_clone_mutations(value),
+                             clone_mutations)
+
+    def test_compact_large_position(self):
+        mutations = {12: 'conservative', 8192: 'synonymous'}
+        value = serialize_mutations(mutations, compact=True)
+        self.assertEqual(deserialize_mutations(value), mutations)
+        self.assertEqual(mutation_positions(value), [12, 8192])
+
+    def test_compact_is_smaller(self):
+        mutations = {i: 'nonconservative' for i in range(0, 300, 7)}
+        self.assertLess(
+            len(serialize_mutations(mutations, compact=True)) * 5,
+            len(serialize_mutations(mutations)))
@@ -0,0 +1,66 @@
+import random
+import shutil
+import time
+import unittest
+
+import ete3
+import numpy as np
+
+import immunedb.trees.clearcut as clearcut
+import immunedb.trees.nj as nj
+
+
+def random_alignment(rand, num_seqs, length):
+    """Simulates sequences evolving down a random binary tree."""
+    seqs = [''.join(rand.choice('ACGT') for _ in range(length))]
+    while len(seqs) < num_seqs:
+        parent = list(seqs.pop(rand.randrange(len(seqs))))
+        for _ in range(2):
+            child = list(parent)
+            for _ in range(rand.randint(1, 4)):
+                child[rand.randrange(length)] = rand.choice('ACGT')
+            seqs.append(''.join(child))
+    return ''.join('>{}\n{}\n'.format(i, s) for i, s in enumerate(seqs))
+
+
+class NeighborJoiningTest(unittest.TestCase):
+    def test_additive(self):
+        rand = np.random.RandomState(0)
+        for _ in range(20):
+            tree = ete3.Tree()
+            tree.populate(rand.randint(3, 20), random_branches=True)
+            leaves = tree.get_leaves()
+            dists = [[a.get_distance(b) for b in leaves] for a in leaves]
+            found = ete3.Tree(
+                nj.neighbor_join(dists, [leaf.name for leaf in leaves]))
+            self.assertEqual(
+                found.robinson_foulds(tree, unrooted_trees=True)[0], 0)
+
+    def test_relaxed(self):
+        fasta = random_alignment(random.Random(0), 50, 100)
+        tree = ete3.Tree(nj.get_newick(fasta, relaxed=True))
+        self.assertEqual(len(tree.get_leaves()), 50)
+
+    def test_too_few(self):
+        self.assertEqual(nj.get_newick('>germline\nACGT\n'), '')
+
+    @unittest.skipUnless(shutil.which('clearcut'), 'clearcut not installed')
+    def test_against_clearcut(self):
+        rand = random.Random(0)
+        for num_seqs in (10, 50, 200):
+            fasta = random_alignment(rand, num_seqs, 300)
+
+            start = time.time()
+            reference = ete3.Tree(clearcut.get_newick(fasta))
+            clearcut_time = time.time() - start
+
+            start = time.time()
+            found = ete3.Tree(nj.get_newick(fasta))
+            nj_time = time.time() - start
+
+            rf, max_rf = found.robinson_foulds(
+                reference, unrooted_trees=True)[:2]
+            self.assertLessEqual(
+                rf, .1 * max_rf,
+                '{} sequences: clearcut {:.3f}s, nj {:.3f}s, RF {} / '
+                '{}'.format(num_seqs, clearcut_time, nj_time, rf, max_rf))
@@ -0,0 +1,40 @@
+from collections import namedtuple
+import random
+import unittest
+
+from immunedb.trees import sample_sequences
+
+Candidate = namedtuple('Candidate', ('ai', 'copy_number_in_subject',
+                                     'samples_in_subject'))
+
+
+class SampleSequencesTest(unittest.TestCase):
+    def setUp(self):
+        rand = random.Random(0)
+        self.candidates = [
+            Candidate(i, rand.choice([1] * 20 + [2, 5, 100]),
+                      rand.choice([1] * 50 + [2]))
+            for i in range(2000)
+        ]
+
+    def test_size(self):
+        chosen = sample_sequences(self.candidates, 300)
+        self.assertEqual(len(chosen), 300)
+        self.assertEqual(chosen, sample_sequences(self.candidates, 300))
+        self.assertEqual(len(sample_sequences(self.candidates[:10], 300)),
+                         10)
+
+    def test_required(self):
+        chosen = sample_sequences(self.candidates, 300)
+        for c in self.candidates:
+            if c.samples_in_subject > 1:
+                self.assertIn(c.ai, chosen)
+        top = sorted(self.candidates,
+                     key=lambda c: (-c.copy_number_in_subject, c.ai))
+        for c in top[:150]:
+            self.assertIn(c.ai, chosen)
+
+    def test_zero_copies(self):
+        candidates = [Candidate(1, 0, 1), Candidate(2, 3, 1),
+                      Candidate(3, 0, 1), Candidate(4, 1, 1)]
+        self.assertEqual(sample_sequences(candidates, 3), set([2, 4, 1]))
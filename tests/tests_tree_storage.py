@@ -0,0 +1,78 @@
+import json
+import unittest
+
+import ete3
+
+from immunedb.trees import (deserialize_tree, expand_tree, get_tree_nodes,
+                            instantiate_node, serialize_tree, tree_as_dict)
+
+
+def make_seq(ai, copy_number, sample_id):
+    return {
+        'ai': ai,
+        'copy_number': copy_number,
+        'sample_name': 'sample{}'.format(sample_id),
+        'sample_id': sample_id,
+        'metadata': {'tissue': 'tissue{}'.format(sample_id % 2),
+                     'sample_id': str(sample_id)}
+    }
+
+
+def make_tree(root_seqs):
+    tree = ete3.Tree('((A,B)C,D);', format=1)
+    seqs = {
+        'A': {'seqA1': make_seq(1, 3, 1), 'seqA2': make_seq(2, 1, 2)},
+        'B': {'seqB': make_seq(3, 2, 2)},
+        'D': {'seqD': make_seq(4, 5, 3)},
+    }
+    for i, node in enumerate(tree.traverse()):
+        instantiate_node(node)
+        node.add_feature('node_id', i)
+        node.seq_ids = seqs.get(node.name, {})
+        node.copy_number = sum(s['copy_number'] for s in node.seq_ids.values())
+        node.mutations = set([(i + 1, 'A', 'T')]) if node.up else set()
+    if root_seqs:
+        tree.seq_ids = {'seqR': make_seq(5, 1, 1)}
+    return {'info': {'min_mut_copies': 0}, 'tree': tree_as_dict(tree)}
+
+
+class TreeStorageTest(unittest.TestCase):
+    def test_round_trip(self):
+        for root_seqs in (False, True):
+            tree = json.loads(json.dumps(make_tree(root_seqs)))
+            value = serialize_tree(tree, compact=True)
+            self.assertLess(len(value), len(serialize_tree(tree)))
+            self.assertEqual(deserialize_tree(value), tree)
+            self.assertEqual(deserialize_tree(serialize_tree(tree)), tree)
+
+    def test_samples_by_id(self):
+        tree = deserialize_tree(serialize_tree(make_tree(False), True),
+                                expand=False)
+        self.assertEqual(sorted(tree['samples']), ['1', '2', '3'])
+        self.assertEqual(tree['samples']['2'], {
+            'name': 'sample2',
+            'metadata': {'tissue': 'tissue0', 'sample_id': '2'}
+        })
+
+    def test_skeleton(self):
+        compact = deserialize_tree(serialize_tree(make_tree(False)),
+                                   expand=False)
+        skeleton = expand_tree(compact, details=False)['tree']
+        self.assertEqual(skeleton['data'], {
+            'node_id': 0,
+            'copy_number': 0,
+            'mutations': [],
+            'num_seqs': 0
+        })
+        leaf = skeleton['children'][0]['children'][0]['data']
+        self.assertEqual(leaf['num_seqs'], 2)
+        self.assertNotIn('seq_ids', leaf)
+
+        nodes = get_tree_nodes(compact, [leaf['node_id'], 100])
+        self.assertEqual(list(nodes), [leaf['node_id']])
+        self.assertEqual(sorted(nodes[leaf['node_id']]['seq_ids']),
+                         ['seqA1', 'seqA2'])
+        self.assertEqual(nodes[leaf['node_id']]['metadata'], {
+            'tissue': ['tissue0', 'tissue1'],
+            'sample_id': ['1', '2']
+        })
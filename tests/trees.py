@@ -1,4 +1,4 @@
-import json
+from immunedb.trees import deserialize_tree
 
 
 def get_leaves(tree):
@@ -53,8 +53,8 @@ def get_max_leaf_dist(tree):
 
 
 def tree_compare(found, correct, error):
-    found = json.loads(found)['tree']
-    correct = json.loads(correct)['tree']
+    found = deserialize_tree(found)['tree']
+    correct = deserialize_tree(correct)['tree']
     metrics = [get_leaves, get_height, get_height_muts, get_node_num,
                get_max_leaf_dist]
 